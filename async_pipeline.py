@@ -0,0 +1,356 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from openai import AsyncOpenAI
+import main
+from tracing import (
+    trace_stage, set_trace_attribute, record_llm_call, run_in_trace_context, iterate_in_context_async
+)
+
+# Maximum number of questions in flight at once, and the time budget for each
+ASYNC_MAX_CONCURRENCY = int(os.getenv('ASYNC_MAX_CONCURRENCY', '32'))
+ASYNC_REQUEST_TIMEOUT = float(os.getenv('ASYNC_REQUEST_TIMEOUT', '60'))
+
+# Initialize async OpenAI client
+async_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+
+
+async def run_blocking(function, *args, executor=None):
+    """
+    Run a blocking call (SQLite, file I/O) on a thread pool so it does not stall the event loop.
+    Executor threads do not inherit the context, so the request's trace is handed over explicitly.
+    """
+    return await asyncio.get_running_loop().run_in_executor(executor, run_in_trace_context(function, *args))
+
+
+async def create_chat_completion_async(stage, **kwargs):
+    """
+    Async version of main.create_chat_completion
+    """
+    start = time.perf_counter()
+    kwargs = dict(model="gpt-3.5-turbo", **kwargs)
+    cassette = main.get_cassette()
+    response = await run_blocking(cassette.replay, stage, kwargs) if cassette is not None else None
+    retries = 0
+    if response is None:
+        raw = await async_client.chat.completions.with_raw_response.create(**kwargs)
+        response = raw.parse()
+        retries = raw.retries_taken
+        if cassette is not None:
+            await run_blocking(cassette.record, stage, kwargs, response)
+    record_llm_call(stage, response.usage, retries, time.perf_counter() - start)
+    return response
+
+
+async def check_query_relevance_async(user_input, on_llm_fallback=None):
+    """
+    Async version of main.check_query_relevance
+    """
+    with trace_stage('relevance'):
+        decision = main.classify_relevance_locally(user_input)
+        if decision is not None:
+            set_trace_attribute('relevance_source', 'local')
+            return decision
+
+        set_trace_attribute('relevance_source', 'llm')
+        if on_llm_fallback is not None:
+            on_llm_fallback()
+        start = time.perf_counter()
+        response = await create_chat_completion_async(
+            'relevance',
+            messages=main.build_relevance_messages(user_input),
+            temperature=0
+        )
+        main.record_relevance_llm_call(time.perf_counter() - start)
+        return main.parse_relevance_answer(response.choices[0].message.content)
+
+
+async def generate_sql_query_async(user_input):
+    """
+    Async version of main.generate_sql_query
+    """
+    with trace_stage('sql_generation'):
+        # Finding the nearest verified examples reads the query library
+        messages = await run_blocking(main.build_sql_messages, user_input)
+        response = await create_chat_completion_async(
+            'sql_generation',
+            messages=messages,
+            temperature=0
+        )
+    return response.choices[0].message.content.strip()
+
+
+async def generate_response_async(user_input, query_results, stats=None):
+    """
+    Async version of main.generate_response
+    """
+    with trace_stage('response'):
+        templated, messages = main.prepare_response(user_input, query_results, stats)
+        if templated is not None:
+            return templated
+
+        response = await create_chat_completion_async('response', messages=messages)
+    return response.choices[0].message.content.strip()
+
+
+async def stream_chat_completion_async(stage, **kwargs):
+    """
+    Async version of main.stream_chat_completion
+    """
+    start = time.perf_counter()
+    kwargs = dict(model="gpt-3.5-turbo", **kwargs)
+    cassette = main.get_cassette()
+    response = await run_blocking(cassette.replay, stage, kwargs) if cassette is not None else None
+    if response is not None:
+        record_llm_call(stage, response.usage, 0, time.perf_counter() - start)
+        yield response.choices[0].message.content
+        return
+
+    raw = await async_client.chat.completions.with_raw_response.create(
+        stream=True, stream_options={"include_usage": True}, **kwargs
+    )
+    parts, first, usage = [], None, None
+    try:
+        async with raw.parse() as stream:
+            async for chunk in stream:
+                first = first or chunk
+                usage = chunk.usage or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+    finally:
+        record_llm_call(stage, usage, raw.retries_taken, time.perf_counter() - start)
+    if cassette is not None and first is not None:
+        await run_blocking(cassette.record, stage, kwargs, main.ChatCompletion.model_validate({
+            'id': first.id, 'created': first.created, 'model': first.model, 'object': 'chat.completion',
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': ''.join(parts)}}],
+            'usage': usage.model_dump() if usage is not None else None
+        }))
+
+
+async def stream_response_async(user_input, query_results, stats=None):
+    """
+    Async version of main.stream_response
+    """
+    with trace_stage('response'):
+        templated, messages = main.prepare_response(user_input, query_results, stats)
+        if templated is not None:
+            yield templated
+            return
+
+        started = False
+        async for piece in stream_chat_completion_async('response', messages=messages):
+            if not started:
+                piece = piece.lstrip()
+                started = bool(piece)
+            if piece:
+                yield piece
+
+
+class AsyncPipeline:
+    """
+    Runs the question pipeline on asyncio so one process can keep many questions in flight.
+
+    LLM calls use AsyncOpenAI, SQLite execution runs on a thread pool, and a
+    semaphore caps how many questions are processed at once.
+    """
+
+    def __init__(self, max_concurrency=ASYNC_MAX_CONCURRENCY, request_timeout=ASYNC_REQUEST_TIMEOUT,
+                 db_workers=None):
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=db_workers or main.DB_POOL_SIZE, thread_name_prefix='sqlite'
+        )
+        self._semaphores = {}
+
+    def _get_semaphore(self):
+        # One semaphore per event loop, since asyncio primitives are bound to a loop
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            self._semaphores = {loop: asyncio.Semaphore(self.max_concurrency)}
+            semaphore = self._semaphores[loop]
+        return semaphore
+
+    async def execute_sql_query(self, query, params=(), export_format=None, export_min_rows=None):
+        return await run_blocking(
+            main.execute_sql_query, query, params, export_format, export_min_rows, executor=self._executor
+        )
+
+    async def get_sql_for_question(self, user_input, result):
+        """
+        Async version of main.get_sql_for_question
+        """
+        # The query library and SQL cache lookups read SQLite
+        sql_query = await run_blocking(main.lookup_known_sql, user_input, result, executor=self._executor)
+        if sql_query is not None:
+            return sql_query
+
+        if main.SPECULATIVE_EXECUTION:
+            # SQL generation only starts once the local classifier turns out to be unsure
+            sql_task = None
+
+            def speculate():
+                nonlocal sql_task
+                sql_task = asyncio.create_task(generate_sql_query_async(user_input))
+
+            try:
+                result['relevant'] = await check_query_relevance_async(user_input, on_llm_fallback=speculate)
+            except BaseException:
+                if sql_task is not None:
+                    sql_task.cancel()
+                raise
+            if sql_task is None:
+                if not result['relevant']:
+                    return None
+                sql_query = await generate_sql_query_async(user_input)
+            elif not result['relevant']:
+                # Unlike the threaded mode, an in-flight request is really cancelled
+                main.record_speculative_run(discarded=sql_task.done())
+                sql_task.cancel()
+                return None
+            else:
+                main.record_speculative_run(discarded=False)
+                sql_query = await sql_task
+        else:
+            result['relevant'] = await check_query_relevance_async(user_input)
+            if not result['relevant']:
+                return None
+            sql_query = await generate_sql_query_async(user_input)
+
+        result['sql_source'] = 'llm'
+        return sql_query
+
+    async def _run(self, user_input):
+        result = main.new_pipeline_result(user_input)
+        async for _ in self._steps(user_input, result):
+            pass
+        return result
+
+    async def _steps(self, user_input, result, stream=False):
+        """
+        Async version of main._pipeline_steps
+        """
+        timings = result['timings']
+        start = time.perf_counter()
+
+        # Generate and execute SQL query
+        sql_query = await self.get_sql_for_question(user_input, result)
+        timings['sql'] = time.perf_counter() - start
+        if sql_query is None:
+            timings['total'] = timings['sql']
+            return
+        result['sql'] = sql_query
+        yield main.sql_event(result)
+        query_results = await self.execute_sql_query(
+            sql_query, result['sql_params'], *main.export_options(user_input)
+        )
+        await run_blocking(main.store_generated_sql, user_input, result, executor=self._executor)
+        result['columns'], result['rows'] = query_results
+        result['export'] = query_results[1].export
+        result['next_cursor'] = await run_blocking(main.next_page_token, result, executor=self._executor)
+        timings['execute'] = time.perf_counter() - start - timings['sql']
+        yield main.rows_event(result)
+
+        # Generate natural language response
+        if stream:
+            parts = []
+            async for piece in stream_response_async(user_input, query_results, stats=result):
+                if not parts:
+                    timings['first_token'] = time.perf_counter() - start
+                parts.append(piece)
+                yield {'event': 'token', 'text': piece}
+            result['response'] = ''.join(parts).rstrip()
+        else:
+            result['response'] = await generate_response_async(user_input, query_results, stats=result)
+            timings['first_token'] = time.perf_counter() - start
+            yield {'event': 'token', 'text': result['response']}
+        timings['total'] = time.perf_counter() - start
+        timings['response'] = timings['total'] - timings['sql'] - timings['execute']
+
+    async def run_pipeline(self, user_input):
+        """
+        Async version of main.run_pipeline, bounded by the concurrency limit and request timeout
+        """
+        async with self._get_semaphore():
+            with main.pipeline_trace(user_input, 'async') as trace:
+                result = await asyncio.wait_for(self._run(user_input), timeout=self.request_timeout)
+                if trace is not None:
+                    trace.finish(result)
+                    result['trace_id'] = trace.trace_id
+                return result
+
+    def stream_pipeline(self, user_input):
+        """
+        Async version of main.stream_pipeline, bounded by the concurrency limit. The client
+        sees each stage as it finishes, so a stream is not cut off by the request timeout.
+        The request's trace is only current while a step runs, not in the caller between events.
+        """
+        return iterate_in_context_async(self._stream_pipeline(user_input))
+
+    async def _stream_pipeline(self, user_input):
+        async with self._get_semaphore():
+            with main.pipeline_trace(user_input, 'async') as trace:
+                result = main.new_pipeline_result(user_input)
+                async for event in self._steps(user_input, result, stream=True):
+                    yield event
+                if trace is not None:
+                    trace.finish(result)
+                    result['trace_id'] = trace.trace_id
+        yield {'event': 'done', 'result': result}
+
+    async def process_user_input(self, user_input):
+        """
+        Async version of main.process_user_input
+        """
+        try:
+            return main.format_pipeline_result(await self.run_pipeline(user_input))
+        except asyncio.TimeoutError:
+            return f"An error occurred: the request timed out after {self.request_timeout} seconds"
+        except Exception as e:
+            return f"An error occurred: {str(e)}"
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+_default_pipeline = None
+
+
+def get_async_pipeline():
+    """
+    Return the shared async pipeline, creating it on first use
+    """
+    global _default_pipeline
+    if _default_pipeline is None:
+        _default_pipeline = AsyncPipeline()
+    return _default_pipeline
+
+
+async def process_user_input_async(user_input):
+    return await get_async_pipeline().process_user_input(user_input)
+
+
+def stream_pipeline_async(user_input):
+    """
+    Yield the pipeline's events for the question as they happen (see main.stream_pipeline)
+    """
+    return get_async_pipeline().stream_pipeline(user_input)
+
+
+async def process_many_async(questions):
+    """
+    Process several questions concurrently and return their responses in order
+    """
+    pipeline = get_async_pipeline()
+    return await asyncio.gather(*(pipeline.process_user_input(question) for question in questions))
+
+
+def process_user_input_sync(user_input):
+    """
+    Thin synchronous wrapper around the async pipeline for callers without an event loop
+    """
+    return asyncio.run(process_user_input_async(user_input))
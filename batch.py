@@ -0,0 +1,121 @@
+import argparse
+import csv
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from query_cache import question_key
+from main import run_pipeline, pipeline_result_to_dict
+
+
+def read_questions(path):
+    """
+    Read (id, question) pairs from a JSONL or CSV file.
+    JSONL lines may be plain strings or objects with a "question" and optional "id";
+    CSV files use the "question" and "id" columns, or the first column if there is no header.
+    """
+    questions = []
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            for line_number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                if isinstance(record, str):
+                    questions.append((line_number, record))
+                else:
+                    questions.append((record.get('id', line_number), record['question']))
+    elif path.endswith('.csv'):
+        with open(path, encoding='utf-8', newline='') as f:
+            rows = list(csv.reader(f))
+        if rows and 'question' in rows[0]:
+            header = rows[0]
+            question_column = header.index('question')
+            id_column = header.index('id') if 'id' in header else None
+            for row_number, row in enumerate(rows[1:], start=2):
+                if not row:
+                    continue
+                record_id = row[id_column] if id_column is not None else row_number
+                questions.append((record_id, row[question_column]))
+        else:
+            questions = [(row_number, row[0]) for row_number, row in enumerate(rows, start=1) if row]
+    else:
+        raise ValueError(f"Unsupported question file {path}: expected .jsonl or .csv")
+    return [(record_id, question.strip()) for record_id, question in questions if question.strip()]
+
+
+def dedupe_questions(questions):
+    """
+    Group (id, question) pairs by normalized question; the first wording seen is the one run
+    """
+    groups = {}
+    for record_id, question in questions:
+        groups.setdefault(question_key(question), []).append((record_id, question))
+    return groups
+
+
+def result_record(record_id, question, result, error, duplicate_of=None):
+    """
+    Build the output line for one input question
+    """
+    record = {'id': record_id}
+    if result is not None:
+        record.update(pipeline_result_to_dict(result))
+    record.update({'question': question, 'error': error, 'duplicate_of': duplicate_of})
+    return record
+
+
+def run_batch(questions, output_path, workers=8):
+    """
+    Run every unique question through the pipeline on a bounded worker pool,
+    appending each result to the output JSONL file as soon as it finishes
+    """
+    groups = dedupe_questions(questions)
+    summary = {'questions': len(questions), 'unique': len(groups), 'errors': 0}
+    start = time.perf_counter()
+
+    def run_one(question):
+        try:
+            return run_pipeline(question), None
+        except Exception as e:
+            return None, str(e)
+
+    with open(output_path, 'w', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_one, group[0][1]): group for group in groups.values()}
+        for future in as_completed(futures):
+            group = futures[future]
+            result, error = future.result()
+            first_id = group[0][0]
+            if error is not None:
+                summary['errors'] += 1
+            for index, (record_id, question) in enumerate(group):
+                record = result_record(record_id, question, result, error,
+                                       duplicate_of=first_id if index else None)
+                out.write(json.dumps(record, default=str) + '\n')
+            out.flush()
+
+    summary['seconds'] = time.perf_counter() - start
+    summary['questions_per_second'] = summary['unique'] / summary['seconds'] if summary['seconds'] else 0.0
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a file of questions about the employee database")
+    parser.add_argument('input', help="JSONL or CSV file of questions")
+    parser.add_argument('-o', '--output', default='results.jsonl', help="JSONL file to write results to")
+    parser.add_argument('-w', '--workers', type=int, default=8, help="number of questions processed at once")
+    args = parser.parse_args(argv)
+
+    questions = read_questions(args.input)
+    summary = run_batch(questions, args.output, workers=args.workers)
+    print(
+        f"Processed {summary['questions']} questions ({summary['unique']} unique) in "
+        f"{summary['seconds']:.2f}s, {summary['errors']} errors, "
+        f"{summary['questions_per_second']:.2f} questions/s",
+        file=sys.stderr
+    )
+
+
+if __name__ == '__main__':
+    main()
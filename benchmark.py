@@ -0,0 +1,574 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Questions the benchmark asks, with the SQL the stand-in model answers them with
+BENCHMARK_QUESTIONS = {
+    "How many employees are in each department?":
+        "SELECT department, COUNT(*) AS employees FROM employees GROUP BY department",
+    "Who are the 10 highest paid employees?":
+        "SELECT first_name, last_name, salary FROM employees ORDER BY salary DESC LIMIT 10",
+    "What is the average salary in Engineering?":
+        "SELECT AVG(salary) FROM employees WHERE department = 'Engineering'",
+    "Which Sales employees were hired in 2024?":
+        "SELECT first_name, last_name, hire_date FROM employees "
+        "WHERE department = 'Sales' AND hire_date >= '2024-01-01'",
+    "Who reports to manager 5?":
+        "SELECT first_name, last_name, job_title FROM employees WHERE manager_id = 5",
+    "Which employees have a performance rating above 4.9?":
+        "SELECT e.first_name, e.last_name, s.performance_rating FROM employees e "
+        "JOIN employee_stats s ON e.employee_id = s.employee_id WHERE s.performance_rating > 4.9",
+    "Which managers have the largest teams?":
+        "SELECT m.first_name, m.last_name, COUNT(*) AS reports FROM employees e "
+        "JOIN employees m ON e.manager_id = m.employee_id GROUP BY m.employee_id ORDER BY reports DESC LIMIT 10"
+}
+
+# Off-topic questions that share words with employee questions; the mock LLM answers NO for
+# them, and the relevance scenario counts any that come back relevant as errors
+OFF_TOPIC_QUESTIONS = [
+    "What is the highest mountain?",
+    "Who is the highest paid actor?",
+    "How do I ask my boss for a raise?",
+    "What is the average salary in Germany?",
+    "Who is the CEO of Apple?",
+    "Tell me a joke about engineering"
+]
+
+DEFAULT_SQL = "SELECT COUNT(*) FROM employees"
+
+# Full listing streamed to a file by the export scenarios, one row per employee
+EXPORT_SQL = (
+    "SELECT e.employee_id, e.first_name, e.last_name, e.department, e.job_title, e.salary, e.hire_date, "
+    "s.performance_rating, s.annual_leave_balance FROM employees e "
+    "LEFT JOIN employee_stats s ON s.employee_id = e.employee_id"
+)
+CANNED_RESPONSE = "Based on the query results, here is the answer to your question."
+
+# Metrics compared between runs; a rise in these is a regression
+LATENCY_METRICS = ('p50', 'p95', 'p99')
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of the values
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize_latencies(values):
+    """
+    Return p50/p95/p99, mean and max of latencies given in seconds, in milliseconds
+    """
+    if not values:
+        return {}
+    return {
+        'p50': percentile(values, 0.50) * 1000,
+        'p95': percentile(values, 0.95) * 1000,
+        'p99': percentile(values, 0.99) * 1000,
+        'mean': sum(values) / len(values) * 1000,
+        'max': max(values) * 1000
+    }
+
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+
+class MockOpenAIServer:
+    """
+    Local stand-in for the chat completions endpoint.
+
+    Requests are answered after latency seconds (plus up to jitter seconds) with a
+    canned reply chosen from the system prompt: YES for the relevance check (NO for
+    OFF_TOPIC_QUESTIONS), the SQL from BENCHMARK_QUESTIONS for SQL generation and
+    CANNED_RESPONSE otherwise.
+    Streamed requests get the reply as server-sent events, one word per chunk.
+    Calls and approximate token counts are tallied per kind of request.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, questions=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.questions = questions or BENCHMARK_QUESTIONS
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {}
+
+    def stats(self):
+        with self._lock:
+            return {kind: dict(values) for kind, values in self._stats.items()}
+
+    def reply(self, messages):
+        """
+        Return (kind, content) for a list of chat messages
+        """
+        system = next((message['content'] for message in messages if message['role'] == 'system'), '')
+        user = next((message['content'] for message in reversed(messages) if message['role'] == 'user'), '')
+        if 'determines if a user query' in system:
+            return 'relevance', 'NO' if user in OFF_TOPIC_QUESTIONS else 'YES'
+        if 'SQL expert' in system:
+            for question, sql in self.questions.items():
+                if question in user:
+                    return 'sql', sql
+            return 'sql', DEFAULT_SQL
+        return 'response', CANNED_RESPONSE
+
+    def _record(self, kind, prompt_tokens, completion_tokens):
+        with self._lock:
+            stats = self._stats.setdefault(kind, {'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0})
+            stats['calls'] += 1
+            stats['prompt_tokens'] += prompt_tokens
+            stats['completion_tokens'] += completion_tokens
+
+    def _delay(self):
+        with self._lock:
+            return self.latency + self._rng.random() * self.jitter
+
+    def start(self, host='127.0.0.1', port=0):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                payload = json.loads(self.rfile.read(length) or b'{}')
+                if not self.path.endswith('/chat/completions'):
+                    self.send_error(404)
+                    return
+                messages = payload.get('messages', [])
+                kind, content = mock.reply(messages)
+                prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+                completion_tokens = estimate_tokens(content)
+                time.sleep(mock._delay())
+                mock._record(kind, prompt_tokens, completion_tokens)
+                usage = {
+                    'prompt_tokens': prompt_tokens,
+                    'completion_tokens': completion_tokens,
+                    'total_tokens': prompt_tokens + completion_tokens
+                }
+                if payload.get('stream'):
+                    self._stream(payload, content, usage)
+                    return
+                body = json.dumps({
+                    'id': 'chatcmpl-benchmark',
+                    'object': 'chat.completion',
+                    'created': int(time.time()),
+                    'model': payload.get('model', 'gpt-3.5-turbo'),
+                    'choices': [{
+                        'index': 0,
+                        'message': {'role': 'assistant', 'content': content},
+                        'finish_reason': 'stop'
+                    }],
+                    'usage': usage
+                }).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, payload, content, usage):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                chunk = {'id': 'chatcmpl-benchmark', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                         'model': payload.get('model', 'gpt-3.5-turbo')}
+                words = content.split(' ')
+                for index, word in enumerate(words):
+                    delta = {'content': word if index == 0 else ' ' + word}
+                    finish = 'stop' if index == len(words) - 1 else None
+                    event = dict(chunk, choices=[{'index': 0, 'delta': delta, 'finish_reason': finish}])
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+                if (payload.get('stream_options') or {}).get('include_usage'):
+                    event = dict(chunk, choices=[], usage=usage)
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+def benchmark_questions(count):
+    """
+    Return count questions cycling through BENCHMARK_QUESTIONS; a request number keeps
+    each one distinct so batch dedupe and question caches do not collapse them
+    """
+    questions = list(BENCHMARK_QUESTIONS)
+    return [f"{questions[index % len(questions)]} (request {index})" for index in range(count)]
+
+
+def _peak_rss_kb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux
+    return usage // 1024 if sys.platform == 'darwin' else usage
+
+
+def _run_scenario(name, concurrency, requests, run):
+    """
+    Call run() and wrap its stage latencies into a scenario report.
+    run returns (stage_latencies, errors) where stage_latencies maps a stage to seconds per request.
+    """
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    stage_latencies, errors = run()
+    seconds = time.perf_counter() - start
+    report = {
+        'name': name,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': errors,
+        'seconds': seconds,
+        'throughput': requests / seconds if seconds else 0.0,
+        'stages': {stage: summarize_latencies(values) for stage, values in stage_latencies.items()},
+        'peak_rss_kb': _peak_rss_kb()
+    }
+    if tracing:
+        report['peak_traced_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+    return report
+
+
+def _run_threaded(function, items, concurrency):
+    """
+    Run function over items on a thread pool, returning the results in order and the error count
+    """
+    errors = 0
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(function, item) for item in items]:
+            try:
+                results.append(future.result())
+            except Exception:
+                errors += 1
+    return results, errors
+
+
+def _stage_timings(results):
+    stages = {}
+    for timings in results:
+        for stage, seconds in timings.items():
+            stages.setdefault(stage, []).append(seconds)
+    return stages
+
+
+def run_worker(config):
+    """
+    Run every scenario against one database inside this process; main is imported
+    here so it picks up the environment the parent prepared
+    """
+    import main
+    import async_pipeline
+    import batch
+
+    if config.get('trace_memory'):
+        tracemalloc.start()
+    requests = config['requests']
+    sql_statements = list(BENCHMARK_QUESTIONS.values())
+    scenarios = []
+
+    # Warm the connection pool and classifiers so the first scenario is not charged for them
+    main.process_user_input(next(iter(BENCHMARK_QUESTIONS)))
+
+    for concurrency in config['concurrency']:
+        def execute(sql):
+            start = time.perf_counter()
+            main.execute_sql_query(sql)
+            return {'execute': time.perf_counter() - start}
+
+        def run_execute():
+            statements = [sql_statements[index % len(sql_statements)] for index in range(requests)]
+            results, errors = _run_threaded(execute, statements, concurrency)
+            return _stage_timings(results), errors
+        scenarios.append(_run_scenario('execute_sql_query', concurrency, requests, run_execute))
+
+        def process(question):
+            # The same calls process_user_input makes, keeping the stage timings it discards
+            start = time.perf_counter()
+            result = main.run_pipeline(question)
+            main.format_pipeline_result(result)
+            timings = dict(result['timings'])
+            timings['total'] = time.perf_counter() - start
+            return timings
+
+        def run_sync():
+            results, errors = _run_threaded(process, benchmark_questions(requests), concurrency)
+            return _stage_timings(results), errors
+        scenarios.append(_run_scenario('process_user_input', concurrency, requests, run_sync))
+
+        def run_async():
+            pipeline = async_pipeline.AsyncPipeline(max_concurrency=concurrency)
+
+            async def run_all():
+                return await asyncio.gather(
+                    *(pipeline.run_pipeline(question) for question in benchmark_questions(requests)),
+                    return_exceptions=True
+                )
+            try:
+                outcomes = asyncio.run(run_all())
+            finally:
+                pipeline.close()
+            results = [outcome['timings'] for outcome in outcomes if not isinstance(outcome, BaseException)]
+            return _stage_timings(results), len(outcomes) - len(results)
+        scenarios.append(_run_scenario('async_pipeline', concurrency, requests, run_async))
+
+        def run_batch():
+            with tempfile.TemporaryDirectory() as tmp:
+                questions = list(enumerate(benchmark_questions(requests)))
+                summary = batch.run_batch(questions, os.path.join(tmp, 'results.jsonl'), workers=concurrency)
+            return {}, summary['errors']
+        scenarios.append(_run_scenario('batch', concurrency, requests, run_batch))
+
+    def check_relevance(question):
+        start = time.perf_counter()
+        if main.check_query_relevance(question):
+            raise ValueError(f"Off-topic question judged relevant: {question}")
+        return {'total': time.perf_counter() - start}
+
+    def run_relevance():
+        results, errors = _run_threaded(check_relevance, OFF_TOPIC_QUESTIONS, 1)
+        return _stage_timings(results), errors
+    scenarios.append(_run_scenario('off_topic', 1, len(OFF_TOPIC_QUESTIONS), run_relevance))
+
+    for export_format in config.get('export_formats', []):
+        exports = []
+
+        def run_export():
+            from result_export import ExportError
+            start = time.perf_counter()
+            try:
+                _, rows = main.export_sql_query(EXPORT_SQL, export_format=export_format)
+            except ExportError:
+                return {}, 1
+            exports.append(rows.export)
+            os.remove(rows.export.path)
+            return {'export': [time.perf_counter() - start]}, 0
+        scenario = _run_scenario(f'export_{export_format}', 1, 1, run_export)
+        if exports:
+            scenario['rows'] = exports[0].row_count
+            scenario['bytes'] = exports[0].size_bytes
+            scenario['rows_per_second'] = exports[0].rows_per_second
+        scenarios.append(scenario)
+
+    return {'scenarios': scenarios, 'pipeline_stats': main.get_pipeline_stats()}
+
+
+def prepare_database(employees, data_dir, seed):
+    """
+    Return the path of a generated database of the given size, generating it only once per seed
+    """
+    from setup_database import generate_database
+    os.makedirs(data_dir, exist_ok=True)
+    db_path = os.path.join(data_dir, f'employees_{employees}_{seed}.db')
+    if not os.path.exists(db_path):
+        generate_database(employees, db_path=db_path, seed=seed)
+    return db_path
+
+
+def run_benchmark(sizes, concurrency, requests, llm_latency=0.05, llm_jitter=0.0, data_dir='benchmark_data',
+                  seed=42, with_caches=False, trace_memory=False, export_formats=('csv',)):
+    """
+    Benchmark every database size in its own subprocess against a local OpenAI stand-in
+    and return the report
+    """
+    mock = MockOpenAIServer(latency=llm_latency, jitter=llm_jitter, seed=seed).start()
+    report = {
+        'config': {
+            'sizes': sizes, 'concurrency': concurrency, 'requests': requests, 'llm_latency': llm_latency,
+            'llm_jitter': llm_jitter, 'seed': seed, 'with_caches': with_caches,
+            'export_formats': list(export_formats), 'python': sys.version.split()[0]
+        },
+        'runs': []
+    }
+    try:
+        for employees in sizes:
+            db_path = prepare_database(employees, data_dir, seed)
+            mock.reset_stats()
+            env = dict(os.environ)
+            env.update({
+                'OPENAI_API_KEY': 'sk-benchmark',
+                'OPENAI_BASE_URL': mock.base_url,
+                'DATABASE_PATH': db_path,
+                'WORKLOAD_LOG_PATH': os.path.join(data_dir, 'workload_log.db'),
+                'SQL_CACHE_PATH': os.path.join(data_dir, 'query_cache.db'),
+                'QUERY_LIBRARY_PATH': os.path.join(data_dir, 'query_library.db'),
+                'EXPORT_DIR': os.path.join(data_dir, 'exports')
+            })
+            if not with_caches:
+                env.update({'SQL_CACHE_ENABLED': '0', 'RESULT_CACHE_ENABLED': '0'})
+            worker_config = {
+                'concurrency': concurrency, 'requests': requests, 'trace_memory': trace_memory,
+                'export_formats': list(export_formats)
+            }
+            completed = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'worker', json.dumps(worker_config)],
+                env=env, capture_output=True, text=True, check=True
+            )
+            run = json.loads(completed.stdout)
+            run['employees'] = employees
+            run['llm'] = mock.stats()
+            report['runs'].append(run)
+    finally:
+        mock.stop()
+    return report
+
+
+def compare_reports(baseline, current, threshold=0.1):
+    """
+    Return a list of regressions: latency percentiles that rose or throughput that fell
+    by more than threshold (a fraction) between two reports
+    """
+    def index(report):
+        return {
+            (run['employees'], scenario['name'], scenario['concurrency']): scenario
+            for run in report['runs'] for scenario in run['scenarios']
+        }
+
+    regressions = []
+    baseline_scenarios = index(baseline)
+    for key, scenario in sorted(index(current).items()):
+        before = baseline_scenarios.get(key)
+        if before is None:
+            continue
+        label = f"{key[1]} ({key[0]} employees, concurrency {key[2]})"
+        if before['throughput'] and scenario['throughput'] < before['throughput'] * (1 - threshold):
+            regressions.append(
+                f"{label}: throughput {before['throughput']:.1f} -> {scenario['throughput']:.1f} req/s"
+            )
+        for stage, latencies in scenario['stages'].items():
+            for metric in LATENCY_METRICS:
+                old = before['stages'].get(stage, {}).get(metric)
+                new = latencies.get(metric)
+                if old and new is not None and new > old * (1 + threshold):
+                    regressions.append(f"{label}: {stage} {metric} {old:.1f} -> {new:.1f} ms")
+    return regressions
+
+
+def format_report(report):
+    lines = []
+    for run in report['runs']:
+        lines.append(f"{run['employees']} employees")
+        for scenario in run['scenarios']:
+            total = scenario['stages'].get('total') or scenario['stages'].get('execute') or {}
+            latency = (f"p50 {total['p50']:.1f} ms, p95 {total['p95']:.1f} ms, p99 {total['p99']:.1f} ms, "
+                       if total else '')
+            if 'rows_per_second' in scenario:
+                lines.append(
+                    f"  {scenario['name']:<18} {scenario['rows']} rows, {scenario['bytes'] / 1_000_000:.1f} MB in "
+                    f"{scenario['seconds']:.2f}s, {scenario['rows_per_second']:,.0f} rows/s, "
+                    f"peak RSS {scenario['peak_rss_kb'] // 1024} MB"
+                )
+                continue
+            lines.append(
+                f"  {scenario['name']:<18} c={scenario['concurrency']:<3} {latency}"
+                f"{scenario['throughput']:.1f} req/s, {scenario['errors']} errors, "
+                f"peak RSS {scenario['peak_rss_kb'] // 1024} MB"
+            )
+        for kind, stats in sorted(run['llm'].items()):
+            lines.append(f"  llm {kind}: {stats['calls']} calls, {stats['prompt_tokens']} prompt tokens, "
+                         f"{stats['completion_tokens']} completion tokens")
+    return '\n'.join(lines)
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def _str_list(value):
+    return [item for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the query pipeline against a local OpenAI stand-in")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run the benchmark and write a JSON report")
+    run_parser.add_argument('--sizes', type=_int_list, default=[10000, 100000], help="employee counts, e.g. 10000,100000")
+    run_parser.add_argument('--concurrency', type=_int_list, default=[1, 8], help="concurrency levels, e.g. 1,8,32")
+    run_parser.add_argument('--requests', type=int, default=50, help="requests per scenario")
+    run_parser.add_argument('--llm-latency', type=float, default=0.05, help="seconds the stand-in takes per call")
+    run_parser.add_argument('--llm-jitter', type=float, default=0.0, help="extra random seconds per call")
+    run_parser.add_argument('--data-dir', default='benchmark_data', help="where generated databases are kept")
+    run_parser.add_argument('--seed', type=int, default=42)
+    run_parser.add_argument('--with-caches', action='store_true', help="keep the SQL and result caches enabled")
+    run_parser.add_argument('--trace-memory', action='store_true',
+                            help="also report the peak of Python allocations (slows the run)")
+    run_parser.add_argument('--export-formats', type=_str_list, default=['csv'],
+                            help="formats to measure export throughput for, e.g. csv,parquet,arrow (empty to skip)")
+    run_parser.add_argument('-o', '--output', default='benchmark_results.json')
+
+    compare_parser = commands.add_parser('compare', help="compare two reports and list regressions")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help="allowed relative change")
+
+    worker_parser = commands.add_parser('worker')
+    worker_parser.add_argument('config')
+
+    args = parser.parse_args(argv)
+    if args.command == 'worker':
+        print(json.dumps(run_worker(json.loads(args.config)), default=str))
+    elif args.command == 'run':
+        report = run_benchmark(
+            args.sizes, args.concurrency, args.requests, llm_latency=args.llm_latency, llm_jitter=args.llm_jitter,
+            data_dir=args.data_dir, seed=args.seed, with_caches=args.with_caches, trace_memory=args.trace_memory,
+            export_formats=args.export_formats
+        )
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(format_report(report))
+        print(f"\nReport written to {args.output}")
+    else:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+        regressions = compare_reports(baseline, current, threshold=args.threshold)
+        for regression in regressions:
+            print(regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions")
+
+
+if __name__ == '__main__':
+    main()
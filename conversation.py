@@ -0,0 +1,425 @@
+import re
+import sqlite3
+from question_compiler import METRICS, NUMBER_WORDS, CompiledQuery, normalize_question
+from result_pages import PageCursor, keyset_condition
+
+# TEMP table holding the result a conversation's follow-ups refine
+RESULT_TABLE = 'session_result'
+
+_LEAD = r'(?:(?:now|and|ok|okay|then|also|but|so|just|what about|how about)\s+)*'
+_REF = r'(?:(?:the )?ones|those|them|they|these|people|employees|rows)'
+# Words that only make sense about a previous result; "employees in Finance" alone is a new question
+_MARKER = r'(?:now|then|also|so|and|but|what about|how about|just|only)'
+_BACKREF = r'(?:(?:the )?ones|those|them|these)'
+_NUMBER = r'(?P<number>\$?[\d,.]+[km]?|' + '|'.join(NUMBER_WORDS) + r')'
+_COUNT = r'(?P<count>\d+|' + '|'.join(NUMBER_WORDS) + r')'
+_COMPARISONS = {
+    'above': '>', 'over': '>', 'more than': '>', 'greater than': '>', 'higher than': '>', 'at least': '>=',
+    'below': '<', 'under': '<', 'less than': '<', 'lower than': '<', 'fewer than': '<', 'at most': '<='
+}
+_OPERATOR = '(?P<op>' + '|'.join(sorted(_COMPARISONS, key=len, reverse=True)) + ')'
+_DESCENDING = {'desc', 'descending', 'highest first', 'high to low', 'from highest', 'largest first',
+               'highest', 'biggest', 'largest', 'most', 'top'}
+
+# (template, pattern) tried in order on the normalized follow-up; a pattern whose column
+# or value is not in the result falls through to the next one
+FOLLOW_UP_PATTERNS = [(name, re.compile(f'^{_LEAD}{pattern}$')) for name, pattern in [
+    ('count', r'how many(?: of them| of those| of these| are there| are left| is that| remain)?'),
+    ('compare', rf'(?:only |show )?(?:{_REF} )?(?:with|where|whose|having) (?:an? |the |their )?'
+                rf'(?P<column>[a-z_ ]+?) (?:is |are |of )?{_OPERATOR} {_NUMBER}'),
+    ('compare', rf'(?:only |show )?(?:{_REF} )?(?:who |that )?(?P<column>earn|earning|earns|make|making|makes|paid)'
+                rf' {_OPERATOR} {_NUMBER}'),
+    ('sort', rf'(?:sort|order|rank)(?:ed)?(?: them| it| those| these| the results| the list)? by (?:the |their )?'
+             r'(?P<column>[a-z_ ]+?)(?: (?P<direction>asc|ascending|desc|descending|highest first|lowest first|'
+             r'high to low|low to high|from highest|from lowest))?'),
+    ('sort', r'(?:show )?(?:the )?(?P<direction>highest|lowest|biggest|smallest|largest|most|least) '
+             r'(?P<column>[a-z_ ]+?) first'),
+    ('page', rf'(?:show |give me |get )?(?:the )?(?P<page>next|previous|prev)(?: page| {_COUNT})?'),
+    ('page', r'(?:show )?(?P<page>more)'),
+    ('page', rf'(?:show |give me |get |list )?(?:only )?(?:the )?(?:first|top) {_COUNT}'
+             r'(?: of them| of those| rows| results| ones)?'),
+    ('exclude', rf'(?:exclude|without|except|not|remove|drop|leave out|skip)(?: the)?(?: {_REF})?'
+                r'(?: in| from| who are)? (?:the )?(?P<value>.+?)(?: department| team)?'),
+    ('filter', rf'(?:only|just)(?: show)?(?: me)?(?: the)?(?: {_REF})?(?: (?:who are|that are|which are))?'
+               r'(?: (?:in|from|at))?(?: the)? (?P<value>.+?)(?: ones| only| department| team)?'),
+    ('filter', rf'(?:(?:{_MARKER} )+(?:show )?(?:just |only )?(?:the )?(?:{_REF} )?|(?:show )?(?:the )?{_BACKREF} )'
+               r'(?:(?:who are|that are) )?(?:in|from) (?:the )?(?P<value>.+?)(?: department| team)?(?: only)?'),
+]]
+
+# Follow-ups the patterns miss but that still refer to the previous result
+FOLLOW_UP_MARKERS = re.compile(
+    r'^(?:now|and|then|also|but|only|just|what about|how about|which of|of (?:them|those|these))\b'
+    r'|\b(?:of|among|from|for|sort|order) (?:them|those|these)\b'
+)
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _parse_number(text):
+    text = text.replace('$', '').replace(',', '')
+    if text in NUMBER_WORDS:
+        return NUMBER_WORDS[text]
+    scale = {'k': 1_000, 'm': 1_000_000}.get(text[-1:], 1)
+    if scale != 1:
+        text = text[:-1]
+    try:
+        value = float(text) * scale
+    except ValueError:
+        return None
+    return int(value) if value.is_integer() else value
+
+
+class Refinement:
+    """
+    Filters, sort order and page applied on top of the session result. Pages are
+    fetched by keyset on the sort column and rowid: start holds the keys of the last
+    row before the page and history the starts of the pages before it.
+    """
+
+    def __init__(self, filters=(), order=None, limit=None, start=None, history=(), nullable=True):
+        self.filters = list(filters)
+        self.order = order
+        self.limit = limit
+        self.start = start
+        self.history = tuple(history)
+        # Whether the sort column has NULLs; see keyset_condition
+        self.nullable = nullable
+
+    def copy(self, **changes):
+        values = {'filters': self.filters, 'order': self.order, 'limit': self.limit, 'start': self.start,
+                  'history': self.history, 'nullable': self.nullable}
+        values.update(changes)
+        return Refinement(**values)
+
+    def keys(self):
+        if self.order is None:
+            return [('rowid', False)]
+        column, descending = self.order
+        return [(column, descending), ('rowid', descending)]
+
+    def where(self, paged=True):
+        terms = [sql for sql, _ in self.filters]
+        params = tuple(param for _, params in self.filters for param in params)
+        if paged and self.start is not None:
+            condition, start_params = keyset_condition(self.keys(), self.start, inclusive=False,
+                                                             nullable=self.nullable)
+            terms.append(condition)
+            params += start_params
+        return (' WHERE ' + ' AND '.join(terms) if terms else ''), params
+
+    def order_by(self):
+        if self.order is None and self.limit is None and self.start is None:
+            return ''
+        return ' ORDER BY ' + ', '.join(
+            f'{_quote(column)} {"DESC" if descending else "ASC"}' for column, descending in self.keys()
+        )
+
+    def select(self):
+        where, params = self.where()
+        sql = f'SELECT * FROM temp.{RESULT_TABLE}{where}{self.order_by()}'
+        if self.limit is not None:
+            sql += ' LIMIT ?'
+            params += (self.limit,)
+        return sql, params
+
+    def page_end(self, conn, size):
+        """
+        Return the keys of the last row of the first size rows from start, or None
+        """
+        where, params = self.where()
+        columns = ', '.join(_quote(column) for column, _ in self.keys())
+        rows = conn.execute(
+            f'SELECT {columns} FROM temp.{RESULT_TABLE}{where}{self.copy(limit=size).order_by()} LIMIT ?',
+            params + (size,)
+        ).fetchall()
+        return tuple(rows[-1]) if rows else None
+
+    def count(self):
+        where, params = self.where(paged=False)
+        return f'SELECT COUNT(*) AS row_count FROM temp.{RESULT_TABLE}{where}', params
+
+
+class ResultSession:
+    """
+    The last result of a conversation, kept in a TEMP table for follow-up questions.
+
+    The table lives on the session's own read-only connection, so it is private to the
+    conversation and dropped with it. A complete result is inserted from the rows already
+    fetched; a truncated or exported one is streamed in again from the query, up to
+    max_rows rows. A result too large for the table can still be paged: the session then
+    keeps a PageCursor on the original query and only "next page" and the like compile.
+    compile() turns follow-ups ("now only the ones in Finance", "sort them by salary",
+    "next page", "how many of them?") into SQL over the table, adding to the filters,
+    sort and page of the previous turns. A session belongs to one conversation and is
+    not meant to be shared between threads.
+    """
+
+    def __init__(self, db_path, max_rows=100_000, page_size=10):
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self.page_size = page_size
+        self.conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+        self.question = None
+        self.sql = None
+        self.params = ()
+        self.columns = []
+        self.refinement = Refinement()
+        self.pages = None
+        self.page_starts = []
+        self.stored = 0
+        self.refined = 0
+        self.too_large = 0
+
+    def has_result(self):
+        return self.question is not None
+
+    def clear(self):
+        self.conn.execute(f'DROP TABLE IF EXISTS temp.{RESULT_TABLE}')
+        self.question = None
+        self.sql = None
+        self.params = ()
+        self.columns = []
+        self.refinement = Refinement()
+        self.pages = None
+        self.page_starts = []
+
+    def _remember(self, question, sql, params):
+        self.question = question
+        self.sql = sql
+        self.params = tuple(params)
+        self.columns = [row[1] for row in self.conn.execute(f'PRAGMA temp.table_info({RESULT_TABLE})')]
+        self.refinement = Refinement()
+        self.stored += 1
+
+    def _create(self, columns):
+        self.clear()
+        names = []
+        for column in columns:
+            name, suffix = column, 2
+            while name in names:
+                name, suffix = f'{column}_{suffix}', suffix + 1
+            names.append(name)
+        self.conn.execute(f'CREATE TEMP TABLE {RESULT_TABLE} ({", ".join(_quote(name) for name in names)})')
+        return f'INSERT INTO temp.{RESULT_TABLE} VALUES ({", ".join("?" for _ in names)})'
+
+    def store_rows(self, question, sql, params, columns, rows):
+        """
+        Keep a complete result from the rows already fetched
+        """
+        self.conn.executemany(self._create(columns), rows)
+        self._remember(question, sql, params)
+        return True
+
+    def store_cursor(self, question, sql, params, columns, cursor, batch_size=10000):
+        """
+        Keep a result streamed from a cursor that ran the query, reading at most max_rows + 1
+        rows in batches; returns False, keeping no result, when there are more than max_rows
+        """
+        insert = self._create(columns)
+        count = 0
+        while count <= self.max_rows:
+            batch = cursor.fetchmany(min(batch_size, self.max_rows + 1 - count))
+            if not batch:
+                break
+            self.conn.executemany(insert, batch)
+            count += len(batch)
+        if count > self.max_rows:
+            self.clear()
+            self.too_large += 1
+            return False
+        self._remember(question, sql, params)
+        return True
+
+    def store_pages(self, question, sql, params, cursor):
+        """
+        Keep only a cursor on a result too large for the table, so it can still be paged;
+        cursor is the position after the rows already shown
+        """
+        self.clear()
+        self.question = question
+        self.sql = sql
+        self.params = tuple(params)
+        self.pages = cursor
+        return True
+
+    def column_for(self, phrase):
+        """
+        Return the result column a phrase names ("salary", "rating", "hire date"), or None
+        """
+        phrase = phrase.strip()
+        if phrase in ('earn', 'earning', 'earns', 'make', 'making', 'makes', 'paid'):
+            phrase = 'salary'
+        columns = {column.lower(): column for column in self.columns}
+        spaced = {column.replace('_', ' '): original for column, original in columns.items()}
+        if phrase in spaced:
+            return spaced[phrase]
+        for _, name, phrases in METRICS.values():
+            if phrase in phrases:
+                for column, original in columns.items():
+                    if name in column:
+                        return original
+        words = set(phrase.split()) | {word.rstrip('s') for word in phrase.split()}
+        for column, original in spaced.items():
+            if words & (set(column.split()) - {'id'}):
+                return original
+        return None
+
+    def value_column(self, value):
+        """
+        Return (column, stored value) for the first column holding the value, ignoring case
+        and a plural s, or None
+        """
+        candidates = [value] + ([value[:-1]] if value.endswith('s') else [])
+        for column in self.columns:
+            for candidate in candidates:
+                row = self.conn.execute(
+                    f'SELECT {_quote(column)} FROM temp.{RESULT_TABLE} WHERE lower({_quote(column)}) = ? LIMIT 1',
+                    (candidate,)
+                ).fetchone()
+                if row is not None:
+                    return column, row[0]
+        return None
+
+    def compile(self, question):
+        """
+        Return (CompiledQuery, Refinement) for a follow-up over the session result, or None;
+        the caller adopts the refinement once the query has run
+        """
+        if not self.has_result():
+            return None
+        text = normalize_question(question)
+        if self.pages is not None:
+            return self._compile_page(text)
+        for name, pattern in FOLLOW_UP_PATTERNS:
+            match = pattern.match(text)
+            if match is None:
+                continue
+            refinement = self._refine(name, match.groupdict())
+            if refinement is None:
+                continue
+            sql, params = refinement.count() if name == 'count' else refinement.select()
+            return CompiledQuery(name, sql, params), refinement
+        return None
+
+    def _compile_page(self, text):
+        for name, pattern in FOLLOW_UP_PATTERNS:
+            match = pattern.match(text) if name == 'page' else None
+            if match is None:
+                continue
+            page, count = match.group('page'), match.groupdict().get('count')
+            size = (int(count) if count.isdigit() else NUMBER_WORDS[count]) if count else self.page_size
+            if page in ('next', 'more'):
+                cursor = self.pages
+            elif page in ('previous', 'prev') and len(self.page_starts) > 1:
+                cursor = self.page_starts[-2]
+            else:
+                cursor = PageCursor(self.sql, self.params, size, self.pages.keys, nullable=self.pages.nullable)
+            cursor = cursor.resize(size)
+            sql, params = cursor.page_query(extra=0)
+            return CompiledQuery('page', sql, params), cursor
+        return None
+
+    def _refine(self, name, groups):
+        current = self.refinement
+        if name == 'count':
+            return current
+        if name in ('filter', 'exclude'):
+            found = self.value_column(groups['value'])
+            if found is None:
+                return None
+            column, value = found
+            operator = '=' if name == 'filter' else 'IS NOT'
+            return current.copy(filters=current.filters + [(f'{_quote(column)} {operator} ?', (value,))],
+                                limit=None, start=None, history=())
+        if name == 'compare':
+            column = self.column_for(groups['column'])
+            number = _parse_number(groups['number'])
+            if column is None or number is None:
+                return None
+            condition = f'{_quote(column)} {_COMPARISONS[groups["op"]]} ?'
+            return current.copy(filters=current.filters + [(condition, (number,))], limit=None, start=None,
+                                history=())
+        if name == 'sort':
+            column = self.column_for(groups['column'])
+            if column is None:
+                return None
+            direction = groups.get('direction')
+            descending = direction in _DESCENDING if direction else False
+            nullable = self.conn.execute(
+                f'SELECT 1 FROM temp.{RESULT_TABLE} WHERE {_quote(column)} IS NULL LIMIT 1'
+            ).fetchone() is not None
+            return current.copy(order=(column, descending), start=None, history=(), nullable=nullable)
+        if name == 'page':
+            page = groups.get('page')
+            count = groups.get('count')
+            size = (int(count) if count.isdigit() else NUMBER_WORDS[count]) if count else None
+            limit = size or current.limit or self.page_size
+            if page in ('next', 'more'):
+                # Without a page yet, the first page_size rows count as seen
+                end = current.page_end(self.conn, current.limit or self.page_size)
+                return current.copy(limit=limit, start=end if end is not None else current.start,
+                                    history=current.history + (current.start,))
+            if page in ('previous', 'prev'):
+                if not current.history:
+                    return current.copy(limit=limit, start=None)
+                return current.copy(limit=limit, start=current.history[-1], history=current.history[:-1])
+            return current.copy(limit=size, start=None, history=())
+        return None
+
+    def is_follow_up(self, question):
+        """
+        Whether a question the patterns did not compile still reads as a follow-up
+        """
+        return (self.has_result() and self.pages is None
+                and FOLLOW_UP_MARKERS.search(normalize_question(question)) is not None)
+
+    def describe(self):
+        """
+        Column list with the type of the first stored value, for the follow-up prompt
+        """
+        first = self.conn.execute(f'SELECT * FROM temp.{RESULT_TABLE} LIMIT 1').fetchone() or ()
+        types = {int: 'INTEGER', float: 'REAL', str: 'TEXT', bytes: 'BLOB'}
+        return '\n'.join(
+            f"- {column} ({types.get(type(first[index]), 'TEXT') if index < len(first) else 'TEXT'})"
+            for index, column in enumerate(self.columns)
+        )
+
+    def adopt(self, refinement, columns=None, rows=None):
+        """
+        Make a compiled follow-up the current state once it has run; a page of a paged-only
+        result needs the columns and rows it returned to find where the next page starts
+        """
+        self.refined += 1
+        if isinstance(refinement, PageCursor):
+            starts = [(start.after, start.offset) for start in self.page_starts]
+            position = (refinement.after, refinement.offset)
+            if position in starts:
+                del self.page_starts[starts.index(position) + 1:]
+            else:
+                self.page_starts.append(refinement)
+            self.pages = refinement.advance(columns, rows)
+            return
+        if refinement.order is not None and refinement.order != self.refinement.order:
+            # With the sort column indexed, a page is a seek however deep it is
+            column = refinement.order[0]
+            self.conn.execute(
+                f'CREATE INDEX IF NOT EXISTS temp.{RESULT_TABLE}_{self.columns.index(column)} '
+                f'ON {RESULT_TABLE} ({_quote(column)})'
+            )
+        self.refinement = refinement
+
+    def stats(self):
+        return {
+            'question': self.question,
+            'columns': list(self.columns),
+            'paged_only': self.pages is not None,
+            'stored': self.stored,
+            'refined': self.refined,
+            'too_large': self.too_large
+        }
+
+    def close(self):
+        self.conn.close()
+
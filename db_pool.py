@@ -0,0 +1,134 @@
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when no pooled connection becomes available in time
+    """
+
+
+class ConnectionPool:
+    """
+    Bounded pool of read-only SQLite connections shared between threads.
+
+    Connections are opened with a mode=ro URI and tuned for reads (memory-mapped
+    I/O, a larger page cache and a prepared statement cache). Idle connections
+    are reused most-recently-used first so their caches stay warm.
+    """
+
+    def __init__(self, db_path, max_connections=8, timeout=30.0, mmap_size=256 * 1024 * 1024,
+                 cache_size_kb=64 * 1024, cached_statements=256):
+        self.db_path = db_path
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.mmap_size = mmap_size
+        self.cache_size_kb = cache_size_kb
+        self.cached_statements = cached_statements
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._closed = False
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            f'file:{self.db_path}?mode=ro', uri=True,
+            check_same_thread=False, cached_statements=self.cached_statements
+        )
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = -{int(self.cache_size_kb)}')
+        conn.execute('PRAGMA query_only = ON')
+        return conn
+
+    def acquire(self):
+        """
+        Take a connection from the pool, opening a new one if the pool is not full yet
+        """
+        try:
+            conn = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+            return conn
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            can_create = self._created < self.max_connections
+            if can_create:
+                self._created += 1
+                self.misses += 1
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        # The pool is exhausted; wait for another thread to release a connection
+        start = time.perf_counter()
+        try:
+            conn = self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeoutError(
+                f"No database connection became available within {self.timeout} seconds"
+            )
+        finally:
+            with self._lock:
+                self.waits += 1
+                self.wait_seconds += time.perf_counter() - start
+        return conn
+
+    def release(self, conn):
+        """
+        Return a connection to the pool
+        """
+        if self._closed:
+            conn.close()
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """
+        Close every idle connection; connections in use are closed when released
+        """
+        self._closed = True
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+    def stats(self):
+        with self._lock:
+            acquisitions = self.hits + self.misses + self.waits
+            return {
+                'connections': self._created,
+                'idle': self._idle.qsize(),
+                'max_connections': self.max_connections,
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'hit_ratio': self.hits / acquisitions if acquisitions else 0.0,
+                'average_wait_seconds': self.wait_seconds / self.waits if self.waits else 0.0
+            }
@@ -0,0 +1,589 @@
+import argparse
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from result_cache import canonicalize_sql
+from sql_guard import strip_sql, table_aliases
+
+COLUMN_REFERENCE_PATTERN = re.compile(r'(?:\b([A-Za-z_]\w*)\.)?\b([A-Za-z_]\w*)\b')
+COMPARISON_PATTERN = re.compile(
+    r'(?:\b([A-Za-z_]\w*)\.)?\b([A-Za-z_]\w*)\s*(==|=|<=|>=|<|>|\bbetween\b|\bin\b|\blike\b|\bglob\b)'
+    r'\s*(?:([A-Za-z_]\w*)\.([A-Za-z_]\w*)\b)?',
+    re.IGNORECASE
+)
+ORDER_BY_PATTERN = re.compile(r'\b(?:order|group)\s+by\s+(.*?)(?=\blimit\b|\bhaving\b|\bwindow\b|\)|$)',
+                              re.IGNORECASE | re.DOTALL)
+EQUALITY_OPERATORS = {'=', '==', 'in'}
+
+
+def load_schema(conn):
+    """
+    Return {table: (columns, primary_key_columns)} for every table in the database
+    """
+    schema = {}
+    tables = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'"
+    ).fetchall()
+    for (table,) in tables:
+        info = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+        columns = [row[1].lower() for row in info]
+        primary_key = {row[1].lower() for row in info if row[5]}
+        schema[table.lower()] = (columns, primary_key)
+    return schema
+
+
+def _resolve(qualifier, column, aliases, schema):
+    """
+    Return (reference, table) for a column reference, where reference is the
+    alias it was qualified with, or None if it is not a column of the query's tables
+    """
+    column = column.lower()
+    if qualifier:
+        table = aliases.get(qualifier.lower())
+        return (qualifier.lower(), table) if table in schema and column in schema[table][0] else None
+    owners = {table for table in aliases.values() if table in schema and column in schema[table][0]}
+    if len(owners) != 1:
+        return None
+    table = owners.pop()
+    return table, table
+
+
+def extract_predicates(sql, schema):
+    """
+    Find the columns a statement filters, joins, sorts and reads on, per table reference
+    so the two sides of a self-join are kept apart.
+    Returns {reference: {'table': ..., 'eq': [...], 'range': [...], 'join': [...], 'order': [...],
+    'referenced': [...]}} with columns listed in the order they first appear.
+    """
+    structure = strip_sql(sql)
+    aliases = table_aliases(sql)
+    usage = {}
+
+    def add(resolved, kind, column):
+        reference, table = resolved
+        columns = usage.setdefault(reference, {
+            'table': table, 'eq': [], 'range': [], 'join': [], 'order': [], 'referenced': []
+        })[kind]
+        if column not in columns:
+            columns.append(column)
+
+    for left_qualifier, left, operator, right_qualifier, right in COMPARISON_PATTERN.findall(structure):
+        resolved = _resolve(left_qualifier, left, aliases, schema)
+        if resolved is None:
+            continue
+        other = _resolve(right_qualifier, right, aliases, schema) if right else None
+        equality = operator.lower() in EQUALITY_OPERATORS
+        if other is not None and equality:
+            add(resolved, 'join', left.lower())
+            add(other, 'join', right.lower())
+        else:
+            add(resolved, 'eq' if equality else 'range', left.lower())
+
+    for clause in ORDER_BY_PATTERN.findall(structure):
+        for qualifier, column in COLUMN_REFERENCE_PATTERN.findall(clause):
+            resolved = _resolve(qualifier, column, aliases, schema)
+            if resolved is not None:
+                add(resolved, 'order', column.lower())
+
+    for qualifier, column in COLUMN_REFERENCE_PATTERN.findall(structure):
+        resolved = _resolve(qualifier, column, aliases, schema)
+        if resolved is not None:
+            add(resolved, 'referenced', column.lower())
+    return usage
+
+
+def candidate_indexes(usage, schema, max_columns=4):
+    """
+    Build candidate indexes for one statement: equality and join columns first,
+    then a range or sort column, and a covering variant that adds the other
+    columns the statement reads when they fit in max_columns
+    """
+    candidates = set()
+    for kinds in usage.values():
+        table = kinds['table']
+        primary_key = schema[table][1]
+        key = [column for column in kinds['eq'] + kinds['join'] if column not in primary_key]
+        key = list(dict.fromkeys(key))
+        trailing = [column for column in kinds['range'] + kinds['order']
+                    if column not in key and column not in primary_key]
+        if trailing:
+            key.append(trailing[0])
+        if not key or len(key) > max_columns:
+            continue
+        candidates.add((table, tuple(key)))
+        covering = key + [column for column in kinds['referenced']
+                          if column not in key and column not in primary_key]
+        if len(covering) > len(key) and len(covering) <= max_columns:
+            candidates.add((table, tuple(covering)))
+    return candidates
+
+
+def index_name(table, columns):
+    return 'idx_' + '_'.join((table,) + tuple(columns))
+
+
+def create_index_sql(table, columns):
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    return f'CREATE INDEX IF NOT EXISTS "{index_name(table, columns)}" ON "{table}" ({column_list})'
+
+
+# A loop of a query plan: "SCAN e", "SEARCH m USING INDEX idx (manager_id=?)"
+PLAN_LOOP_PATTERN = re.compile(
+    r'^(SCAN|SEARCH) (\w+)(?: USING (?:(COVERING )?INDEX (\w+)|(?:INTEGER )?PRIMARY KEY))?(?: \((.*)\))?'
+)
+PLAN_CONSTRAINT_PATTERN = re.compile(r'(\w+)(=|>|<)')
+
+# Rows the planner assumes an equality match on an index without statistics returns,
+# and the factor a range or an unindexed filter term cuts the rows down by
+DEFAULT_EQ_ROWS = 10
+DEFAULT_FILTER_FACTOR = 4
+
+
+def load_statistics(conn):
+    """
+    Return ({table: rows}, {index: [rows, rows per key prefix, ...]}) from sqlite_stat1,
+    or two empty dicts if the database has not been analyzed
+    """
+    table_rows, index_stats = {}, {}
+    try:
+        rows = conn.execute('SELECT tbl, idx, stat FROM sqlite_stat1').fetchall()
+    except sqlite3.OperationalError:
+        return table_rows, index_stats
+    for table, index, stat in rows:
+        numbers = [int(value) for value in stat.split() if value.isdigit()]
+        if not numbers:
+            continue
+        table_rows[table.lower()] = numbers[0]
+        if index:
+            index_stats[index.lower()] = numbers
+    return table_rows, index_stats
+
+
+def estimate_plan_cost(plan, sql, usage, table_rows, index_stats):
+    """
+    Estimate the rows a statement visits from its EXPLAIN QUERY PLAN rows (id, parent, detail).
+
+    Loops under the same parent are nested: each one runs once per row of the loops before
+    it. A scan reads the whole table, a search costs a b-tree descent plus the matching rows
+    (twice over when the index does not cover the statement), and a temporary b-tree sorts
+    the rows produced so far. Without statistics the planner's own defaults are used.
+    """
+    aliases = table_aliases(sql)
+    outer_rows, cost = {}, 0.0
+    for _, parent, detail in plan:
+        outer = outer_rows.get(parent, 1.0)
+        if detail.startswith('USE TEMP B-TREE'):
+            cost += outer * math.log2(outer + 1)
+            continue
+        match = PLAN_LOOP_PATTERN.match(detail)
+        if match is None:
+            continue
+        operation, reference, covering, index, constraints = match.groups()
+        table = aliases.get(reference.lower())
+        if table not in table_rows:
+            # A CTE or subquery, whose cost is counted where it is built
+            continue
+        rows = table_rows[table]
+        used = PLAN_CONSTRAINT_PATTERN.findall(constraints or '')
+        if operation == 'SCAN':
+            # A covering index is narrower than the table rows it stands in for
+            cost += outer * rows / (2 if covering else 1)
+            matched = rows
+        else:
+            equalities = sum(1 for _, operator in used if operator == '=')
+            if index is None:
+                matched = 1 if equalities else rows / DEFAULT_FILTER_FACTOR
+            elif equalities and index.lower() in index_stats and equalities < len(index_stats[index.lower()]):
+                matched = index_stats[index.lower()][equalities]
+            else:
+                matched = min(rows, DEFAULT_EQ_ROWS) if equalities else rows
+            if len(used) > equalities:
+                matched /= DEFAULT_FILTER_FACTOR
+            lookups = 1 if index is None or covering else 2
+            cost += outer * (math.log2(rows + 1) + matched * lookups)
+        # Filter terms the loop does not use still cut down the rows it passes on
+        kinds = usage.get(reference.lower(), {})
+        filtered = set(kinds.get('eq', []) + kinds.get('range', [])) - {column.lower() for column, _ in used}
+        matched = max(1.0, matched / DEFAULT_FILTER_FACTOR ** len(filtered))
+        outer_rows[parent] = outer * matched
+    return round(cost)
+
+
+def _add_execution(entry, ms, now):
+    entry['executions'] += 1
+    entry['total_ms'] += ms
+    entry['max_ms'] = max(entry['max_ms'], ms)
+    entry['last_seen_at'] = now
+
+
+class WorkloadLog:
+    """
+    Persistent log of executed SQL, stored in SQLite.
+
+    Statements are aggregated on their canonical text with an execution count,
+    latency totals and the query plan captured the first time they ran. The
+    least recently seen statements are dropped beyond max_statements.
+
+    record() only adds to an in-memory buffer, so logging costs the query no disk
+    write; a background thread writes the buffer out every flush_seconds, or as
+    soon as batch_size distinct statements are waiting. Reads flush it first.
+    """
+
+    def __init__(self, log_path, max_statements=1000, flush_seconds=1.0, batch_size=100):
+        self.log_path = log_path
+        self.max_statements = max_statements
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._known = set()
+        self._pending = {}
+        self._wake = threading.Event()
+        self._closed = False
+        self._conn = sqlite3.connect(log_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS workload (
+            sql_key TEXT PRIMARY KEY,
+            sql TEXT NOT NULL,
+            plan TEXT NOT NULL,
+            executions INTEGER NOT NULL,
+            total_ms REAL NOT NULL,
+            max_ms REAL NOT NULL,
+            last_seen_at REAL NOT NULL
+        )
+        ''')
+        self._conn.commit()
+        self._known.update(key for (key,) in self._conn.execute('SELECT sql_key FROM workload'))
+        self._flusher = threading.Thread(target=self._flush_loop, name='workload-log', daemon=True)
+        self._flusher.start()
+
+    def record(self, sql, seconds, conn):
+        """
+        Record one execution of a statement; conn is used to capture the plan of statements not seen before
+        """
+        key = canonicalize_sql(sql)
+        ms = seconds * 1000
+        now = time.time()
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is not None:
+                _add_execution(entry, ms, now)
+                return
+            known = key in self._known
+        plan = None if known else '\n'.join(row[3] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}'))
+        with self._lock:
+            entry = self._pending.get(key)
+            if entry is None:
+                self._pending[key] = {'sql': sql, 'plan': plan, 'executions': 1, 'total_ms': ms,
+                                      'max_ms': ms, 'last_seen_at': now}
+            else:
+                # Another thread buffered the statement while the plan was captured
+                _add_execution(entry, ms, now)
+            self._known.add(key)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            try:
+                self.flush()
+            except sqlite3.Error:
+                # The buffer is lost rather than the thread; the log is advisory
+                pass
+
+    def flush(self):
+        """
+        Write the buffered executions to the log in one transaction
+        """
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return
+            self._conn.executemany(
+                'INSERT INTO workload (sql_key, sql, plan, executions, total_ms, max_ms, last_seen_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (sql_key) DO UPDATE SET '
+                'executions = executions + excluded.executions, total_ms = total_ms + excluded.total_ms, '
+                'max_ms = MAX(max_ms, excluded.max_ms), last_seen_at = excluded.last_seen_at',
+                [(key, entry['sql'], entry['plan'] or '', entry['executions'], entry['total_ms'],
+                  entry['max_ms'], entry['last_seen_at']) for key, entry in pending.items()]
+            )
+            trimmed = self._conn.execute('''
+            DELETE FROM workload WHERE sql_key IN (
+                SELECT sql_key FROM workload ORDER BY last_seen_at DESC LIMIT -1 OFFSET ?
+            )
+            ''', (self.max_statements,)).rowcount
+            self._conn.commit()
+            if trimmed:
+                # Dropped statements need their plan captured again when they come back
+                kept = {key for (key,) in self._conn.execute('SELECT sql_key FROM workload')}
+                with self._lock:
+                    self._known = kept | set(self._pending)
+
+    def close(self):
+        """
+        Stop the background thread and write out whatever is still buffered
+        """
+        self._closed = True
+        self._wake.set()
+        self._flusher.join()
+        self.flush()
+
+    def statements(self):
+        """
+        Return the logged statements, most executed first
+        """
+        self.flush()
+        with self._write_lock:
+            rows = self._conn.execute(
+                'SELECT sql, plan, executions, total_ms, max_ms FROM workload ORDER BY executions DESC'
+            ).fetchall()
+        return [
+            {'sql': sql, 'plan': plan.split('\n'), 'executions': executions,
+             'avg_ms': total_ms / executions, 'max_ms': max_ms}
+            for sql, plan, executions, total_ms, max_ms in rows
+        ]
+
+    def clear(self):
+        with self._write_lock:
+            with self._lock:
+                self._pending.clear()
+                self._known.clear()
+            self._conn.execute('DELETE FROM workload')
+            self._conn.commit()
+
+    def stats(self):
+        self.flush()
+        with self._write_lock:
+            statements, executions = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(executions), 0) FROM workload'
+            ).fetchone()
+        return {'statements': statements, 'executions': executions}
+
+
+class IndexAdvisor:
+    """
+    Recommends indexes for a logged workload.
+
+    Candidate indexes are derived from the predicates and join keys of the logged
+    statements and evaluated with EXPLAIN QUERY PLAN on an empty in-memory copy of
+    the schema that carries the database's sqlite_stat1, so the planner makes the
+    same choices it would on the real data without any rows being copied or read.
+    Each plan is costed from the table sizes and index statistics. Indexes are
+    chosen greedily by the largest estimated saving weighted by execution count,
+    and each recommendation carries the before/after plans and costs.
+    """
+
+    def __init__(self, db_path, max_columns=4, min_improvement=0.1):
+        self.db_path = db_path
+        self.max_columns = max_columns
+        self.min_improvement = min_improvement
+
+    def _schema_copy(self):
+        """
+        Return (conn, table_rows, index_stats) for an in-memory database with the source's
+        tables, indexes and views but no rows, and the source's planner statistics
+        """
+        source = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+        copy = sqlite3.connect(':memory:')
+        try:
+            definitions = source.execute(
+                "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' "
+                "AND type IN ('table', 'index', 'view') "
+                "ORDER BY CASE type WHEN 'table' THEN 0 WHEN 'index' THEN 1 ELSE 2 END, rowid"
+            ).fetchall()
+            for (sql,) in definitions:
+                copy.execute(sql)
+            table_rows, index_stats = load_statistics(source)
+            try:
+                stat_rows = source.execute('SELECT tbl, idx, stat FROM sqlite_stat1').fetchall()
+            except sqlite3.OperationalError:
+                stat_rows = []
+            for table in load_schema(copy):
+                if table not in table_rows:
+                    # Tables missing from the statistics are sized by their largest rowid, an O(log n) lookup
+                    try:
+                        table_rows[table] = source.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+                    except sqlite3.Error:
+                        pass
+        finally:
+            source.close()
+        if stat_rows:
+            # ANALYZE of the empty copy creates sqlite_stat1; the source's rows replace its
+            # own and ANALYZE sqlite_master makes the planner load them
+            copy.execute('ANALYZE')
+            copy.execute('DELETE FROM sqlite_stat1')
+            copy.executemany('INSERT INTO sqlite_stat1 (tbl, idx, stat) VALUES (?, ?, ?)', stat_rows)
+            copy.commit()
+            copy.execute('ANALYZE sqlite_master')
+        return copy, table_rows, index_stats
+
+    def _explain(self, conn, entry, table_rows, index_stats):
+        plan = [(row[0], row[1], row[3]) for row in conn.execute(f"EXPLAIN QUERY PLAN {entry['sql']}")]
+        return {'plan': [detail for _, _, detail in plan],
+                'cost': estimate_plan_cost(plan, entry['sql'], entry['usage'], table_rows, index_stats)}
+
+    def predicate_counts(self, statements):
+        """
+        Count how often each (table, column, usage) appears, weighted by executions
+        """
+        conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+        try:
+            schema = load_schema(conn)
+        finally:
+            conn.close()
+        counts = Counter()
+        for statement in statements:
+            for kinds in extract_predicates(statement['sql'], schema).values():
+                table = kinds['table']
+                for kind in ('eq', 'range', 'join', 'order'):
+                    for column in kinds[kind]:
+                        counts[(table, column, kind)] += statement['executions']
+        return counts
+
+    def recommend(self, statements):
+        """
+        Return the recommended indexes for the statements, best first
+        """
+        conn, table_rows, index_stats = self._schema_copy()
+        try:
+            schema = load_schema(conn)
+            workload = []
+            candidates = set()
+            for statement in statements:
+                usage = extract_predicates(statement['sql'], schema)
+                if not usage:
+                    continue
+                entry = {'sql': statement['sql'], 'executions': statement['executions'], 'usage': usage,
+                         'tables': {kinds['table'] for kinds in usage.values()}}
+                try:
+                    entry['current'] = self._explain(conn, entry, table_rows, index_stats)
+                except sqlite3.Error:
+                    # The statement no longer runs against this schema
+                    continue
+                workload.append(entry)
+                candidates |= candidate_indexes(usage, schema, self.max_columns)
+
+            recommendations = []
+            while candidates:
+                best = None
+                for table, columns in sorted(candidates):
+                    result = self._evaluate(conn, table, columns, workload, table_rows, index_stats)
+                    if result is not None and (best is None or result['saving'] > best['saving']):
+                        best = result
+                if best is None:
+                    break
+                candidates.discard((best['table'], best['columns']))
+                recommendations.append(self._describe(best))
+                # Keep the chosen index so later candidates are measured on top of it
+                conn.execute(best['sql'])
+                for entry, after in best['measured']:
+                    entry['current'] = after
+            return recommendations
+        finally:
+            conn.close()
+
+    def _evaluate(self, conn, table, columns, workload, table_rows, index_stats):
+        affected = [entry for entry in workload if table in entry['tables']]
+        if not affected:
+            return None
+        sql = create_index_sql(table, columns)
+        conn.execute(sql)
+        try:
+            measured = [(entry, self._explain(conn, entry, table_rows, index_stats)) for entry in affected]
+        finally:
+            conn.execute(f'DROP INDEX "{index_name(table, columns)}"')
+        cost_before = sum(entry['executions'] * entry['current']['cost'] for entry in affected)
+        cost_after = sum(entry['executions'] * after['cost'] for entry, after in measured)
+        saving = cost_before - cost_after
+        if cost_before == 0 or saving / cost_before < self.min_improvement:
+            return None
+        return {'table': table, 'columns': columns, 'sql': sql, 'saving': saving,
+                'cost_before': cost_before, 'cost_after': cost_after, 'measured': measured}
+
+    def _describe(self, evaluation):
+        return {
+            'table': evaluation['table'],
+            'columns': list(evaluation['columns']),
+            'sql': evaluation['sql'],
+            'cost_before': evaluation['cost_before'],
+            'cost_after': evaluation['cost_after'],
+            'statements': [
+                {
+                    'sql': entry['sql'],
+                    'executions': entry['executions'],
+                    'plan_before': entry['current']['plan'],
+                    'plan_after': after['plan'],
+                    'cost_before': entry['current']['cost'],
+                    'cost_after': after['cost']
+                }
+                for entry, after in evaluation['measured']
+                if after['plan'] != entry['current']['plan']
+            ]
+        }
+
+    def apply(self, recommendations):
+        """
+        Create the recommended indexes in the database. ANALYZE is not run, so the
+        planner sees the same statistics the indexes were measured with.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for recommendation in recommendations:
+                conn.execute(recommendation['sql'])
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def format_recommendation(recommendation):
+    lines = [
+        f"{recommendation['sql']};",
+        f"  estimated cost {recommendation['cost_before']} -> {recommendation['cost_after']} rows visited"
+    ]
+    for statement in recommendation['statements']:
+        lines.append(f"  {' '.join(statement['sql'].split())}  (x{statement['executions']})")
+        lines.append(f"    before: {' / '.join(statement['plan_before'])}  [~{statement['cost_before']} rows]")
+        lines.append(f"    after:  {' / '.join(statement['plan_after'])}  [~{statement['cost_after']} rows]")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommend indexes for the SQL logged by the pipeline")
+    parser.add_argument('--db', default=os.getenv('DATABASE_PATH', 'employees.db'), help="database to index")
+    parser.add_argument('--log', default=os.getenv('WORKLOAD_LOG_PATH', 'workload_log.db'),
+                        help="workload log written by the pipeline")
+    parser.add_argument('--max-columns', type=int, default=4, help="widest index to consider")
+    parser.add_argument('--min-improvement', type=float, default=0.1,
+                        help="smallest relative saving worth an index")
+    parser.add_argument('--apply', action='store_true', help="create the recommended indexes")
+    args = parser.parse_args(argv)
+
+    statements = WorkloadLog(args.log).statements()
+    advisor = IndexAdvisor(args.db, max_columns=args.max_columns, min_improvement=args.min_improvement)
+    print(f"{len(statements)} logged statements")
+    for (table, column, kind), count in advisor.predicate_counts(statements).most_common():
+        print(f"  {table}.{column} ({kind}): {count}")
+
+    recommendations = advisor.recommend(statements)
+    if not recommendations:
+        print("No index would improve the logged workload")
+        return
+    for recommendation in recommendations:
+        print()
+        print(format_recommendation(recommendation))
+    if args.apply:
+        advisor.apply(recommendations)
+        print(f"\nCreated {len(recommendations)} indexes in {args.db}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from openai.types.chat import ChatCompletion
+
+CASSETTE_MODES = ('off', 'replay', 'record', 'rerecord')
+
+
+class CassetteMiss(Exception):
+    """
+    Raised in replay mode when a request has no recorded response, or only one recorded
+    for a different request
+    """
+    pass
+
+
+def _last_user_message(kwargs):
+    for message in reversed(kwargs.get('messages', [])):
+        if message.get('role') == 'user':
+            return message.get('content') or ''
+    return ''
+
+
+def entry_key(stage, kwargs):
+    """
+    Name an entry after the stage and the question, so a changed prompt finds its old entry
+    """
+    digest = hashlib.sha256(f'{stage}\n{_last_user_message(kwargs)}'.encode('utf-8')).hexdigest()
+    return f'{stage}-{digest[:16]}'
+
+
+def request_hash(kwargs):
+    """
+    Hash the whole request: model, messages and sampling parameters
+    """
+    return hashlib.sha256(json.dumps(kwargs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class Cassette:
+    """
+    Records chat completion responses to JSON files and replays them.
+
+    Each entry is one file in directory, named after the stage and the last user
+    message and holding the hash of the full request it answered. When the
+    prompt changes the entry becomes stale: replay mode treats it as missing,
+    record mode still replays it and rerecord mode calls the API again and
+    overwrites it. A request with no entry raises CassetteMiss in replay mode
+    and is recorded otherwise. Files are
+    written atomically, so parallel test workers can share a directory.
+    """
+
+    def __init__(self, directory, mode='replay'):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"Unknown cassette mode {mode!r}, expected one of {', '.join(CASSETTE_MODES)}")
+        self.directory = directory
+        self.mode = mode
+        self._lock = threading.Lock()
+        self.replayed = 0
+        self.stale = 0
+        self.recorded = 0
+
+    def _path(self, stage, kwargs):
+        return os.path.join(self.directory, entry_key(stage, kwargs) + '.json')
+
+    def replay(self, stage, kwargs):
+        """
+        Return the recorded ChatCompletion for the request, or None when it should be recorded
+        """
+        path = self._path(stage, kwargs)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            entry = None
+        if entry is None:
+            if self.mode == 'replay':
+                raise CassetteMiss(
+                    f"No recorded {stage} response for {_last_user_message(kwargs)!r} in {self.directory}; "
+                    f"run with LLM_CASSETTE_MODE=record to record it"
+                )
+            return None
+        stale = entry['request_hash'] != request_hash(kwargs)
+        if stale and self.mode == 'replay':
+            # The prompt or examples changed, so the recording no longer answers this request
+            with self._lock:
+                self.stale += 1
+            raise CassetteMiss(
+                f"The recorded {stage} response for {_last_user_message(kwargs)!r} in {self.directory} "
+                f"answers a different request; run with LLM_CASSETTE_MODE=rerecord to refresh it"
+            )
+        if stale and self.mode == 'rerecord':
+            return None
+        with self._lock:
+            self.replayed += 1
+            self.stale += int(stale)
+        return ChatCompletion.model_validate(entry['response'])
+
+    def record(self, stage, kwargs, response):
+        """
+        Store the response to a request, replacing any older entry for it
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {
+            'stage': stage,
+            'question': _last_user_message(kwargs),
+            'request_hash': request_hash(kwargs),
+            'request': kwargs,
+            'response': response.model_dump(mode='json')
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, indent=2, sort_keys=True, default=str)
+            f.write('\n')
+        os.replace(tmp_path, self._path(stage, kwargs))
+        with self._lock:
+            self.recorded += 1
+
+    def stats(self):
+        with self._lock:
+            return {'mode': self.mode, 'replayed': self.replayed, 'stale': self.stale, 'recorded': self.recorded}
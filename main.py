@@ -1,7 +1,35 @@
+import atexit
 import os
+import secrets
 import sqlite3
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
+from openai.types.chat import ChatCompletion
 from dotenv import load_dotenv
+from db_pool import ConnectionPool
+from query_cache import QueryCache
+from result_cache import ResultCache
+from result_fetch import fetch_rows, ResultRows
+from result_export import EXPORT_FORMATS, export_request, export_rows, prune_exports
+from result_pages import PageCursor, ResultPage, cursor_after
+from result_serializer import serialize_results
+from sql_guard import SQLGuard, SQLGuardError
+from index_advisor import WorkloadLog
+from response_templates import render_response
+from relevance_classifier import RelevanceClassifier
+from prompt_builder import SchemaPromptBuilder
+from question_compiler import QuestionCompiler, render_sql
+from conversation import RESULT_TABLE, ResultSession
+from query_library import QueryLibrary
+from llm_cassette import Cassette
+from metrics import MetricsRegistry
+from tracing import (
+    TraceLog, request_trace, trace_stage, set_trace_attribute, record_cache_lookup, record_llm_call,
+    run_in_trace_context, iterate_in_context
+)
 
 # Load environment variables
 load_dotenv()
@@ -9,11 +37,345 @@ load_dotenv()
 # Initialize OpenAI client
 client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
 
-def check_query_relevance(user_input):
+# Database settings
+DATABASE_PATH = os.getenv('DATABASE_PATH', 'employees.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '8'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+
+# Row and byte budget for fetching query results
+RESULT_MAX_ROWS = int(os.getenv('RESULT_MAX_ROWS', '1000'))
+RESULT_MAX_BYTES = int(os.getenv('RESULT_MAX_BYTES', '1000000'))
+RESULT_BATCH_SIZE = int(os.getenv('RESULT_BATCH_SIZE', '200'))
+RESULT_COUNT_TOTAL = os.getenv('RESULT_COUNT_TOTAL', '1') == '1'
+
+# Pages of a result past the rows already returned, fetched by keyset on the query's
+# ORDER BY columns; cursors are signed with PAGE_CURSOR_SECRET (random per process if unset)
+RESULT_PAGE_SIZE = int(os.getenv('RESULT_PAGE_SIZE', '50'))
+PAGE_CURSOR_SECRET = os.getenv('PAGE_CURSOR_SECRET') or secrets.token_hex(32)
+
+# Stream large and listing-style results to a file instead of the response prompt;
+# listing-style results up to EXPORT_MIN_ROWS rows are answered as usual
+EXPORT_ENABLED = os.getenv('EXPORT_ENABLED', '1') == '1'
+EXPORT_DIR = os.getenv('EXPORT_DIR', 'exports')
+EXPORT_FORMAT = os.getenv('EXPORT_FORMAT', 'csv')
+EXPORT_MIN_ROWS = int(os.getenv('EXPORT_MIN_ROWS', str(RESULT_MAX_ROWS)))
+EXPORT_PREVIEW_ROWS = int(os.getenv('EXPORT_PREVIEW_ROWS', '5'))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '10000'))
+EXPORT_TIMEOUT_SECONDS = float(os.getenv('EXPORT_TIMEOUT_SECONDS', '600'))
+EXPORT_MAX_VM_STEPS = int(os.getenv('EXPORT_MAX_VM_STEPS', '10000000000'))
+EXPORT_RETENTION_SECONDS = int(os.getenv('EXPORT_RETENTION_SECONDS', str(24 * 3600)))
+EXPORT_MAX_FILES = int(os.getenv('EXPORT_MAX_FILES', '100'))
+
+# Keep each conversation's last result in a TEMP table and answer follow-up questions
+# ("now only the ones in Finance", "sort them by salary", "next page") over it
+CONVERSATION_ENABLED = os.getenv('CONVERSATION_ENABLED', '1') == '1'
+CONVERSATION_MAX_ROWS = int(os.getenv('CONVERSATION_MAX_ROWS', '100000'))
+CONVERSATION_PAGE_SIZE = int(os.getenv('CONVERSATION_PAGE_SIZE', '10'))
+
+# Pre-flight checks and execution budget for generated SQL
+SQL_GUARD_ENABLED = os.getenv('SQL_GUARD_ENABLED', '1') == '1'
+SQL_GUARD_MAX_SCAN_ROWS = int(os.getenv('SQL_GUARD_MAX_SCAN_ROWS', '100000'))
+SQL_GUARD_MAX_JOIN_ROWS = int(os.getenv('SQL_GUARD_MAX_JOIN_ROWS', '10000000'))
+SQL_GUARD_TIMEOUT_SECONDS = float(os.getenv('SQL_GUARD_TIMEOUT_SECONDS', '10'))
+SQL_GUARD_MAX_VM_STEPS = int(os.getenv('SQL_GUARD_MAX_VM_STEPS', '50000000'))
+
+# Log of executed SQL with plans and latency, read by index_advisor.py
+WORKLOAD_LOG_ENABLED = os.getenv('WORKLOAD_LOG_ENABLED', '1') == '1'
+WORKLOAD_LOG_PATH = os.getenv('WORKLOAD_LOG_PATH', 'workload_log.db')
+WORKLOAD_LOG_MAX_STATEMENTS = int(os.getenv('WORKLOAD_LOG_MAX_STATEMENTS', '1000'))
+WORKLOAD_LOG_FLUSH_SECONDS = float(os.getenv('WORKLOAD_LOG_FLUSH_SECONDS', '1'))
+WORKLOAD_LOG_BATCH_SIZE = int(os.getenv('WORKLOAD_LOG_BATCH_SIZE', '100'))
+
+# In-memory cache of query results, invalidated by PRAGMA data_version
+RESULT_CACHE_ENABLED = os.getenv('RESULT_CACHE_ENABLED', '1') == '1'
+RESULT_CACHE_MAX_BYTES = int(os.getenv('RESULT_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Token budget for the query results sent to generate_response
+RESPONSE_TOKEN_BUDGET = int(os.getenv('RESPONSE_TOKEN_BUDGET', '1500'))
+
+# Print the REPL's answer as it is generated: the SQL, then the row count, then the response
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+
+# Answer empty, scalar, single-row and small results from a template instead of GPT-3.5
+TEMPLATED_RESPONSES = os.getenv('TEMPLATED_RESPONSES', '1') == '1'
+TEMPLATE_MAX_ROWS = int(os.getenv('TEMPLATE_MAX_ROWS', '10'))
+TEMPLATE_MAX_COLUMNS = int(os.getenv('TEMPLATE_MAX_COLUMNS', '4'))
+
+# Question -> SQL cache settings
+SQL_CACHE_ENABLED = os.getenv('SQL_CACHE_ENABLED', '1') == '1'
+SQL_CACHE_PATH = os.getenv('SQL_CACHE_PATH', 'query_cache.db')
+SQL_CACHE_MAX_ENTRIES = int(os.getenv('SQL_CACHE_MAX_ENTRIES', '1000'))
+SQL_CACHE_TTL_SECONDS = int(os.getenv('SQL_CACHE_TTL_SECONDS', str(7 * 24 * 3600)))
+
+# Run the relevance check and SQL generation concurrently, trading the tokens
+# of a discarded SQL generation on unrelated questions for lower latency
+SPECULATIVE_EXECUTION = os.getenv('SPECULATIVE_EXECUTION', '0') == '1'
+
+# Compile common question shapes straight to SQL, skipping the relevance check and GPT-3.5
+LOCAL_SQL_ENABLED = os.getenv('LOCAL_SQL_ENABLED', '1') == '1'
+
+# Record/replay of LLM responses: off, replay (never call the API), record (call it
+# for requests with no recorded response) or rerecord (also for stale ones)
+LLM_CASSETTE_MODE = os.getenv('LLM_CASSETTE_MODE', 'off')
+LLM_CASSETTE_DIR = os.getenv('LLM_CASSETTE_DIR', 'cassettes')
+
+# Library of verified question/SQL pairs: exact matches skip GPT-3.5, and the
+# nearest pairs are sent as few-shot examples with a shorter prompt
+QUERY_LIBRARY_ENABLED = os.getenv('QUERY_LIBRARY_ENABLED', '1') == '1'
+QUERY_LIBRARY_PATH = os.getenv('QUERY_LIBRARY_PATH', 'query_library.db')
+QUERY_LIBRARY_EXAMPLES = int(os.getenv('QUERY_LIBRARY_EXAMPLES', '3'))
+QUERY_LIBRARY_MIN_SIMILARITY = float(os.getenv('QUERY_LIBRARY_MIN_SIMILARITY', '0.4'))
+
+# Build SQL generation prompts from the introspected schema, listing only the
+# tables, columns and rules a question needs instead of SQL_SYSTEM_PROMPT
+PRUNED_SQL_PROMPT = os.getenv('PRUNED_SQL_PROMPT', '1') == '1'
+SQL_PROMPT_RULES_TOKEN_BUDGET = int(os.getenv('SQL_PROMPT_RULES_TOKEN_BUDGET', '200'))
+
+# Per-request traces feeding the metrics registry, optionally written as JSON lines
+TRACING_ENABLED = os.getenv('TRACING_ENABLED', '1') == '1'
+TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH', '')
+
+# Local relevance classifier; the LLM is only asked when its score is ambiguous
+LOCAL_RELEVANCE_ENABLED = os.getenv('LOCAL_RELEVANCE_ENABLED', '1') == '1'
+LOCAL_RELEVANCE_THRESHOLD = float(os.getenv('LOCAL_RELEVANCE_THRESHOLD', '0.4'))
+
+_connection_pool = None
+_pool_lock = threading.Lock()
+_query_cache = None
+_result_cache = None
+_sql_guard = None
+_workload_log = None
+_relevance_classifier = None
+_trace_log = None
+_prompt_builder = None
+_question_compiler = None
+_query_library = None
+_cassette = None
+metrics_registry = MetricsRegistry()
+_speculative_executor = None
+_speculative_lock = threading.Lock()
+_speculative_stats = {'runs': 0, 'discarded_sql': 0}
+_serialization_lock = threading.Lock()
+_serialization_stats = {'responses': 0, 'summarized': 0, 'prompt_tokens': 0, 'prompt_tokens_saved': 0}
+_response_source_stats = {'template': 0, 'llm': 0}
+_export_lock = threading.Lock()
+_export_stats = {'exports': 0, 'answered_inline': 0, 'pruned': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0}
+_page_lock = threading.Lock()
+_page_stats = {'pages': 0, 'keyset': 0, 'offset': 0, 'rows': 0}
+_conversation_lock = threading.Lock()
+_conversation_stats = {
+    'full_pipeline': 0, 'local_followups': 0, 'llm_followups': 0, 'stored': 0, 'paged_only': 0, 'not_stored': 0
+}
+
+def get_connection_pool():
     """
-    Check if the user input is relevant to the employee database using GPT-3.5
+    Return the shared read-only connection pool, creating it on first use
+    """
+    global _connection_pool
+    with _pool_lock:
+        if _connection_pool is None:
+            _connection_pool = ConnectionPool(DATABASE_PATH, max_connections=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT)
+    return _connection_pool
+
+def get_query_cache():
+    """
+    Return the shared question -> SQL cache, creating it on first use
     """
-    system_prompt = """You are a helpful assistant that determines if a user query is related to an employee database. 
+    global _query_cache
+    with _pool_lock:
+        if _query_cache is None:
+            _query_cache = QueryCache(
+                SQL_CACHE_PATH, DATABASE_PATH,
+                max_entries=SQL_CACHE_MAX_ENTRIES, ttl_seconds=SQL_CACHE_TTL_SECONDS
+            )
+    return _query_cache
+
+def get_result_cache():
+    """
+    Return the shared query result cache, creating it on first use
+    """
+    global _result_cache
+    with _pool_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(DATABASE_PATH, max_bytes=RESULT_CACHE_MAX_BYTES)
+    return _result_cache
+
+def get_sql_guard():
+    """
+    Return the shared SQL guard, creating it on first use
+    """
+    global _sql_guard
+    with _pool_lock:
+        if _sql_guard is None:
+            # The added LIMIT goes one past the row budget so truncation is still detected
+            _sql_guard = SQLGuard(
+                max_scan_rows=SQL_GUARD_MAX_SCAN_ROWS, max_join_rows=SQL_GUARD_MAX_JOIN_ROWS,
+                default_limit=RESULT_MAX_ROWS + 1, timeout_seconds=SQL_GUARD_TIMEOUT_SECONDS,
+                max_vm_steps=SQL_GUARD_MAX_VM_STEPS
+            )
+    return _sql_guard
+
+def get_workload_log():
+    """
+    Return the shared workload log, creating it on first use
+    """
+    global _workload_log
+    with _pool_lock:
+        if _workload_log is None:
+            _workload_log = WorkloadLog(
+                WORKLOAD_LOG_PATH, max_statements=WORKLOAD_LOG_MAX_STATEMENTS,
+                flush_seconds=WORKLOAD_LOG_FLUSH_SECONDS, batch_size=WORKLOAD_LOG_BATCH_SIZE
+            )
+            # Executions still buffered at exit are written out rather than lost
+            atexit.register(_workload_log.close)
+    return _workload_log
+
+def get_prompt_builder():
+    """
+    Return the shared schema prompt builder, creating it on first use
+    """
+    global _prompt_builder
+    with _pool_lock:
+        if _prompt_builder is None:
+            _prompt_builder = SchemaPromptBuilder(
+                DATABASE_PATH, baseline_prompt=SQL_SYSTEM_PROMPT,
+                rules_token_budget=SQL_PROMPT_RULES_TOKEN_BUDGET
+            )
+    return _prompt_builder
+
+def get_question_compiler():
+    """
+    Return the shared question compiler, creating it on first use
+    """
+    global _question_compiler
+    with _pool_lock:
+        if _question_compiler is None:
+            _question_compiler = QuestionCompiler(DATABASE_PATH)
+    return _question_compiler
+
+def get_query_library():
+    """
+    Return the shared library of verified queries, creating it on first use
+    """
+    global _query_library
+    with _pool_lock:
+        if _query_library is None:
+            _query_library = QueryLibrary(QUERY_LIBRARY_PATH)
+    return _query_library
+
+def get_speculative_executor():
+    """
+    Return the thread pool that runs speculative SQL generation, creating it on first use
+    """
+    global _speculative_executor
+    with _pool_lock:
+        if _speculative_executor is None:
+            _speculative_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='speculative')
+    return _speculative_executor
+
+def get_cassette():
+    """
+    Return the shared LLM cassette, or None when record/replay is off
+    """
+    global _cassette
+    if LLM_CASSETTE_MODE == 'off':
+        return None
+    with _pool_lock:
+        if _cassette is None:
+            _cassette = Cassette(LLM_CASSETTE_DIR, LLM_CASSETTE_MODE)
+    return _cassette
+
+def get_trace_log():
+    """
+    Return the shared trace log, or None when TRACE_LOG_PATH is not set
+    """
+    global _trace_log
+    if not TRACE_LOG_PATH:
+        return None
+    with _pool_lock:
+        if _trace_log is None:
+            _trace_log = TraceLog(TRACE_LOG_PATH)
+    return _trace_log
+
+def pipeline_trace(user_input, path='sync'):
+    """
+    Trace one pipeline request into the metrics registry and the trace log
+    """
+    if not TRACING_ENABLED:
+        return request_trace(user_input, enabled=False)
+    return request_trace(user_input, path, registry=metrics_registry, log=get_trace_log())
+
+def create_chat_completion(stage, **kwargs):
+    """
+    Call the chat completions API with GPT-3.5 and record the call's latency, token usage
+    and retries in the current trace. With a cassette, recorded responses are replayed.
+    """
+    start = time.perf_counter()
+    kwargs = dict(model="gpt-3.5-turbo", **kwargs)
+    cassette = get_cassette()
+    response = cassette.replay(stage, kwargs) if cassette is not None else None
+    retries = 0
+    if response is None:
+        raw = client.chat.completions.with_raw_response.create(**kwargs)
+        response = raw.parse()
+        retries = raw.retries_taken
+        if cassette is not None:
+            cassette.record(stage, kwargs, response)
+    record_llm_call(stage, response.usage, retries, time.perf_counter() - start)
+    return response
+
+def stream_chat_completion(stage, **kwargs):
+    """
+    Streaming version of create_chat_completion: yield the completion's text as it arrives.
+    Cassettes hold whole responses, so a replayed one comes in a single piece and a
+    streamed one is recorded once it is complete.
+    """
+    start = time.perf_counter()
+    kwargs = dict(model="gpt-3.5-turbo", **kwargs)
+    cassette = get_cassette()
+    response = cassette.replay(stage, kwargs) if cassette is not None else None
+    if response is not None:
+        record_llm_call(stage, response.usage, 0, time.perf_counter() - start)
+        yield response.choices[0].message.content
+        return
+
+    raw = client.chat.completions.with_raw_response.create(
+        stream=True, stream_options={"include_usage": True}, **kwargs
+    )
+    parts, first, usage = [], None, None
+    try:
+        with raw.parse() as stream:
+            for chunk in stream:
+                first = first or chunk
+                # The usage comes in a last chunk of its own, without choices
+                usage = chunk.usage or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+    finally:
+        record_llm_call(stage, usage, raw.retries_taken, time.perf_counter() - start)
+    if cassette is not None and first is not None:
+        cassette.record(stage, kwargs, ChatCompletion.model_validate({
+            'id': first.id, 'created': first.created, 'model': first.model, 'object': 'chat.completion',
+            'choices': [{'index': 0, 'finish_reason': 'stop',
+                         'message': {'role': 'assistant', 'content': ''.join(parts)}}],
+            'usage': usage.model_dump() if usage is not None else None
+        }))
+
+def get_relevance_classifier():
+    """
+    Return the shared local relevance classifier, creating it on first use
+    """
+    global _relevance_classifier
+    with _pool_lock:
+        if _relevance_classifier is None:
+            _relevance_classifier = RelevanceClassifier(
+                DATABASE_PATH, relevant_threshold=LOCAL_RELEVANCE_THRESHOLD
+            )
+    return _relevance_classifier
+
+# System prompts shared by the sync and async pipelines
+RELEVANCE_SYSTEM_PROMPT = """You are a helpful assistant that determines if a user query is related to an employee database. 
     The database contains two tables:
     
     1. employees table with: employee_id, first_name, last_name, email, phone_number, 
@@ -24,23 +386,8 @@ def check_query_relevance(user_input):
     
     Respond with only 'YES' if the query is related to employee data, or 'NO' if it's not."""
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_input}
-        ],
-        temperature=0
-    )
-    
-    return response.choices[0].message.content.strip().upper() == 'YES'
-
-def generate_sql_query(user_input):
-    """
-    Generate an SQL query based on the user input using GPT-3.5
-    """
-    system_prompt = """You are an SQL expert. Generate a SQL query for the following user request.
-    The database has two tables:
+SQL_SYSTEM_PROMPT = """You are an SQL expert. Generate a SQL query for the following user request.
+    The database has two tables, plus three derived tables kept up to date from them:
 
     1. employees table:
     - employee_id (INTEGER PRIMARY KEY)
@@ -62,6 +409,19 @@ def generate_sql_query(user_input):
     - last_promotion_date (DATE)
     - performance_rating (DECIMAL)
 
+    3. employee_hierarchy table (one row per manager/report pair at any depth, plus depth 0 for each employee):
+    - ancestor_id (INTEGER) - References employees.employee_id
+    - descendant_id (INTEGER) - References employees.employee_id
+    - depth (INTEGER) - 1 for direct reports, 2 for their reports, ...
+
+    4. department_summary table:
+    - department (TEXT PRIMARY KEY)
+    - headcount, salary_sum, salary_avg, rated_count, rating_sum, rating_avg
+
+    5. manager_summary table (totals over everyone below the manager, not the manager):
+    - manager_id (INTEGER PRIMARY KEY) - References employees.employee_id
+    - direct_reports, headcount, salary_sum, salary_avg, rated_count, rating_sum, rating_avg
+
  --                         Rules for SQL Query Generation
 -- ----------------------------------------------------------------------------
 -- These guidelines will help you choose the right patterns and syntax whenever  
@@ -111,6 +471,13 @@ def generate_sql_query(user_input):
 --       COUNT( ), SUM( ), AVG( ), MAX( ), MIN( ) on salary, leave balances, performance_rating.  
 --    • **DISTINCT**  
 --       Deduplicate when necessary: COUNT(DISTINCT department), SELECT DISTINCT job_title.  
+--    • **Precomputed rollups**  
+--       Read department or per-manager headcount, salary and rating totals/averages from  
+--       `department_summary` / `manager_summary` instead of aggregating `employees`.  
+--    • **Reporting chains**  
+--       For everyone under a manager (at any depth) join `employee_hierarchy`:  
+--          `JOIN employee_hierarchy h ON h.descendant_id = e.employee_id WHERE h.ancestor_id = ? AND h.depth > 0`  
+--       instead of a recursive CTE.  
 
 -- 5. CONDITIONAL LOGIC & NULL HANDLING
 --    • **CASE … WHEN … THEN … ELSE … END**  
@@ -174,89 +541,922 @@ def generate_sql_query(user_input):
 
     Respond with ONLY the SQL query, nothing else."""
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_input}
-        ],
+FOLLOWUP_SYSTEM_PROMPT = """You are an SQL expert. The result of the user's previous question is stored in the SQLite table {table}.
+    Write a SQLite query over {table} that answers the user's follow-up request.
+
+    Previous question: {question}
+
+    Columns of {table}:
+{columns}
+
+    Respond with ONLY the SQL query, nothing else."""
+
+RESPONSE_SYSTEM_PROMPT = """You are a helpful assistant that generates natural language responses based on database query results.
+    Provide a clear and concise response that answers the user's question using the query results.
+    If the results show rankings or comparisons, explain them clearly.
+    If the results are empty, explain why that might be the case."""
+
+def classify_relevance_locally(user_input):
+    """
+    Return the local classifier's relevance decision, or None if the LLM has to decide
+    """
+    if not LOCAL_RELEVANCE_ENABLED:
+        return None
+    return get_relevance_classifier().classify(user_input)
+
+def record_relevance_llm_call(seconds):
+    if LOCAL_RELEVANCE_ENABLED:
+        get_relevance_classifier().record_llm_call(seconds)
+
+def build_relevance_messages(user_input):
+    return [
+        {"role": "system", "content": RELEVANCE_SYSTEM_PROMPT},
+        {"role": "user", "content": user_input}
+    ]
+
+def parse_relevance_answer(content):
+    return content.strip().upper() == 'YES'
+
+def check_query_relevance(user_input, on_llm_fallback=None):
+    """
+    Check if the user input is relevant to the employee database, using the local
+    classifier first and GPT-3.5 only when the classifier is unsure. on_llm_fallback
+    is called just before GPT-3.5 is asked, to start work that can overlap with it.
+    """
+    with trace_stage('relevance'):
+        decision = classify_relevance_locally(user_input)
+        if decision is not None:
+            set_trace_attribute('relevance_source', 'local')
+            return decision
+
+        set_trace_attribute('relevance_source', 'llm')
+        if on_llm_fallback is not None:
+            on_llm_fallback()
+        start = time.perf_counter()
+        relevant = check_query_relevance_llm(user_input)
+        record_relevance_llm_call(time.perf_counter() - start)
+        return relevant
+
+def check_query_relevance_llm(user_input):
+    """
+    Check if the user input is relevant to the employee database using GPT-3.5
+    """
+    response = create_chat_completion(
+        'relevance',
+        messages=build_relevance_messages(user_input),
         temperature=0
     )
     
-    return response.choices[0].message.content.strip()
+    return parse_relevance_answer(response.choices[0].message.content)
 
-def execute_sql_query(query):
+def build_sql_messages(user_input):
+    examples = []
+    if QUERY_LIBRARY_ENABLED:
+        with trace_stage('query_library'):
+            examples = get_query_library().nearest(
+                user_input, k=QUERY_LIBRARY_EXAMPLES, min_similarity=QUERY_LIBRARY_MIN_SIMILARITY
+            )
+    if PRUNED_SQL_PROMPT:
+        # Verified examples show the query patterns, so the optional rules are left out
+        system_prompt = get_prompt_builder().build(user_input, include_rules=not examples).text
+    else:
+        system_prompt = SQL_SYSTEM_PROMPT
+    messages = [{"role": "system", "content": system_prompt}]
+    # Closest example last, right before the question
+    for _, question, sql in reversed(examples):
+        messages.append({"role": "user", "content": question})
+        messages.append({"role": "assistant", "content": sql})
+    messages.append({"role": "user", "content": user_input})
+    return messages
+
+def generate_sql_query(user_input):
     """
-    Execute the SQL query and return the results
+    Generate an SQL query based on the user input using GPT-3.5
     """
-    conn = sqlite3.connect('employees.db')
-    cursor = conn.cursor()
+    with trace_stage('sql_generation'):
+        response = create_chat_completion(
+            'sql_generation',
+            messages=build_sql_messages(user_input),
+            temperature=0
+        )
     
-    try:
-        cursor.execute(query)
-        columns = [description[0] for description in cursor.description]
-        results = cursor.fetchall()
-        conn.close()
+    return response.choices[0].message.content.strip()
+
+def execute_sql_query(query, params=(), export_format=None, export_min_rows=None):
+    """
+    Execute the SQL query and return the results, streamed from the cursor
+    in batches and capped at the configured row and byte budget.
+    Results are served from the result cache while the data is unchanged, and
+    new queries go through the SQL guard's pre-flight checks and execution budget.
+    Every execution is recorded in the workload log for the index advisor.
+
+    Only questions that export_options() marks for export, or callers passing export_format,
+    are exported. With export_min_rows 0 (the question asked for a file) the rows are streamed
+    to a file straight away (see export_sql_query). Otherwise the query runs as usual and is
+    exported when it overflows the row or byte budget or has more than export_min_rows rows;
+    the export counts the rows, so the inline run does not count them first.
+    """
+    with trace_stage('execute'):
+        if not EXPORT_ENABLED or export_format is None:
+            return _execute_sql_query(query, params)
+        if export_min_rows == 0:
+            return export_sql_query(query, params, export_format)
+        columns, results = _execute_sql_query(query, params, count_total=False)
+        if results.truncated or (export_min_rows is not None and len(results) > export_min_rows):
+            # Too large for the prompt: run it again, writing every row to a file
+            return export_sql_query(query, params, export_format)
+        with _export_lock:
+            _export_stats['answered_inline'] += 1
         return columns, results
-    except Exception as e:
-        conn.close()
-        raise e
 
-def generate_response(user_input, query_results):
+def export_sql_query(query, params=(), export_format=EXPORT_FORMAT):
+    """
+    Stream every row of the query to a file in EXPORT_DIR with constant memory and return
+    (columns, rows), where rows are the first EXPORT_PREVIEW_ROWS with the ExportResult in
+    rows.export. The guard still checks the query, but without its LIMIT and with the export
+    time budget. Files past EXPORT_RETENTION_SECONDS or EXPORT_MAX_FILES are deleted first.
+    """
+    # Make room for the new file; 0 turns either limit off
+    pruned = prune_exports(EXPORT_DIR, EXPORT_RETENTION_SECONDS or None,
+                           EXPORT_MAX_FILES - 1 if EXPORT_MAX_FILES else None)
+    guard = get_sql_guard() if SQL_GUARD_ENABLED else None
+    with get_connection_pool().connection() as conn:
+        sql_to_run = guard.prepare(conn, query, params, limit=False)[0] if guard is not None else query
+        cursor = conn.cursor()
+        try:
+            with guard.budget(conn, timeout_seconds=EXPORT_TIMEOUT_SECONDS, max_vm_steps=EXPORT_MAX_VM_STEPS) \
+                    if guard is not None else nullcontext():
+                cursor.execute(sql_to_run, params)
+                columns = [description[0] for description in cursor.description]
+                export = export_rows(
+                    cursor, columns, EXPORT_DIR, export_format=export_format, batch_size=EXPORT_BATCH_SIZE,
+                    keep_rows=EXPORT_PREVIEW_ROWS
+                )
+        finally:
+            cursor.close()
+        if WORKLOAD_LOG_ENABLED:
+            get_workload_log().record(render_sql(sql_to_run, params), export.seconds, conn)
+
+    with _export_lock:
+        _export_stats['exports'] += 1
+        _export_stats['pruned'] += pruned
+        _export_stats['rows'] += export.row_count
+        _export_stats['bytes'] += export.size_bytes
+        _export_stats['seconds'] += export.seconds
+    preview = ResultRows(export.preview[:EXPORT_PREVIEW_ROWS], truncated=True, total_count=export.row_count,
+                         export=export)
+    return columns, preview
+
+def page_cursor_after(query, params, columns, rows, page_size=None):
+    """
+    Return the PageCursor for the rows of the query after rows, or None when rows is
+    the whole result
+    """
+    if not getattr(rows, 'truncated', False):
+        return None
+    cursor = cursor_after(query, params, columns, rows, page_size or RESULT_PAGE_SIZE)
+    with get_connection_pool().connection() as conn:
+        return cursor.check_nulls(conn)
+
+def next_page_token(result):
+    """
+    Return the opaque cursor for the rows after a pipeline result's rows, or None
+    """
+    if result['sql'] is None:
+        return None
+    cursor = page_cursor_after(result['sql'], result['sql_params'], result['columns'], result['rows'])
+    return cursor.encode(PAGE_CURSOR_SECRET) if cursor is not None else None
+
+def fetch_result_page(cursor, page_size=None):
     """
-    Generate a natural language response based on the query results using GPT-3.5
+    Return the ResultPage a cursor (a PageCursor or its token) points at, with the token
+    for the page after it. Pages are fetched by keyset on the query's ORDER BY columns,
+    so a page costs the same however deep it is, and by OFFSET for queries without one.
+    The page query goes through the SQL guard; no LLM call is made.
+    """
+    if isinstance(cursor, str):
+        cursor = PageCursor.decode(cursor, PAGE_CURSOR_SECRET)
+    if page_size is not None:
+        cursor = cursor.resize(max(1, min(page_size, RESULT_MAX_ROWS)))
+    sql, params = cursor.page_query()
+    guard = get_sql_guard() if SQL_GUARD_ENABLED else None
+    with trace_stage('execute'):
+        with get_connection_pool().connection() as conn:
+            sql_to_run = guard.prepare(conn, sql, params)[0] if guard is not None else sql
+            db_cursor = conn.cursor()
+            try:
+                start = time.perf_counter()
+                with guard.budget(conn) if guard is not None else nullcontext():
+                    db_cursor.execute(sql_to_run, params)
+                    columns = [description[0] for description in db_cursor.description]
+                    rows = db_cursor.fetchall()
+                elapsed = time.perf_counter() - start
+            finally:
+                db_cursor.close()
+            if WORKLOAD_LOG_ENABLED:
+                get_workload_log().record(render_sql(sql_to_run, params), elapsed, conn)
+
+    # The page query reads one row more than the page to tell whether another follows
+    more = len(rows) > cursor.page_size
+    rows = rows[:cursor.page_size]
+    next_cursor = cursor.advance(columns, rows).encode(PAGE_CURSOR_SECRET) if more else None
+    with _page_lock:
+        _page_stats['pages'] += 1
+        _page_stats[cursor.mode] += 1
+        _page_stats['rows'] += len(rows)
+    return ResultPage(columns, rows, next_cursor, cursor.mode)
+
+def _execute_sql_query(query, params=(), count_total=True):
+    """
+    Run the query inline; without count_total the rows past the budget are not counted,
+    for callers that export a truncated result and get the count from the file
+    """
+    count_total = count_total and RESULT_COUNT_TOTAL
+    cache = get_result_cache() if RESULT_CACHE_ENABLED else None
+    if cache is not None:
+        cached = cache.get(query, params)
+        record_cache_lookup('result', cached is not None)
+        if cached is not None:
+            return cached
+        data_version = cache.data_version()
+
+    guard = get_sql_guard() if SQL_GUARD_ENABLED else None
+    with get_connection_pool().connection() as conn:
+        sql_to_run, limited = guard.prepare(conn, query, params) if guard is not None else (query, False)
+        cursor = conn.cursor()
+        try:
+            start = time.perf_counter()
+            with guard.budget(conn) if guard is not None else nullcontext():
+                cursor.execute(sql_to_run, params)
+                columns = [description[0] for description in cursor.description]
+                results = fetch_rows(
+                    cursor, max_rows=RESULT_MAX_ROWS, max_bytes=RESULT_MAX_BYTES,
+                    batch_size=RESULT_BATCH_SIZE, count_total=count_total
+                )
+            elapsed = time.perf_counter() - start
+        finally:
+            cursor.close()
+        if WORKLOAD_LOG_ENABLED:
+            # The log keeps SQL text only, so parameters are inlined for the index advisor to replay
+            get_workload_log().record(render_sql(sql_to_run, params), elapsed, conn)
+        if limited and results.truncated:
+            # The guard's LIMIT hides how many rows the query would really return, so they are
+            # counted without being fetched; a count that runs out of budget stays unknown
+            results.total_count = guard.count_rows(conn, query, params) if count_total else None
+
+    if cache is not None and (count_total or not results.truncated or not RESULT_COUNT_TOTAL):
+        # A result left uncounted only for an export would be served without its total later
+        cache.put(query, params, columns, results, data_version)
+    return columns, results
+
+def prepare_response(user_input, query_results, stats=None):
+    """
+    Render a templated response for simple results, or build the GPT-3.5 messages for the rest.
+    Returns (response, None) or (None, messages).
+    If a stats dict is given, the response source and prompt token counts are recorded in it.
     """
     columns, results = query_results
-    results_str = f"Columns: {', '.join(columns)}\nResults: {results}"
-    
-    system_prompt = """You are a helpful assistant that generates natural language responses based on database query results.
-    Provide a clear and concise response that answers the user's question using the query results.
-    If the results show rankings or comparisons, explain them clearly.
-    If the results are empty, explain why that might be the case."""
+    export = getattr(results, 'export', None)
+    if export is not None and TEMPLATED_RESPONSES:
+        # The rows are in the file; the answer only needs to say where
+        with _serialization_lock:
+            _response_source_stats['template'] += 1
+        if stats is not None:
+            stats['response_source'] = 'template'
+        return f"{export.summary()}.", None
+    if TEMPLATED_RESPONSES and export is None:
+        templated = render_response(columns, results, max_rows=TEMPLATE_MAX_ROWS, max_columns=TEMPLATE_MAX_COLUMNS)
+        if templated is not None:
+            with _serialization_lock:
+                _response_source_stats['template'] += 1
+            if stats is not None:
+                stats['response_source'] = 'template'
+            return templated, None
 
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": f"Original question: {user_input}\n\nQuery results: {results_str}"}
-        ]
-    )
+    serialized = serialize_results(columns, results, token_budget=RESPONSE_TOKEN_BUDGET)
+    results_str = f"Results (tab-separated, first line is the column names):\n{serialized.text}"
+    if export is not None:
+        results_str += f"\n(First {len(results)} rows only. {export.summary()}; tell the user where the file is)"
+    elif getattr(results, 'truncated', False):
+        total = results.total_count if results.total_count is not None else 'more'
+        results_str += f"\n(Results truncated: fetched {len(results)} of {total} rows)"
+
+    with _serialization_lock:
+        _response_source_stats['llm'] += 1
+        _serialization_stats['responses'] += 1
+        _serialization_stats['summarized'] += int(serialized.summarized)
+        _serialization_stats['prompt_tokens'] += serialized.tokens
+        _serialization_stats['prompt_tokens_saved'] += serialized.tokens_saved
+    if stats is not None:
+        stats['response_source'] = 'llm'
+        stats['result_tokens'] = serialized.tokens
+        stats['result_tokens_saved'] = serialized.tokens_saved
+
+    return None, [
+        {"role": "system", "content": RESPONSE_SYSTEM_PROMPT},
+        {"role": "user", "content": f"Original question: {user_input}\n\nQuery results: {results_str}"}
+    ]
+
+def generate_response(user_input, query_results, stats=None):
+    """
+    Generate a natural language response based on the query results, from a template
+    when the result is simple enough and using GPT-3.5 otherwise
+    """
+    with trace_stage('response'):
+        templated, messages = prepare_response(user_input, query_results, stats)
+        if templated is not None:
+            return templated
+
+        response = create_chat_completion('response', messages=messages)
     
     return response.choices[0].message.content.strip()
 
-def process_user_input(user_input):
+def stream_response(user_input, query_results, stats=None):
     """
-    Main function to process user input and return appropriate response
+    Streaming version of generate_response: yield the response in pieces as GPT-3.5
+    writes it, or a templated response in one piece
     """
-    try:
+    with trace_stage('response'):
+        templated, messages = prepare_response(user_input, query_results, stats)
+        if templated is not None:
+            yield templated
+            return
+
+        started = False
+        for piece in stream_chat_completion('response', messages=messages):
+            if not started:
+                # Like generate_response, drop the whitespace the answer starts with
+                piece = piece.lstrip()
+                started = bool(piece)
+            if piece:
+                yield piece
+
+def compile_question_locally(user_input, result):
+    """
+    Return SQL compiled from a common question shape, or None when the question needs the LLM.
+    The parameters go into result['sql_params'].
+    """
+    if not LOCAL_SQL_ENABLED:
+        return None
+    with trace_stage('local_sql'):
+        compiled = get_question_compiler().compile(user_input)
+    if compiled is None:
+        return None
+    # A question that matches a template is about employee data by construction
+    result['relevant'] = True
+    result['sql_source'] = 'local'
+    result['sql_params'] = compiled.params
+    return compiled.sql
+
+def lookup_verified_sql(user_input, result):
+    """
+    Return the verified SQL for a question asked before, or None
+    """
+    if not QUERY_LIBRARY_ENABLED:
+        return None
+    with trace_stage('query_library'):
+        sql_query = get_query_library().lookup(user_input)
+    if sql_query is not None:
+        result['relevant'] = True
+        result['sql_source'] = 'library'
+    return sql_query
+
+def lookup_known_sql(user_input, result):
+    """
+    Return SQL for the question without calling the LLM: compiled locally, verified
+    in the query library or cached from an earlier generation. None if all miss.
+    """
+    for lookup in (compile_question_locally, lookup_verified_sql, lookup_cached_sql):
+        sql_query = lookup(user_input, result)
+        if sql_query is not None:
+            return sql_query
+    return None
+
+def lookup_cached_sql(user_input, result):
+    """
+    Return the cached SQL for a question, or None on a miss or when the cache is disabled
+    """
+    if not SQL_CACHE_ENABLED:
+        return None
+    with trace_stage('sql_cache'):
+        sql_query = get_query_cache().get(user_input)
+    record_cache_lookup('sql', sql_query is not None)
+    if sql_query is not None:
+        # A cached question already passed the relevance check
+        result['relevant'] = True
+        result['sql_source'] = 'cache'
+    return sql_query
+
+def store_generated_sql(user_input, result):
+    """
+    Cache SQL generated by the LLM once it has executed, so SQL that fails is not
+    replayed for the cache's whole TTL
+    """
+    if SQL_CACHE_ENABLED and result['sql_source'] == 'llm':
+        get_query_cache().put(user_input, result['sql'])
+
+def record_speculative_run(discarded):
+    with _speculative_lock:
+        _speculative_stats['runs'] += 1
+        _speculative_stats['discarded_sql'] += int(discarded)
+
+def get_sql_for_question(user_input, result):
+    """
+    Compile the question locally or look it up in the query library and SQL cache,
+    falling back to the relevance check and GPT-3.5.
+    Returns the SQL query, or None if the question is unrelated to the employee database.
+    """
+    sql_query = lookup_known_sql(user_input, result)
+    if sql_query is not None:
+        return sql_query
+
+    if SPECULATIVE_EXECUTION:
+        sql_query = _speculative_sql_for_question(user_input, result)
+    else:
         # Check if query is relevant to employee database
-        if not check_query_relevance(user_input):
-            return "This query appears to be unrelated to the employee database. Please ask a question about employee data."
+        result['relevant'] = check_query_relevance(user_input)
+        sql_query = generate_sql_query(user_input) if result['relevant'] else None
+    if sql_query is None:
+        return None
 
-        # Generate and execute SQL query
-        sql_query = generate_sql_query(user_input)
-        query_results = execute_sql_query(sql_query)
-        
-        # Generate natural language response
-        final_response = generate_response(user_input, query_results)
-        
-        # Always show SQL query with response
-        final_response = f"SQL Query:\n{sql_query}\n\nResponse:\n{final_response}"
-            
-        return final_response
+    result['sql_source'] = 'llm'
+    return sql_query
+
+def _speculative_sql_for_question(user_input, result):
+    """
+    Fire the LLM relevance check and SQL generation at once and drop the SQL if the question
+    is unrelated. SQL generation only starts once the local classifier turns out to be unsure:
+    a local decision takes microseconds, so there is no round trip to overlap it with.
+    """
+    sql_future = None
+
+    def speculate():
+        nonlocal sql_future
+        sql_future = get_speculative_executor().submit(run_in_trace_context(generate_sql_query, user_input))
+
+    try:
+        result['relevant'] = check_query_relevance(user_input, on_llm_fallback=speculate)
+    except Exception:
+        if sql_future is not None:
+            sql_future.cancel()
+        raise
+
+    if sql_future is None:
+        return generate_sql_query(user_input) if result['relevant'] else None
+    if not result['relevant']:
+        # The request may already be in flight; its result is simply never used
+        record_speculative_run(discarded=not sql_future.cancel())
+        return None
+    record_speculative_run(discarded=False)
+    return sql_future.result()
+
+def run_pipeline(user_input):
+    """
+    Run the full question pipeline and return a dict describing each stage
+    """
+    with pipeline_trace(user_input) as trace:
+        result = _run_pipeline(user_input)
+        if trace is not None:
+            trace.finish(result)
+            result['trace_id'] = trace.trace_id
+        return result
+
+def _run_pipeline(user_input):
+    result = new_pipeline_result(user_input)
+    for _ in _pipeline_steps(user_input, result):
+        pass
+    return result
+
+def _pipeline_steps(user_input, result, stream=False):
+    """
+    Run the pipeline's stages, filling in result and yielding an event as each one
+    finishes (see stream_pipeline)
+    """
+    timings = result['timings']
+    start = time.perf_counter()
+
+    # Generate and execute SQL query
+    sql_query = get_sql_for_question(user_input, result)
+    timings['sql'] = time.perf_counter() - start
+    if sql_query is None:
+        timings['total'] = timings['sql']
+        return
+    result['sql'] = sql_query
+    yield sql_event(result)
+    query_results = execute_sql_query(sql_query, result['sql_params'], *export_options(user_input))
+    store_generated_sql(user_input, result)
+    result['columns'], result['rows'] = query_results
+    result['export'] = query_results[1].export
+    result['next_cursor'] = next_page_token(result)
+    timings['execute'] = time.perf_counter() - start - timings['sql']
+    yield rows_event(result)
+
+    # Generate natural language response
+    yield from _response_steps(user_input, query_results, result, start, stream)
 
+def _response_steps(user_input, query_results, result, start, stream=False):
+    """
+    Generate the response into result, yielding it as token events: piece by piece as
+    GPT-3.5 streams it, or whole when not streaming
+    """
+    timings = result['timings']
+    if stream:
+        parts = []
+        for piece in stream_response(user_input, query_results, stats=result):
+            if not parts:
+                timings['first_token'] = time.perf_counter() - start
+            parts.append(piece)
+            yield {'event': 'token', 'text': piece}
+        result['response'] = ''.join(parts).rstrip()
+    else:
+        result['response'] = generate_response(user_input, query_results, stats=result)
+        timings['first_token'] = time.perf_counter() - start
+        yield {'event': 'token', 'text': result['response']}
+    timings['total'] = time.perf_counter() - start
+    timings['response'] = timings['total'] - timings['sql'] - timings['execute']
+
+def sql_event(result):
+    return {
+        'event': 'sql',
+        'sql': result['sql'],
+        'sql_params': list(result['sql_params']),
+        'sql_source': result['sql_source']
+    }
+
+def rows_event(result):
+    rows = result['rows']
+    return {
+        'event': 'rows',
+        'columns': result['columns'],
+        'row_count': len(rows),
+        'truncated': getattr(rows, 'truncated', False),
+        'total_count': getattr(rows, 'total_count', len(rows)),
+        'export': result['export'].to_dict() if result['export'] is not None else None,
+        'next_cursor': result['next_cursor']
+    }
+
+def stream_pipeline(user_input, session=None, stream=True):
+    """
+    Answer a question incrementally, yielding events as its stages finish: 'sql' as soon
+    as the SQL is known, 'rows' once it has run, 'token' for each piece of the response
+    as GPT-3.5 streams it, and finally 'done' with the pipeline result. Unrelated
+    questions only get 'done'. With a session, follow-ups refine its previous result
+    (see run_conversation_turn). The steps run in their own context, so the request's trace
+    is not current in the caller's code between events.
+    """
+    return iterate_in_context(_stream_pipeline(user_input, session, stream))
+
+def _stream_pipeline(user_input, session, stream):
+    compiled, follow_up = None, False
+    if session is not None and session.has_result():
+        compiled = session.compile(user_input)
+        follow_up = compiled is not None or session.is_follow_up(user_input)
+
+    with pipeline_trace(user_input) as trace:
+        result = new_pipeline_result(user_input)
+        if follow_up:
+            yield from _follow_up_steps(session, user_input, compiled, result, stream)
+        else:
+            yield from _pipeline_steps(user_input, result, stream)
+        if trace is not None:
+            trace.finish(result)
+            result['trace_id'] = trace.trace_id
+
+    if not follow_up:
+        with _conversation_lock:
+            _conversation_stats['full_pipeline'] += 1
+        if session is not None:
+            remember_result(session, result)
+    yield {'event': 'done', 'result': result}
+
+def new_conversation():
+    """
+    Return a ResultSession holding one conversation's last result, or None when
+    follow-up questions are disabled
+    """
+    if not CONVERSATION_ENABLED:
+        return None
+    return ResultSession(DATABASE_PATH, max_rows=CONVERSATION_MAX_ROWS, page_size=CONVERSATION_PAGE_SIZE)
+
+def run_conversation_turn(session, user_input):
+    """
+    Answer one question of a conversation. Follow-ups are compiled into a query over the
+    previous result in the session's TEMP table; any other question runs the full pipeline
+    and its result replaces the session's.
+    """
+    for event in stream_pipeline(user_input, session, stream=False):
+        pass
+    return event['result']
+
+def _follow_up_steps(session, user_input, compiled, result, stream=False):
+    result['relevant'] = True
+    timings = result['timings']
+    start = time.perf_counter()
+
+    if compiled is not None:
+        query, refinement = compiled
+        sql_query, params, source = query.sql, query.params, 'followup'
+    else:
+        # Not a shape the session compiles: a short prompt over the result's columns only
+        with trace_stage('followup_sql'):
+            response = create_chat_completion(
+                'followup_sql',
+                messages=[
+                    {"role": "system", "content": FOLLOWUP_SYSTEM_PROMPT.format(
+                        table=RESULT_TABLE, question=session.question, columns=session.describe()
+                    )},
+                    {"role": "user", "content": user_input}
+                ],
+                temperature=0
+            )
+        refinement, sql_query, params, source = None, response.choices[0].message.content.strip(), (), 'followup_llm'
+    result['sql'], result['sql_params'], result['sql_source'] = sql_query, params, source
+    timings['sql'] = time.perf_counter() - start
+    yield sql_event(result)
+
+    with trace_stage('execute'):
+        query_results = execute_follow_up_query(session, sql_query, params)
+    result['columns'], result['rows'] = query_results
+    timings['execute'] = time.perf_counter() - start - timings['sql']
+    if refinement is not None:
+        # Later follow-ups build on this turn's filters, order and page
+        session.adopt(refinement, result['columns'], result['rows'])
+    with _conversation_lock:
+        _conversation_stats['local_followups' if refinement is not None else 'llm_followups'] += 1
+    yield rows_event(result)
+
+    if refinement is not None and query.template == 'page' and TEMPLATED_RESPONSES:
+        # A page is listed as it is, without asking GPT-3.5 to describe it again
+        columns, rows = query_results
+        result['response'] = render_response(columns, rows, max_rows=max(len(rows), 1), max_columns=len(columns))
+        result['response_source'] = 'template'
+        with _serialization_lock:
+            _response_source_stats['template'] += 1
+        timings['first_token'] = timings['total'] = time.perf_counter() - start
+        timings['response'] = timings['total'] - timings['sql'] - timings['execute']
+        yield {'event': 'token', 'text': result['response']}
+    else:
+        # The follow-up alone ("sort them by salary") says little without the question it refines
+        question = f"{session.question} (follow-up: {user_input})"
+        yield from _response_steps(question, query_results, result, start, stream)
+
+def execute_follow_up_query(session, query, params=()):
+    """
+    Run a follow-up query on the session's connection, with the SQL guard's checks and
+    budget and the usual row and byte budget; the TEMP table is small, so it skips the caches
+    """
+    guard = get_sql_guard() if SQL_GUARD_ENABLED else None
+    sql_to_run = guard.prepare(session.conn, query, params)[0] if guard is not None else query
+    cursor = session.conn.cursor()
+    try:
+        with guard.budget(session.conn) if guard is not None else nullcontext():
+            cursor.execute(sql_to_run, params)
+            columns = [description[0] for description in cursor.description]
+            results = fetch_rows(
+                cursor, max_rows=RESULT_MAX_ROWS, max_bytes=RESULT_MAX_BYTES,
+                batch_size=RESULT_BATCH_SIZE, count_total=RESULT_COUNT_TOTAL
+            )
+    finally:
+        cursor.close()
+    return columns, results
+
+def remember_result(session, result):
+    """
+    Keep a full pipeline result in the session for follow-ups. A complete result is copied
+    from its rows; a truncated or exported one is streamed in again from the query. One
+    with more than CONVERSATION_MAX_ROWS rows is only kept as a cursor for paging.
+    """
+    if not result['relevant'] or result['sql'] is None:
+        # Unrelated questions leave the previous result in place
+        return
+    rows = result['rows']
+    try:
+        if result['export'] is None and not getattr(rows, 'truncated', False):
+            stored = session.store_rows(result['question'], result['sql'], result['sql_params'],
+                                        result['columns'], rows)
+        else:
+            guard = get_sql_guard() if SQL_GUARD_ENABLED else None
+            with get_connection_pool().connection() as conn:
+                sql_to_run = (guard.prepare(conn, result['sql'], result['sql_params'], limit=False)[0]
+                              if guard is not None else result['sql'])
+                cursor = conn.cursor()
+                try:
+                    with guard.budget(conn, timeout_seconds=EXPORT_TIMEOUT_SECONDS,
+                                      max_vm_steps=EXPORT_MAX_VM_STEPS) if guard is not None else nullcontext():
+                        cursor.execute(sql_to_run, result['sql_params'])
+                        stored = session.store_cursor(
+                            result['question'], result['sql'], result['sql_params'], result['columns'], cursor,
+                            batch_size=EXPORT_BATCH_SIZE
+                        )
+                finally:
+                    cursor.close()
+        if not stored:
+            # Too large to copy, but "next page" can still seek through the query
+            stored = session.store_pages(
+                result['question'], result['sql'], result['sql_params'],
+                page_cursor_after(result['sql'], result['sql_params'], result['columns'], rows,
+                                  CONVERSATION_PAGE_SIZE)
+            )
+    except (sqlite3.Error, SQLGuardError):
+        # Follow-ups then start over with the full pipeline
+        session.clear()
+        stored = False
+    outcome = 'not_stored' if not stored else 'paged_only' if session.pages is not None else 'stored'
+    with _conversation_lock:
+        _conversation_stats[outcome] += 1
+
+def export_options(user_input):
+    """
+    Return (export_format, export_min_rows) for execute_sql_query: questions that ask for a
+    file are always exported, listing-style ones once they have more than EXPORT_MIN_ROWS rows
+    """
+    named_format, explicit = export_request(user_input)
+    if explicit is None:
+        return None, None
+    export_format = named_format if named_format in EXPORT_FORMATS else EXPORT_FORMAT
+    return export_format, 0 if explicit else EXPORT_MIN_ROWS
+
+def new_pipeline_result(user_input):
+    """
+    Create the empty result dict that the pipeline stages fill in; timings are in seconds
+    """
+    return {
+        'question': user_input,
+        'relevant': None,
+        'sql': None,
+        'sql_source': None,
+        'sql_params': (),
+        'columns': [],
+        'rows': [],
+        'export': None,
+        'next_cursor': None,
+        'response': None,
+        'response_source': None,
+        'result_tokens': None,
+        'result_tokens_saved': None,
+        'timings': {},
+        'trace_id': None
+    }
+
+def pipeline_result_to_dict(result):
+    """
+    Convert a pipeline result into a JSON-friendly dict
+    """
+    rows = result['rows']
+    return {
+        'question': result['question'],
+        'relevant': result['relevant'],
+        'sql': result['sql'],
+        'sql_source': result['sql_source'],
+        'sql_params': list(result['sql_params']),
+        'columns': result['columns'],
+        'rows': [list(row) for row in rows],
+        'row_count': len(rows),
+        'truncated': getattr(rows, 'truncated', False),
+        'total_count': getattr(rows, 'total_count', len(rows)),
+        'export': result['export'].to_dict() if result['export'] is not None else None,
+        'next_cursor': result['next_cursor'],
+        'answer': result['response'],
+        'response_source': result['response_source'],
+        'timings': result['timings'],
+        'trace_id': result['trace_id']
+    }
+
+UNRELATED_RESPONSE = (
+    "This query appears to be unrelated to the employee database. Please ask a question about employee data."
+)
+SQL_SOURCE_LABELS = {
+    'cache': "SQL Query (cache hit)", 'local': "SQL Query (local)", 'library': "SQL Query (verified)",
+    'followup': "SQL Query (follow-up)", 'followup_llm': "SQL Query (follow-up, generated)"
+}
+
+def format_pipeline_result(result):
+    """
+    Format a pipeline result the way the REPL shows it
+    """
+    if not result['relevant']:
+        return UNRELATED_RESPONSE
+
+    # Always show SQL query with response
+    return f"{format_sql(result)}\n\nResponse:\n{result['response']}"
+
+def format_sql(result):
+    """
+    Format the SQL of a pipeline result or sql event, labelled with where it came from
+    """
+    sql_label = SQL_SOURCE_LABELS.get(result['sql_source'], "SQL Query")
+    return f"{sql_label}:\n{render_sql(result['sql'], result['sql_params'])}"
+
+def format_row_count(event):
+    """
+    Format the row count of a rows event: "12", "1000 of 4200" or "1000+" when truncated
+    """
+    if not event['truncated']:
+        return str(event['row_count'])
+    if event['total_count'] is None:
+        return f"{event['row_count']}+"
+    return f"{event['row_count']} of {event['total_count']}"
+
+def get_pipeline_stats():
+    """
+    Collect statistics from the pipeline's caches and helpers
+    """
+    stats = {'connection_pool': get_connection_pool().stats()}
+    if LOCAL_SQL_ENABLED:
+        stats['local_sql'] = get_question_compiler().stats()
+    if LLM_CASSETTE_MODE != 'off':
+        stats['llm_cassette'] = get_cassette().stats()
+    if QUERY_LIBRARY_ENABLED:
+        stats['query_library'] = get_query_library().stats()
+    if LOCAL_RELEVANCE_ENABLED:
+        stats['relevance_classifier'] = get_relevance_classifier().stats()
+    if SQL_CACHE_ENABLED:
+        stats['sql_cache'] = get_query_cache().stats()
+    if RESULT_CACHE_ENABLED:
+        stats['result_cache'] = get_result_cache().stats()
+    if SQL_GUARD_ENABLED:
+        stats['sql_guard'] = get_sql_guard().stats()
+    if WORKLOAD_LOG_ENABLED:
+        stats['workload_log'] = get_workload_log().stats()
+    with _serialization_lock:
+        stats['result_serializer'] = dict(_serialization_stats)
+        stats['response_source'] = dict(_response_source_stats)
+    if SPECULATIVE_EXECUTION:
+        with _speculative_lock:
+            stats['speculative'] = dict(_speculative_stats)
+    if PRUNED_SQL_PROMPT:
+        stats['sql_prompt'] = get_prompt_builder().stats()
+    if EXPORT_ENABLED:
+        with _export_lock:
+            stats['export'] = dict(_export_stats)
+        stats['export']['rows_per_second'] = (
+            stats['export']['rows'] / stats['export']['seconds'] if stats['export']['seconds'] else 0.0
+        )
+    with _page_lock:
+        stats['result_pages'] = dict(_page_stats)
+    if CONVERSATION_ENABLED:
+        with _conversation_lock:
+            stats['conversation'] = dict(_conversation_stats)
+    if TRACING_ENABLED:
+        stats['metrics'] = metrics_registry.snapshot(include_buckets=False)
+    return stats
+
+def process_user_input(user_input, session=None):
+    """
+    Main function to process user input and return appropriate response.
+    With a session (see new_conversation) follow-up questions refine the previous result.
+    """
+    try:
+        return format_pipeline_result(run_conversation_turn(session, user_input))
     except Exception as e:
         return f"An error occurred: {str(e)}"
 
+def stream_user_input(user_input, session=None):
+    """
+    Streaming version of process_user_input: yield the REPL's output in pieces, the SQL as
+    soon as it is known, then the row count, then the response as it is generated
+    """
+    try:
+        for event in stream_pipeline(user_input, session):
+            if event['event'] == 'sql':
+                yield f"{format_sql(event)}\n\n"
+            elif event['event'] == 'rows':
+                yield f"Rows: {format_row_count(event)}\n\nResponse:\n"
+            elif event['event'] == 'token':
+                yield event['text']
+            elif not event['result']['relevant']:
+                yield UNRELATED_RESPONSE
+    except Exception as e:
+        yield f"\nAn error occurred: {str(e)}"
+
 if __name__ == "__main__":
     print("Welcome to the Employee Database Query System!")
+    print("Type 'stats' to show cache statistics")
     print("Type 'quit' to exit")
+    print("Type 'reset' to start a new conversation")
     print("\nWhat would you like to know about the employees?")
+    session = new_conversation()
     
     while True:
         user_input = input("\nEnter your question: ")
         if user_input.lower() == 'quit':
             break
+        if user_input.lower() == 'stats':
+            for name, values in get_pipeline_stats().items():
+                print(f"\n{name}: {values}")
+            if session is not None:
+                print(f"\nconversation_session: {session.stats()}")
+            continue
+        if user_input.lower() == 'reset':
+            if session is not None:
+                session.clear()
+            continue
         
-        response = process_user_input(user_input)
+        if STREAM_RESPONSES:
+            print()
+            for text in stream_user_input(user_input, session):
+                print(text, end='', flush=True)
+            print()
+            continue
+        response = process_user_input(user_input, session)
         print("\nResponse:", response) 
\ No newline at end of file
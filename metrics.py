@@ -0,0 +1,121 @@
+import bisect
+import threading
+
+# Bucket upper bounds for latencies in seconds and for counts such as tokens and rows
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (0, 1, 10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 100000)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram; percentiles are interpolated within the bucket they fall in
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, fraction):
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= target:
+                lower = self.buckets[index - 1] if index > 0 else self.min
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (target - seen) / bucket_count
+            seen += bucket_count
+        return self.max
+
+    def snapshot(self, include_buckets=True):
+        snapshot = {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(0.50),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99)
+        }
+        if include_buckets:
+            bounds = [str(bucket) for bucket in self.buckets] + ['+Inf']
+            snapshot['buckets'] = dict(zip(bounds, self.counts))
+        return snapshot
+
+
+def metric_key(name, labels):
+    if not labels:
+        return name
+    return name + '{' + ','.join(f'{key}={value}' for key, value in sorted(labels.items())) + '}'
+
+
+class MetricsRegistry:
+    """
+    Thread-safe in-process registry of counters and histograms, keyed on name and labels
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = metric_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = metric_key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def observe_trace(self, trace):
+        """
+        Record a finished pipeline trace (as returned by PipelineTrace.to_dict)
+        """
+        status = 'error' if trace['error'] else 'ok'
+        self.increment('pipeline_requests', status=status, path=trace['path'])
+        self.observe('pipeline_seconds', trace['total_seconds'], path=trace['path'])
+        for stage, seconds in trace['stages'].items():
+            self.observe('pipeline_stage_seconds', seconds, stage=stage)
+        for call in trace['llm_calls']:
+            self.increment('llm_calls', stage=call['stage'])
+            self.increment('llm_retries', call['retries'], stage=call['stage'])
+            self.increment('llm_prompt_tokens', call['prompt_tokens'], stage=call['stage'])
+            self.increment('llm_completion_tokens', call['completion_tokens'], stage=call['stage'])
+            self.observe('llm_call_seconds', call['seconds'], stage=call['stage'])
+        for cache, hit in trace['cache'].items():
+            if hit is not None:
+                self.increment('cache_lookups', cache=cache, result='hit' if hit else 'miss')
+        if trace['rows'] is not None:
+            self.observe('pipeline_rows', trace['rows'], buckets=COUNT_BUCKETS)
+
+    def snapshot(self, include_buckets=True):
+        with self._lock:
+            return {
+                'counters': dict(self._counters),
+                'histograms': {
+                    key: histogram.snapshot(include_buckets) for key, histogram in self._histograms.items()
+                }
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
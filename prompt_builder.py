@@ -0,0 +1,283 @@
+import sqlite3
+import threading
+from query_cache import database_stamp
+from relevance_classifier import STOPWORDS, stem, tokenize
+from result_serializer import estimate_tokens
+
+SQL_PROMPT_HEADER = "You are an SQL expert. Generate a SQLite query for the following user request."
+SQL_PROMPT_FOOTER = "Respond with ONLY the SQL query, nothing else."
+
+# Question words that point at a column without naming it
+COLUMN_SYNONYMS = {
+    'salary': {'pay', 'paid', 'earn', 'earner', 'earning', 'compensation', 'wage', 'payroll', 'income'},
+    'manager_id': {'manager', 'boss', 'report', 'reporting', 'team', 'supervisor', 'subordinate'},
+    'management_level': {'level', 'senior', 'seniority', 'executive', 'junior'},
+    'hire_date': {'hired', 'hire', 'joined', 'started', 'tenure', 'recent', 'newest', 'oldest', 'year'},
+    'department': {'dept', 'team', 'division'},
+    'job_title': {'title', 'role', 'position', 'job'},
+    'email': {'contact', 'mail'},
+    'phone_number': {'contact', 'phone', 'call'},
+    'annual_leave_balance': {'leave', 'vacation', 'pto', 'holiday', 'annual'},
+    'sick_leave_balance': {'leave', 'sick'},
+    'last_promotion_date': {'promoted', 'promotion'},
+    'performance_rating': {'performer', 'performance', 'rated', 'rating', 'review', 'best', 'top'},
+    'descendant_id': {'under', 'below', 'beneath', 'everyone', 'indirect', 'indirectly', 'org'},
+    'ancestor_id': {'above', 'chain', 'over'},
+    'depth': {'level', 'deep', 'layer', 'indirect', 'indirectly'},
+    'direct_reports': {'directly', 'span'},
+    'headcount': {'many', 'number', 'size', 'people', 'staff', 'count'}
+}
+
+AGGREGATE_WORDS = {'many', 'count', 'number', 'average', 'avg', 'mean', 'total', 'sum', 'headcount', 'payroll',
+                   'size', 'biggest', 'largest', 'smallest'}
+
+# Tables derived from the others by setup_database: listed only when the question hits
+# every word set, and left out of the whole-schema fallback
+DERIVED_TABLES = {
+    'employee_hierarchy': [{'under', 'below', 'beneath', 'chain', 'hierarchy', 'indirect', 'indirectly',
+                            'org', 'everyone', 'downline', 'subordinate'}],
+    'department_summary': [{'department', 'dept', 'division'}, AGGREGATE_WORDS],
+    'manager_summary': [{'manager', 'boss', 'report', 'supervisor', 'team'}, AGGREGATE_WORDS]
+}
+
+# Columns whose distinct values are listed in the prompt when they are few enough
+VALUE_COLUMNS = {'employees': ['department', 'job_title']}
+
+# Trimmed rules: (name, trigger words, text). Core rules are always included;
+# the others only when the question or the chosen tables call for them.
+CORE_RULES = """Rules:
+- Write a single read-only SELECT statement for SQLite.
+- Alias tables (e, s) and name the columns you return; avoid SELECT *.
+- Return only the columns the question needs, plus names when listing employees."""
+
+OPTIONAL_RULES = [
+    ('joins', set(), """- Join employee_stats on employee_id only when leave or performance data is needed.
+- Use INNER JOIN for employees that have stats, LEFT JOIN to keep every employee."""),
+    ('rollups', set(),
+     """- department_summary and manager_summary hold precomputed headcount, salary and rating totals and averages;
+  read them instead of aggregating employees."""),
+    ('aggregation', {'many', 'count', 'number', 'average', 'avg', 'total', 'sum', 'each', 'per', 'mean'},
+     """- Aggregate with COUNT/SUM/AVG/MIN/MAX and GROUP BY the category column.
+- Filter aggregated groups with HAVING, not WHERE."""),
+    ('ranking', {'top', 'highest', 'lowest', 'best', 'worst', 'most', 'least', 'rank', 'largest', 'smallest'},
+     """- For "top N" use ORDER BY ... DESC LIMIT N; per group use ROW_NUMBER() OVER (PARTITION BY ...)."""),
+    ('dates', {'hired', 'date', 'year', 'month', 'since', 'before', 'after', 'recent', 'ago', 'promoted', 'joined'},
+     """- Dates are ISO text (YYYY-MM-DD); compare them as strings or with date('now', '-1 year') and strftime()."""),
+    ('nulls', {'missing', 'never', 'without', 'null', 'none', 'no'},
+     """- Check for missing values with IS NULL / IS NOT NULL and use COALESCE for defaults."""),
+    ('comparison', {'above', 'below', 'than', 'compared', 'versus', 'vs'},
+     """- Compare against group averages with a correlated subquery or a CTE (WITH ... AS)."""),
+    ('hierarchy', {'manager', 'boss', 'report', 'reporting', 'team', 'subordinate', 'chain', 'under', 'hierarchy'},
+     """- manager_id references employees.employee_id; self-join employees (e, m) to get manager names.
+- For everyone under a manager at any depth, join employee_hierarchy (ancestor_id = manager, depth > 0).""")
+]
+
+
+def _column_words(column):
+    return {stem(word) for word in column.lower().split('_') if word not in ('id',)}
+
+
+class PromptBuild:
+    """
+    A system prompt assembled for one question, with its token estimate against the static prompt
+    """
+
+    def __init__(self, text, tables, rules, tokens, baseline_tokens):
+        self.text = text
+        self.tables = tables
+        self.rules = rules
+        self.tokens = tokens
+        self.baseline_tokens = baseline_tokens
+
+    @property
+    def tokens_saved(self):
+        return max(0, self.baseline_tokens - self.tokens)
+
+
+class SchemaPromptBuilder:
+    """
+    Builds SQL generation prompts from the live database schema.
+
+    The schema is read once from PRAGMA table_info and PRAGMA foreign_key_list and
+    cached until the database file changes. Each prompt lists only the tables and
+    columns the question points at (falling back to the whole schema when nothing
+    matches) and adds the trimmed rules it triggers within rules_token_budget.
+    """
+
+    def __init__(self, db_path, baseline_prompt='', rules_token_budget=200, max_listed_values=12):
+        self.db_path = db_path
+        self.baseline_tokens = estimate_tokens(baseline_prompt)
+        self.rules_token_budget = rules_token_budget
+        self.max_listed_values = max_listed_values
+        self._lock = threading.Lock()
+        self._schema = None
+        self._schema_stamp = None
+        self.prompts = 0
+        self.pruned = 0
+        self.prompt_tokens = 0
+        self.tokens_saved = 0
+
+    def schema(self):
+        """
+        Return {table: {'columns': [(name, type, is_pk)], 'foreign_keys': {column: (table, column)},
+        'values': {column: [...]}}}, re-reading it only when the database file changes
+        """
+        stamp = database_stamp(self.db_path)
+        with self._lock:
+            if self._schema is not None and stamp == self._schema_stamp:
+                return self._schema
+        schema = self._introspect()
+        with self._lock:
+            self._schema = schema
+            self._schema_stamp = stamp
+        return schema
+
+    def _introspect(self):
+        conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+        try:
+            tables = [row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+            )]
+            schema = {}
+            for table in tables:
+                columns = [(row[1], row[2] or 'TEXT', bool(row[5]))
+                           for row in conn.execute(f'PRAGMA table_info("{table}")')]
+                foreign_keys = {row[3]: (row[2], row[4])
+                                for row in conn.execute(f'PRAGMA foreign_key_list("{table}")')}
+                values = {}
+                for column in VALUE_COLUMNS.get(table, []):
+                    if column not in {name for name, _, _ in columns}:
+                        continue
+                    rows = conn.execute(
+                        f'SELECT DISTINCT "{column}" FROM "{table}" WHERE "{column}" IS NOT NULL LIMIT ?',
+                        (self.max_listed_values + 1,)
+                    ).fetchall()
+                    if len(rows) <= self.max_listed_values:
+                        values[column] = sorted(str(value) for (value,) in rows)
+                schema[table] = {'columns': columns, 'foreign_keys': foreign_keys, 'values': values}
+            return schema
+        finally:
+            conn.close()
+
+    def refresh(self):
+        with self._lock:
+            self._schema = None
+
+    def relevant_columns(self, user_input, schema):
+        """
+        Return {table: set(columns)} for the columns the question names, hints at or quotes a value of
+        """
+        words = {token for token in tokenize(user_input) if token not in STOPWORDS}
+        all_words = set(tokenize(user_input))
+        all_table_words = {table: {stem(word) for word in table.lower().split('_')} for table in schema}
+        matches = {}
+        for table, info in schema.items():
+            if table in DERIVED_TABLES:
+                if not all(all_words & {stem(word) for word in triggers} for triggers in DERIVED_TABLES[table]):
+                    continue
+                matches[table] = set()
+            # A table is named by the words no other table name shares, e.g. "stats" for employee_stats
+            shared = set().union(*(words_ for other, words_ in all_table_words.items() if other != table))
+            table_words = (all_table_words[table] - shared) or all_table_words[table]
+            for name, _, is_pk in info['columns']:
+                if is_pk:
+                    continue
+                hints = _column_words(name) | {stem(word) for word in COLUMN_SYNONYMS.get(name, ())}
+                value_words = {
+                    token for value in info['values'].get(name, []) for token in tokenize(value)
+                } - STOPWORDS
+                if words & (hints | value_words):
+                    matches.setdefault(table, set()).add(name)
+            if words & table_words and table not in matches:
+                matches[table] = set()
+        return matches
+
+    def select_tables(self, matches, schema):
+        """
+        Add the tables the matched tables reference, so rows can be joined back to names
+        """
+        selected = list(matches)
+        for table in list(selected):
+            for referenced_table, _ in schema[table]['foreign_keys'].values():
+                if referenced_table in schema and referenced_table not in selected:
+                    selected.append(referenced_table)
+        return [table for table in schema if table in selected]
+
+    def describe_table(self, table, info, relevant, full):
+        """
+        Describe a table: keys, name-like and relevant columns with their types, the rest by name only
+        """
+        lines = [f"{table} table:"]
+        others = []
+        for name, column_type, is_pk in info['columns']:
+            detail = f"{column_type}{' PRIMARY KEY' if is_pk else ''}"
+            if name in info['foreign_keys']:
+                referenced_table, referenced_column = info['foreign_keys'][name]
+                detail += f", references {referenced_table}.{referenced_column}"
+            if full or is_pk or name in info['foreign_keys'] or name in relevant or 'name' in name:
+                line = f"- {name} ({detail})"
+                if name in info['values'] and (full or name in relevant):
+                    line += f" values: {', '.join(info['values'][name])}"
+                lines.append(line)
+            else:
+                others.append(name)
+        if others:
+            lines.append(f"- other columns: {', '.join(others)}")
+        return '\n'.join(lines)
+
+    def select_rules(self, user_input, tables):
+        words = {token for token in tokenize(user_input)}
+        budget = self.rules_token_budget - estimate_tokens(CORE_RULES)
+        chosen = []
+        for name, triggers, text in OPTIONAL_RULES:
+            if name == 'joins':
+                triggered = len(tables) > 1
+            elif name == 'rollups':
+                triggered = any(table.endswith('_summary') for table in tables)
+            else:
+                triggered = bool(words & {stem(word) for word in triggers})
+            if not triggered:
+                continue
+            cost = estimate_tokens(text)
+            if cost > budget:
+                continue
+            budget -= cost
+            chosen.append((name, text))
+        return chosen
+
+    def build(self, user_input, include_rules=True):
+        """
+        Assemble the SQL generation system prompt for a question; without include_rules
+        only the core rules are added
+        """
+        schema = self.schema()
+        matches = self.relevant_columns(user_input, schema)
+        full = not matches
+        tables = [table for table in schema if table not in DERIVED_TABLES] if full else \
+            self.select_tables(matches, schema)
+        rules = self.select_rules(user_input, tables) if include_rules else []
+
+        sections = [SQL_PROMPT_HEADER, "Schema:"]
+        sections += [self.describe_table(table, schema[table], matches.get(table, set()), full)
+                     for table in tables]
+        sections.append('\n'.join([CORE_RULES] + [text for _, text in rules]))
+        sections.append(SQL_PROMPT_FOOTER)
+        text = '\n\n'.join(sections)
+        build = PromptBuild(text, tables, [name for name, _ in rules], estimate_tokens(text), self.baseline_tokens)
+
+        with self._lock:
+            self.prompts += 1
+            self.pruned += int(not full)
+            self.prompt_tokens += build.tokens
+            self.tokens_saved += build.tokens_saved
+        return build
+
+    def stats(self):
+        with self._lock:
+            return {
+                'prompts': self.prompts,
+                'pruned': self.pruned,
+                'average_prompt_tokens': self.prompt_tokens / self.prompts if self.prompts else 0.0,
+                'baseline_prompt_tokens': self.baseline_tokens,
+                'tokens_saved': self.tokens_saved
+            }
@@ -0,0 +1,235 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# Number literals are pulled out of the question so that "top 5" and "top 3"
+# share one cache entry
+NUMBER_PATTERN = re.compile(r'(?<![\w.])\d+(?:\.\d+)?(?![\w.])')
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s<>]")
+WHITESPACE_PATTERN = re.compile(r'\s+')
+NUMBER_TOKEN = '<num>'
+
+
+def normalize_question(user_input):
+    """
+    Normalize a question for cache lookups.
+    Returns the normalized text and the number literals that were pulled out of it.
+    """
+    text = user_input.lower()
+    params = NUMBER_PATTERN.findall(text)
+    text = NUMBER_PATTERN.sub(f' {NUMBER_TOKEN} ', text)
+    text = text.replace("'", '')
+    text = PUNCTUATION_PATTERN.sub(' ', text)
+    text = WHITESPACE_PATTERN.sub(' ', text).strip()
+    return text, params
+
+
+def question_key(user_input):
+    """
+    Normalize a question but keep its number literals, so only questions
+    asking for exactly the same thing share a key
+    """
+    return _literal_key(*normalize_question(user_input))
+
+
+def _literal_key(normalized, params):
+    """
+    Build the cache key that keeps the number literals in place
+    """
+    parts = normalized.split(NUMBER_TOKEN)
+    key = parts[0]
+    for value, part in zip(params, parts[1:]):
+        key += value + part
+    return key
+
+
+def _param_pattern(value):
+    return re.compile(r'(?<![\w.])' + re.escape(value) + r'(?![\w.])')
+
+
+def _param_marker(index):
+    return '{{n%d}}' % index
+
+
+def _templatize(sql, params):
+    """
+    Replace the question's number literals in the SQL with markers.
+    Returns None when a literal is missing or ambiguous in the SQL.
+    """
+    if len(set(params)) != len(params):
+        return None
+    template = sql
+    for index, value in enumerate(params):
+        pattern = _param_pattern(value)
+        if len(pattern.findall(template)) != 1:
+            return None
+        template = pattern.sub(_param_marker(index), template)
+    return template
+
+
+def _render(template, params):
+    sql = template
+    for index, value in enumerate(params):
+        sql = sql.replace(_param_marker(index), value)
+    return sql
+
+
+def database_stamp(db_path):
+    """
+    Size and modification time of the database file and its WAL. In WAL mode writes,
+    schema changes included, reach the main file only at checkpoints.
+    """
+    stat = os.stat(db_path)
+    try:
+        wal = os.stat(db_path + '-wal')
+        wal_stamp = (wal.st_mtime_ns, wal.st_size)
+    except FileNotFoundError:
+        wal_stamp = None
+    return stat.st_mtime_ns, stat.st_size, wal_stamp
+
+
+def compute_schema_hash(db_path):
+    """
+    Hash the DDL of every table, view and trigger in the database.
+    Indexes are left out: adding one does not change which SQL is valid.
+    """
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        rows = conn.execute(
+            "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND type != 'index' "
+            "ORDER BY type, name"
+        ).fetchall()
+    finally:
+        conn.close()
+    digest = hashlib.sha256()
+    for row in rows:
+        digest.update(repr(row).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class QueryCache:
+    """
+    Persistent question -> SQL cache stored in SQLite.
+
+    Entries are evicted least-recently-used once max_entries is exceeded,
+    expire after ttl_seconds, and are dropped whenever the schema hash of
+    the employee database changes.
+    """
+
+    def __init__(self, cache_path, db_path, max_entries=1000, ttl_seconds=7 * 24 * 3600):
+        self.cache_path = cache_path
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._schema_hash = None
+        self._schema_stamp = None
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS sql_cache (
+            cache_key TEXT PRIMARY KEY,
+            schema_hash TEXT NOT NULL,
+            sql TEXT NOT NULL,
+            is_template INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER DEFAULT 0
+        )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_sql_cache_last_used ON sql_cache (last_used_at)')
+        self._conn.commit()
+
+    def schema_hash(self):
+        """
+        Return the current schema hash, recomputing it only when the database file changes
+        """
+        stamp = database_stamp(self.db_path)
+        if stamp != self._schema_stamp:
+            schema_hash = compute_schema_hash(self.db_path)
+            if schema_hash != self._schema_hash:
+                with self._lock:
+                    self._conn.execute('DELETE FROM sql_cache WHERE schema_hash != ?', (schema_hash,))
+                    self._conn.commit()
+            self._schema_hash = schema_hash
+            self._schema_stamp = stamp
+        return self._schema_hash
+
+    def get(self, user_input):
+        """
+        Return the cached SQL for a question, or None on a miss
+        """
+        normalized, params = normalize_question(user_input)
+        schema_hash = self.schema_hash()
+        now = time.time()
+        with self._lock:
+            for key in dict.fromkeys([normalized, _literal_key(normalized, params)]):
+                row = self._conn.execute(
+                    'SELECT sql, is_template, created_at FROM sql_cache WHERE cache_key = ? AND schema_hash = ?',
+                    (key, schema_hash)
+                ).fetchone()
+                if row is None:
+                    continue
+                sql, is_template, created_at = row
+                if now - created_at > self.ttl_seconds:
+                    self._conn.execute('DELETE FROM sql_cache WHERE cache_key = ?', (key,))
+                    self._conn.commit()
+                    continue
+                self._conn.execute(
+                    'UPDATE sql_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?',
+                    (now, key)
+                )
+                self._conn.commit()
+                self.hits += 1
+                return _render(sql, params) if is_template else sql
+            self.misses += 1
+        return None
+
+    def put(self, user_input, sql):
+        """
+        Store the SQL generated for a question
+        """
+        normalized, params = normalize_question(user_input)
+        template = _templatize(sql, params)
+        if template is not None:
+            key, stored_sql, is_template = normalized, template, bool(params)
+        else:
+            key, stored_sql, is_template = _literal_key(normalized, params), sql, False
+        schema_hash = self.schema_hash()
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sql_cache '
+                '(cache_key, schema_hash, sql, is_template, created_at, last_used_at, hits) '
+                'VALUES (?, ?, ?, ?, ?, ?, 0)',
+                (key, schema_hash, stored_sql, int(is_template), now, now)
+            )
+            self._conn.execute(
+                'DELETE FROM sql_cache WHERE created_at < ?', (now - self.ttl_seconds,)
+            )
+            self._conn.execute('''
+            DELETE FROM sql_cache WHERE cache_key IN (
+                SELECT cache_key FROM sql_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+            ''', (self.max_entries,))
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute('DELETE FROM sql_cache')
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute('SELECT COUNT(*) FROM sql_cache').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'entries': entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
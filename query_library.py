@@ -0,0 +1,254 @@
+import argparse
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+from query_cache import question_key
+from relevance_classifier import STOPWORDS, tokenize
+
+# Stopwords that still decide the shape of the SQL ("most" vs "least", "by department")
+SHAPE_WORDS = {'by', 'each', 'many', 'more', 'most', 'much', 'per', 'than'}
+
+# Verified pairs every library starts with. None of them is a test_system SQL generation case,
+# so replayed SQL generation is not handed its own answer as an example
+SEED_EXAMPLES = [
+    ("Who are the 5 most recently hired employees?",
+     "SELECT first_name, last_name, hire_date FROM employees ORDER BY hire_date DESC LIMIT 5"),
+    ("Which employees have the most annual leave left?",
+     "SELECT e.first_name, e.last_name, s.annual_leave_balance FROM employees e "
+     "JOIN employee_stats s ON e.employee_id = s.employee_id ORDER BY s.annual_leave_balance DESC LIMIT 10"),
+    ("What is the total salary cost per job title?",
+     "SELECT job_title, SUM(salary) AS total_salary FROM employees GROUP BY job_title"),
+    ("Who reports to Jane Smith?",
+     "SELECT e.first_name, e.last_name, e.job_title FROM employees e "
+     "JOIN employees m ON e.manager_id = m.employee_id WHERE m.first_name = 'Jane' AND m.last_name = 'Smith'"),
+    ("Which employees were hired in the last year?",
+     "SELECT first_name, last_name, hire_date FROM employees WHERE hire_date >= date('now', '-1 year') "
+     "ORDER BY hire_date DESC"),
+    ("How many employees are in each department?",
+     "SELECT department, COUNT(*) AS employee_count FROM employees GROUP BY department"),
+    ("Which employees earn more than their department average?",
+     "SELECT e.first_name, e.last_name, e.department, e.salary FROM employees e "
+     "WHERE e.salary > (SELECT AVG(salary) FROM employees WHERE department = e.department)"),
+    ("List the top 3 performers in each department",
+     "SELECT department, first_name, last_name, performance_rating FROM ("
+     "SELECT e.department, e.first_name, e.last_name, s.performance_rating, "
+     "ROW_NUMBER() OVER (PARTITION BY e.department ORDER BY s.performance_rating DESC) AS rank "
+     "FROM employees e JOIN employee_stats s ON e.employee_id = s.employee_id) WHERE rank <= 3")
+]
+
+
+def question_grams(question, size=3):
+    """
+    Character n-grams of the question's significant words, each padded so word starts and ends count
+    """
+    grams = set()
+    for token in tokenize(question):
+        if token in STOPWORDS and token not in SHAPE_WORDS:
+            continue
+        padded = f' {token} '
+        grams.update(padded[index:index + size] for index in range(max(1, len(padded) - size + 1)))
+    return grams
+
+
+class QueryLibrary:
+    """
+    Persistent library of verified question -> SQL pairs stored in SQLite.
+
+    The pairs are held in memory with an inverted index from character n-grams
+    to entries. lookup() finds a verified question asked again (same normalized
+    text, same numbers) in a dict. nearest() gathers candidates from the
+    question's rarest n-grams first, reading at most posting_budget postings,
+    and scores only the best candidates on all their n-grams, so both stay well
+    under a millisecond with tens of thousands of pairs.
+    """
+
+    def __init__(self, path, gram_size=3, posting_budget=2000, seed=True):
+        self.path = path
+        self.gram_size = gram_size
+        self.posting_budget = posting_budget
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('''
+        CREATE TABLE IF NOT EXISTS verified_queries (
+            question_key TEXT PRIMARY KEY,
+            question TEXT NOT NULL,
+            sql TEXT NOT NULL,
+            source TEXT NOT NULL,
+            verified_at REAL NOT NULL
+        )
+        ''')
+        if seed:
+            # Seed pairs follow SEED_EXAMPLES; pairs verified by hand are left alone
+            seeds = {question_key(question): (question, sql) for question, sql in SEED_EXAMPLES}
+            stored = self._conn.execute("SELECT question_key FROM verified_queries WHERE source = 'seed'").fetchall()
+            self._conn.executemany('DELETE FROM verified_queries WHERE question_key = ?',
+                                   [(key,) for key, in stored if key not in seeds])
+            self._conn.executemany(
+                "INSERT INTO verified_queries (question_key, question, sql, source, verified_at) "
+                "VALUES (?, ?, ?, 'seed', ?) ON CONFLICT (question_key) DO UPDATE SET sql = excluded.sql "
+                "WHERE source = 'seed'",
+                [(key, question, sql, time.time()) for key, (question, sql) in seeds.items()]
+            )
+        self._conn.commit()
+        self._keys = {}
+        self._entries = []
+        self._postings = {}
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self.lookups = 0
+        for key, question, sql in self._conn.execute(
+            'SELECT question_key, question, sql FROM verified_queries ORDER BY rowid'
+        ):
+            self._index(key, question, sql)
+
+    def _index(self, key, question, sql):
+        entry_id = self._keys.get(key)
+        grams = question_grams(question, self.gram_size)
+        if entry_id is not None:
+            old_grams = self._entries[entry_id][2]
+            for gram in old_grams:
+                self._postings[gram].remove(entry_id)
+            self._entries[entry_id] = (question, sql, grams)
+        else:
+            entry_id = len(self._entries)
+            self._keys[key] = entry_id
+            self._entries.append((question, sql, grams))
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(entry_id)
+
+    def add(self, question, sql, source='manual'):
+        self.add_many([(question, sql)], source)
+
+    def add_many(self, pairs, source='manual'):
+        """
+        Store verified (question, sql) pairs; a question already in the library gets the new SQL
+        """
+        now = time.time()
+        rows = [(question_key(question), question, sql.strip(), source, now) for question, sql in pairs]
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO verified_queries (question_key, question, sql, source, verified_at) '
+                'VALUES (?, ?, ?, ?, ?)', rows
+            )
+            self._conn.commit()
+            for key, question, sql, _, _ in rows:
+                self._index(key, question, sql)
+
+    def _record(self, kind, seconds):
+        with self._lock:
+            setattr(self, kind, getattr(self, kind) + 1)
+            self.lookups += 1
+            self.lookup_seconds += seconds
+
+    def lookup(self, question):
+        """
+        Return the verified SQL for the question, or None when it has not been verified
+        """
+        start = time.perf_counter()
+        with self._lock:
+            entry_id = self._keys.get(question_key(question))
+            sql = self._entries[entry_id][1] if entry_id is not None else None
+        if sql is not None:
+            self._record('exact_hits', time.perf_counter() - start)
+        return sql
+
+    def nearest(self, question, k=3, min_similarity=0.4):
+        """
+        Return up to k (similarity, question, sql) for the most similar verified questions,
+        best first; similarity is the Dice coefficient of the n-gram sets. The question's
+        own entry is left out: lookup() already answers it, and as an example it would
+        hand the model the answer.
+        """
+        start = time.perf_counter()
+        grams = question_grams(question, self.gram_size)
+        with self._lock:
+            own_id = self._keys.get(question_key(question))
+            postings = sorted((self._postings[gram] for gram in grams if self._postings.get(gram)), key=len)
+            overlaps = Counter()
+            budget = self.posting_budget
+            for entries in postings:
+                # The rarest gram is always read, truncated if need be, so common words still find candidates
+                if budget <= 0:
+                    break
+                overlaps.update(entries[:budget])
+                budget -= len(entries)
+            scored = []
+            overlaps.pop(own_id, None)
+            for entry_id, _ in overlaps.most_common(k * 20):
+                entry_question, sql, entry_grams = self._entries[entry_id]
+                # Score on every gram, including the common ones skipped when gathering candidates
+                similarity = 2 * len(grams & entry_grams) / (len(grams) + len(entry_grams))
+                if similarity >= min_similarity:
+                    scored.append((similarity, entry_question, sql))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        self._record('similar_hits' if scored else 'misses', time.perf_counter() - start)
+        return scored[:k]
+
+    def entries(self):
+        with self._lock:
+            return [(question, sql) for question, sql, _ in self._entries]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'exact_hits': self.exact_hits,
+                'similar_hits': self.similar_hits,
+                'misses': self.misses,
+                'average_lookup_ms': self.lookup_seconds / self.lookups * 1000 if self.lookups else 0.0
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the library of verified question/SQL pairs")
+    parser.add_argument('--library', default='query_library.db', help="location of the library database")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add_parser = commands.add_parser('add', help="add one verified pair")
+    add_parser.add_argument('question')
+    add_parser.add_argument('sql')
+
+    import_parser = commands.add_parser('import', help="add pairs from a JSON lines file of {question, sql}")
+    import_parser.add_argument('path')
+
+    search_parser = commands.add_parser('search', help="show the verified pairs closest to a question")
+    search_parser.add_argument('question')
+    search_parser.add_argument('-k', type=int, default=3)
+
+    commands.add_parser('list', help="list the verified pairs")
+
+    args = parser.parse_args(argv)
+    library = QueryLibrary(args.library)
+    try:
+        if args.command == 'add':
+            library.add(args.question, args.sql)
+            print(f"Added: {args.question}")
+        elif args.command == 'import':
+            with open(args.path, encoding='utf-8') as f:
+                records = [json.loads(line) for line in f if line.strip()]
+            pairs = [(record['question'], record['sql']) for record in records]
+            library.add_many(pairs, source='import')
+            print(f"Imported {len(pairs)} pairs")
+        elif args.command == 'search':
+            exact = library.lookup(args.question)
+            if exact is not None:
+                print(f"Exact match:\n  {exact}")
+            for similarity, question, sql in library.nearest(args.question, k=args.k, min_similarity=0.0):
+                print(f"{similarity:.2f}  {question}\n      {sql}")
+        else:
+            for question, sql in library.entries():
+                print(f"{question}\n    {sql}")
+    finally:
+        library.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+import re
+import sqlite3
+import threading
+from query_cache import database_stamp
+
+# Numeric columns questions can rank, average or compare on, and the phrases that name them
+METRICS = {
+    'salary': ('employees', 'salary', ['salary', 'salaries', 'pay', 'compensation']),
+    'performance_rating': ('employee_stats', 'performance_rating',
+                           ['performance rating', 'performance ratings', 'performance', 'rating', 'ratings']),
+    'annual_leave_balance': ('employee_stats', 'annual_leave_balance',
+                             ['annual leave', 'vacation days', 'vacation', 'annual leave balance']),
+    'sick_leave_balance': ('employee_stats', 'sick_leave_balance',
+                           ['sick leave', 'sick days', 'sick leave balance'])
+}
+
+# Nouns for "top N earners" style questions, mapped to the metric they rank on
+RANKED_NOUNS = {
+    'earners': 'salary',
+    'paid employees': 'salary',
+    'performers': 'performance_rating',
+    'rated employees': 'performance_rating'
+}
+
+NUMBER_WORDS = {
+    'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5,
+    'six': 6, 'seven': 7, 'eight': 8, 'nine': 9, 'ten': 10, 'twenty': 20
+}
+
+HIGH_WORDS = {'highest', 'most', 'best', 'biggest', 'largest', 'top'}
+LOW_WORDS = {'lowest', 'least', 'worst', 'smallest', 'fewest', 'bottom'}
+
+LEADING_WORDS = re.compile(r'^(?:please\s+)?(?:(?:can|could) you\s+)?(?:please\s+)?')
+TRAILING_PUNCTUATION = re.compile(r'[\s?.!]+$')
+WHITESPACE = re.compile(r'\s+')
+
+
+class CompiledQuery:
+    """
+    Parameterized SQL compiled from a question, with the name of the template that matched
+    """
+
+    def __init__(self, template, sql, params):
+        self.template = template
+        self.sql = sql
+        self.params = tuple(params)
+
+
+def normalize_question(question):
+    question = WHITESPACE.sub(' ', question.strip().lower())
+    question = TRAILING_PUNCTUATION.sub('', question)
+    return LEADING_WORDS.sub('', question)
+
+
+def render_sql(sql, params):
+    """
+    Inline params into SQL as literals, for display and for logs that keep SQL text only
+    """
+    if not params:
+        return sql
+    values = iter(params)
+
+    def literal(_):
+        value = next(values)
+        if value is None:
+            return 'NULL'
+        if isinstance(value, (int, float)):
+            return repr(value)
+        return "'" + str(value).replace("'", "''") + "'"
+    return re.sub(r'\?', literal, sql)
+
+
+def _alternation(phrases):
+    # Longest first, so "performance rating" wins over "performance"
+    return '|'.join(re.escape(phrase) for phrase in sorted(phrases, key=len, reverse=True))
+
+
+class QuestionCompiler:
+    """
+    Compiles common question shapes straight to parameterized SQL, without the LLM.
+
+    Questions are normalized and matched in full against a small grammar built
+    from the schema vocabulary: metric columns that exist in the database and the
+    department names stored in it (re-read when the database file changes). A
+    question that does not match a template exactly compiles to None and is left
+    to the relevance check and GPT-3.5.
+    """
+
+    def __init__(self, db_path, max_top_n=100):
+        self.db_path = db_path
+        self.max_top_n = max_top_n
+        self._lock = threading.Lock()
+        self._grammar = None
+        self._stamp = None
+        self.hits = 0
+        self.misses = 0
+        self.templates = {}
+
+    def _load_vocabulary(self):
+        conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+        try:
+            columns = {}
+            for table in {table for table, _, _ in METRICS.values()} | {'employees'}:
+                columns[table] = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+            departments = []
+            if 'department' in columns['employees']:
+                departments = [row[0] for row in conn.execute(
+                    'SELECT DISTINCT department FROM employees WHERE department IS NOT NULL'
+                )]
+        finally:
+            conn.close()
+        metrics = {name: spec for name, spec in METRICS.items() if spec[1] in columns.get(spec[0], set())}
+        return metrics, departments
+
+    def _build_grammar(self, metrics, departments):
+        phrases = {phrase: name for name, (_, _, names) in metrics.items() for phrase in names}
+        ranked = {noun: name for noun, name in RANKED_NOUNS.items() if name in metrics}
+        departments = {department.lower(): department for department in departments}
+        metric = f"(?P<metric>{_alternation(phrases)})" if phrases else r'(?!x)x'
+        noun = f"(?P<noun>{_alternation(ranked)})" if ranked else r'(?!x)x'
+        department = f"(?P<department>{_alternation(departments)})" if departments else r'(?!x)x'
+        extreme = f"(?P<direction>{_alternation(HIGH_WORDS | LOW_WORDS)})"
+        count = f"(?P<count>\\d+|{_alternation(NUMBER_WORDS)})"
+        in_department = f"(?:in|from|of) (?:the )?{department}(?: department| team)?"
+        patterns = [
+            ('count_employees',
+             r'how many employees (?:are there|do we have|work here|are employed)'),
+            ('count_in_department',
+             f"how many (?:employees|people) (?:are there |work |are )?{in_department}"),
+            ('employees_in_department',
+             f"(?:(?:show|list|give|find|get)(?: me)? |who are |which employees are )?"
+             f"(?:all )?(?:the )?(?:employees|people|staff) {in_department}"),
+            ('extreme_metric',
+             f"(?:who|which employee|which employees) (?:has|have|gets|get|earns|earn) "
+             f"the {extreme} {metric}"),
+            ('extreme_metric',
+             f"who (?:is|are) the {extreme} (?P<noun_metric>paid|rated)(?: employees?)?"),
+            ('average_by_department',
+             f"(?:what is |what's |what are |show(?: me)? |list )?(?:the )?(?:average|avg|mean) {metric} "
+             f"(?:by|per|for each|in each|across|of each) department(?:s)?"),
+            ('average_in_department',
+             f"(?:what is |what's |show(?: me)? )?(?:the )?(?:average|avg|mean) {metric} {in_department}"),
+            ('average_metric',
+             f"(?:what is |what's |show(?: me)? )?(?:the )?(?:average|avg|mean) {metric}"
+             f"(?: of (?:all )?(?:the )?employees| across the company| overall)?"),
+            ('top_n',
+             f"(?:(?:show|list|give|find|get)(?: me)? |who are |what are )?(?:the )?"
+             f"(?P<edge>top|bottom) {count} (?:employees )?(?:by|ranked by|with the highest|on) {metric}"),
+            ('top_n',
+             f"(?:(?:show|list|give|find|get)(?: me)? |who are |what are )?(?:the )?"
+             f"(?P<edge>top|bottom) {count} {noun}"),
+            ('top_n',
+             f"(?:(?:show|list|give|find|get)(?: me)? |who are |what are )?(?:the )?"
+             f"{count} (?P<edge>highest|lowest) {noun}"),
+        ]
+        return {
+            'metrics': metrics,
+            'phrases': phrases,
+            'ranked': ranked,
+            'departments': departments,
+            'patterns': [(name, re.compile(f'^{pattern}$')) for name, pattern in patterns]
+        }
+
+    def grammar(self):
+        stamp = database_stamp(self.db_path)
+        with self._lock:
+            if self._grammar is not None and stamp == self._stamp:
+                return self._grammar
+        grammar = self._build_grammar(*self._load_vocabulary())
+        with self._lock:
+            self._grammar = grammar
+            self._stamp = stamp
+        return grammar
+
+    def compile(self, question):
+        """
+        Return a CompiledQuery for the question, or None when no template matches it confidently
+        """
+        grammar = self.grammar()
+        text = normalize_question(question)
+        compiled = None
+        for name, pattern in grammar['patterns']:
+            match = pattern.match(text)
+            if match is not None:
+                compiled = self._emit(name, match.groupdict(), grammar)
+                if compiled is not None:
+                    break
+        with self._lock:
+            if compiled is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.templates[compiled.template] = self.templates.get(compiled.template, 0) + 1
+        return compiled
+
+    def _metric(self, groups, grammar):
+        if groups.get('metric'):
+            return grammar['metrics'][grammar['phrases'][groups['metric']]]
+        if groups.get('noun'):
+            return grammar['metrics'][grammar['ranked'][groups['noun']]]
+        if groups.get('noun_metric'):
+            name = 'salary' if groups['noun_metric'] == 'paid' else 'performance_rating'
+            return grammar['metrics'].get(name)
+        return None
+
+    def _emit(self, name, groups, grammar):
+        department = grammar['departments'].get(groups.get('department'))
+        if name == 'count_employees':
+            return CompiledQuery(name, 'SELECT COUNT(*) AS employee_count FROM employees', ())
+        if name == 'count_in_department':
+            return CompiledQuery(name, 'SELECT COUNT(*) AS employee_count FROM employees WHERE department = ?',
+                                 (department,))
+        if name == 'employees_in_department':
+            return CompiledQuery(
+                name,
+                'SELECT first_name, last_name, job_title FROM employees WHERE department = ? '
+                'ORDER BY last_name, first_name',
+                (department,)
+            )
+
+        metric = self._metric(groups, grammar)
+        if metric is None:
+            return None
+        table, column, _ = metric
+        source, value = ('employees e', f'e.{column}') if table == 'employees' else (
+            'employees e JOIN employee_stats s ON s.employee_id = e.employee_id', f's.{column}'
+        )
+
+        if name == 'extreme_metric':
+            aggregate = 'MIN' if groups['direction'] in LOW_WORDS else 'MAX'
+            return CompiledQuery(
+                name,
+                f'SELECT e.first_name, e.last_name, {value} FROM {source} '
+                f'WHERE {value} = (SELECT {aggregate}({column}) FROM {table}) ORDER BY e.last_name, e.first_name',
+                ()
+            )
+        if name == 'average_by_department':
+            return CompiledQuery(
+                name,
+                f'SELECT e.department, AVG({value}) AS average_{column} FROM {source} '
+                f'GROUP BY e.department ORDER BY average_{column} DESC',
+                ()
+            )
+        if name == 'average_in_department':
+            return CompiledQuery(
+                name, f'SELECT AVG({value}) AS average_{column} FROM {source} WHERE e.department = ?',
+                (department,)
+            )
+        if name == 'average_metric':
+            return CompiledQuery(name, f'SELECT AVG({column}) AS average_{column} FROM {table}', ())
+        if name == 'top_n':
+            count = groups['count']
+            count = int(count) if count.isdigit() else NUMBER_WORDS[count]
+            if not 0 < count <= self.max_top_n:
+                return None
+            order = 'ASC' if groups['edge'] in ('bottom', 'lowest') else 'DESC'
+            # SQLite sorts NULL first, so unrated employees would otherwise lead the bottom N
+            return CompiledQuery(
+                name,
+                f'SELECT e.first_name, e.last_name, {value} FROM {source} WHERE {value} IS NOT NULL '
+                f'ORDER BY {value} {order}, e.employee_id LIMIT ?',
+                (count,)
+            )
+        return None
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'templates': dict(self.templates)
+            }
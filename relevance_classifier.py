@@ -0,0 +1,216 @@
+import re
+import sqlite3
+import threading
+import time
+
+TOKEN_PATTERN = re.compile(r"[a-z]+")
+
+# Words that carry no signal about the topic of a question
+STOPWORDS = {
+    'a', 'about', 'all', 'an', 'and', 'any', 'are', 'as', 'at', 'be', 'by', 'can', 'could', 'do',
+    'does', 'each', 'for', 'from', 'give', 'has', 'have', 'how', 'i', 'in', 'is', 'it', 'its',
+    'list', 'many', 'me', 'more', 'most', 'much', 'my', 'of', 'on', 'or', 'our', 'please', 's',
+    'show', 'tell', 'than', 'that', 'the', 'their', 'them', 'there', 'these', 'they', 'this',
+    'those', 'to', 'was', 'we', 'were', 'what', 'whats', 'when', 'where', 'which', 'who', 'whom',
+    'whose', 'why', 'will', 'with', 'would', 'you', 'your'
+}
+
+# Weight of words that also appear in everyday questions
+GENERIC_WEIGHT = 0.5
+
+# Column-name fragments that also appear in everyday questions count for less
+WEAK_SCHEMA_WORDS = {'date', 'first', 'id', 'last', 'level', 'name', 'number', 'title'}
+
+# Words that point at employee data without being part of the schema
+DOMAIN_WORDS = {
+    'colleague', 'compensation', 'headcount', 'hired', 'org', 'organization', 'payroll', 'performer',
+    'promoted', 'pto', 'seniority', 'staff', 'vacation', 'wage', 'worker', 'workforce', 'employed',
+    'tenure', 'hiring'
+}
+
+# Words common in employee questions and in everyday ones alike ("highest", "boss", "raise").
+# They count for less and cannot make a question relevant on their own: a confident YES
+# needs at least one schema, domain or database term.
+GENERIC_WORDS = {
+    'average', 'boss', 'earn', 'earner', 'earning', 'executive', 'highest', 'joined', 'lowest',
+    'paid', 'pay', 'people', 'person', 'rated', 'report', 'reporting', 'team', 'work', 'worked',
+    'working', 'hire', 'newest', 'raise', 'bonus', 'office', 'role'
+}
+
+# Everyday topics with nothing to do with employee data. A question that scores zero is only
+# a confident NO when it also names one of these: on-topic questions phrased without any
+# vocabulary word ("Who has been here the longest?") score zero too and go to the LLM.
+OFF_TOPIC_WORDS = {
+    'weather', 'rain', 'sunny', 'forecast', 'temperature', 'joke', 'funny', 'riddle', 'poem', 'story',
+    'song', 'music', 'movie', 'film', 'tv', 'game', 'football', 'soccer', 'recipe', 'cook', 'coffee',
+    'tea', 'food', 'restaurant', 'pizza', 'clock', 'stock', 'bitcoin', 'crypto', 'capital', 'planet',
+    'moon', 'translate', 'spell', 'meaning', 'diet', 'flight', 'hotel', 'horoscope', 'universe',
+    'mountain', 'river', 'ocean', 'actor', 'actress', 'celebrity', 'singer', 'athlete', 'president',
+    'country', 'germany', 'france', 'spain', 'italy', 'china', 'japan', 'india', 'america', 'usa',
+    'apple', 'google', 'microsoft', 'amazon', 'tesla', 'facebook'
+}
+
+SCHEMA_TABLES = {
+    'employees': [
+        'employee_id', 'first_name', 'last_name', 'email', 'phone_number', 'hire_date',
+        'job_title', 'department', 'salary', 'manager_id', 'management_level'
+    ],
+    'employee_stats': [
+        'employee_id', 'annual_leave_balance', 'sick_leave_balance',
+        'last_promotion_date', 'performance_rating'
+    ]
+}
+
+# Columns whose values (names, departments, titles) are worth recognizing in questions
+VALUE_COLUMNS = ['first_name', 'last_name', 'department', 'job_title']
+
+
+def stem(word):
+    """
+    Reduce a word to a crude singular form
+    """
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s') and not word.endswith('ss'):
+        return word[:-1]
+    return word
+
+
+def tokenize(text):
+    return [stem(token) for token in TOKEN_PATTERN.findall(text.lower().replace("'", ''))]
+
+
+OFF_TOPIC_STEMS = {stem(word) for word in OFF_TOPIC_WORDS}
+
+
+class RelevanceClassifier:
+    """
+    Keyword classifier that scores a question against the employee database vocabulary.
+
+    classify() returns True when the score reaches relevant_threshold, the question has
+    at least one term that is more than a generic word and it names no off-topic subject;
+    False when the score is at most irrelevant_threshold and it names an off-topic subject;
+    and None when the caller should fall back to the LLM.
+    """
+
+    def __init__(self, db_path=None, relevant_threshold=0.4, irrelevant_threshold=0.0):
+        self.db_path = db_path
+        self.relevant_threshold = relevant_threshold
+        self.irrelevant_threshold = irrelevant_threshold
+        self._vocabulary = None
+        self._lock = threading.Lock()
+        self.local_decisions = 0
+        self.fallbacks = 0
+        self.local_seconds = 0.0
+        self.llm_calls = 0
+        self.llm_seconds = 0.0
+
+    def vocabulary(self):
+        """
+        Build the weighted vocabulary from the schema, domain words and database values
+        """
+        if self._vocabulary is None:
+            vocabulary = {}
+            for word in GENERIC_WORDS:
+                vocabulary[stem(word)] = GENERIC_WEIGHT
+            for word in DOMAIN_WORDS:
+                vocabulary[stem(word)] = 1.0
+            for table, columns in SCHEMA_TABLES.items():
+                for name in [table] + columns:
+                    for word in tokenize(name.replace('_', ' ')):
+                        vocabulary[word] = GENERIC_WEIGHT if word in WEAK_SCHEMA_WORDS else 1.0
+            for word in self._database_words():
+                vocabulary.setdefault(word, 1.0)
+            self._vocabulary = vocabulary
+        return self._vocabulary
+
+    def _database_words(self):
+        if self.db_path is None:
+            return set()
+        words = set()
+        try:
+            conn = sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True)
+            try:
+                for column in VALUE_COLUMNS:
+                    for (value,) in conn.execute(f'SELECT DISTINCT {column} FROM employees'):
+                        words.update(word for word in tokenize(str(value)) if word not in STOPWORDS)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            # The schema and domain vocabulary still work without the database
+            pass
+        return words
+
+    def refresh(self):
+        self._vocabulary = None
+
+    def score(self, user_input):
+        """
+        Return the weighted share of content words that belong to the vocabulary
+        """
+        vocabulary = self.vocabulary()
+        tokens = [token for token in tokenize(user_input) if token not in STOPWORDS]
+        if not tokens:
+            return None
+        return min(1.0, sum(vocabulary.get(token, 0.0) for token in tokens) / len(tokens))
+
+    def anchored(self, user_input):
+        """
+        Return whether the question has a term that points at the employee data by itself
+        """
+        vocabulary = self.vocabulary()
+        return any(vocabulary.get(token, 0.0) > GENERIC_WEIGHT for token in tokenize(user_input))
+
+    def off_topic(self, user_input):
+        """
+        Return whether the question names an everyday subject outside the employee data
+        """
+        return any(token in OFF_TOPIC_STEMS for token in tokenize(user_input))
+
+    def classify(self, user_input):
+        """
+        Return True/False for confident decisions, or None when the question is ambiguous
+        """
+        start = time.perf_counter()
+        score = self.score(user_input)
+        if score is None:
+            decision = None
+        elif score >= self.relevant_threshold and self.anchored(user_input):
+            # An off-topic subject ("a joke about engineering") leaves the decision to the LLM
+            decision = None if self.off_topic(user_input) else True
+        elif score <= self.irrelevant_threshold and self.off_topic(user_input):
+            decision = False
+        else:
+            decision = None
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.local_seconds += elapsed
+            if decision is None:
+                self.fallbacks += 1
+            else:
+                self.local_decisions += 1
+        return decision
+
+    def record_llm_call(self, seconds):
+        """
+        Record the latency of a fallback LLM call, used to estimate the latency saved
+        """
+        with self._lock:
+            self.llm_calls += 1
+            self.llm_seconds += seconds
+
+    def stats(self):
+        with self._lock:
+            total = self.local_decisions + self.fallbacks
+            average_llm_seconds = self.llm_seconds / self.llm_calls if self.llm_calls else None
+            return {
+                'local_decisions': self.local_decisions,
+                'fallbacks': self.fallbacks,
+                'fallback_rate': self.fallbacks / total if total else 0.0,
+                'average_local_microseconds': self.local_seconds / total * 1e6 if total else 0.0,
+                'average_llm_seconds': average_llm_seconds,
+                'estimated_seconds_saved': (
+                    self.local_decisions * average_llm_seconds if average_llm_seconds is not None else None
+                )
+            }
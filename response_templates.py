@@ -0,0 +1,83 @@
+import re
+from decimal import Decimal
+
+AGGREGATE_PATTERN = re.compile(r'^(avg|sum|min|max|count|total)\s*\(\s*(distinct\s+)?(.*?)\s*\)$', re.IGNORECASE)
+
+# Integers in columns named for these are labels or dates, not amounts, so their digits are not grouped
+PLAIN_NUMBER_WORDS = {'id', 'year', 'month', 'day', 'date', 'code'}
+COLUMN_WORD_PATTERN = re.compile(r'[a-z]+')
+
+AGGREGATE_WORDS = {
+    'avg': 'average',
+    'sum': 'total',
+    'total': 'total',
+    'min': 'minimum',
+    'max': 'maximum',
+    'count': 'number of'
+}
+
+
+def column_label(column):
+    """
+    Turn a result column name such as "AVG(e.salary)" or "avg_salary" into readable words
+    """
+    match = AGGREGATE_PATTERN.match(column.strip())
+    if match:
+        function, distinct, argument = match.groups()
+        argument = argument.split('.')[-1].replace('_', ' ')
+        if function.lower() == 'count':
+            if argument in ('*', '1', ''):
+                return 'number of matching records'
+            return f"number of {'distinct ' if distinct else ''}{argument} values"
+        return f"{AGGREGATE_WORDS[function.lower()]} {argument}"
+
+    words = column.split('.')[-1].replace('_', ' ').split()
+    if words and words[0].lower() in AGGREGATE_WORDS and len(words) > 1:
+        words[0] = AGGREGATE_WORDS[words[0].lower()]
+    return ' '.join(words)
+
+
+def format_value(column, value):
+    """
+    Format a value for display, grouping the digits of amounts but not of ids, years and dates
+    """
+    if value is None:
+        return 'not recorded'
+    if isinstance(value, bool):
+        return str(value)
+    if isinstance(value, (float, Decimal)):
+        return f'{float(value):,.2f}'
+    if isinstance(value, int) and PLAIN_NUMBER_WORDS.isdisjoint(COLUMN_WORD_PATTERN.findall(column.lower())):
+        return f'{value:,}'
+    return str(value)
+
+
+def _format_record(columns, row):
+    return ', '.join(
+        f"{column_label(column).capitalize()}: {format_value(column, value)}"
+        for column, value in zip(columns, row)
+    )
+
+
+def render_response(columns, rows, max_rows=10, max_columns=4):
+    """
+    Render a response for empty, scalar, single-row and small-table results.
+    Returns None when the result needs the LLM to be explained.
+    """
+    if getattr(rows, 'truncated', False):
+        return None
+    if not rows:
+        return "No records in the employee database match your question."
+
+    if len(rows) == 1 and len(columns) == 1:
+        value = rows[0][0]
+        return f"The {column_label(columns[0])} is {format_value(columns[0], value)}."
+
+    if len(rows) == 1 and len(columns) <= max_columns + 2:
+        return f"Found 1 matching record:\n- {_format_record(columns, rows[0])}"
+
+    if len(rows) <= max_rows and len(columns) <= max_columns:
+        lines = [f"- {_format_record(columns, row)}" for row in rows]
+        return f"Found {len(rows)} matching records:\n" + '\n'.join(lines)
+
+    return None
@@ -0,0 +1,152 @@
+import re
+import sqlite3
+import threading
+from collections import OrderedDict
+from result_fetch import ResultRows, estimate_row_bytes
+
+# Quoted spans keep their case and spacing when SQL is canonicalized: single-quoted strings, and
+# double-quoted, backtick and bracket identifiers, since SQLite reads "abc" as a string when no column matches
+STRING_LITERAL_PATTERN = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])""")
+WHITESPACE_PATTERN = re.compile(r'\s+')
+LINE_COMMENT_PATTERN = re.compile(r'--[^\n]*')
+
+# Functions whose result changes between runs of the same SQL on the same data, matched on
+# canonical SQL: the current date and time ('now' or no arguments), randomness and connection state
+NONDETERMINISTIC_PATTERN = re.compile(
+    r"\b(?:date|time|datetime|julianday|strftime|unixepoch)\s*\((?:\s*\)|[^)]*'now')"
+    r"|\bcurrent_(?:timestamp|date|time)\b"
+    r"|\b(?:random|randomblob|changes|total_changes|last_insert_rowid)\s*\("
+)
+
+# Rough per-row and per-entry bookkeeping overhead counted against the memory cap
+ROW_OVERHEAD_BYTES = 64
+ENTRY_OVERHEAD_BYTES = 256
+
+
+def canonicalize_sql(sql):
+    """
+    Canonicalize SQL text so trivially different spellings share a cache key:
+    comments are dropped, whitespace collapsed, trailing semicolons removed and
+    everything outside quoted strings and identifiers lowercased
+    """
+    parts = STRING_LITERAL_PATTERN.split(sql)
+    for index in range(0, len(parts), 2):
+        text = LINE_COMMENT_PATTERN.sub(' ', parts[index])
+        parts[index] = WHITESPACE_PATTERN.sub(' ', text).lower()
+    canonical = ''.join(parts).strip()
+    while canonical.endswith(';'):
+        canonical = canonical[:-1].rstrip()
+    return canonical
+
+
+class ResultCache:
+    """
+    In-memory LRU cache of query results keyed on canonical SQL text.
+
+    The cache holds a private read-only connection to the database and reads
+    PRAGMA data_version on every lookup; the value changes whenever another
+    connection commits, so any write (including create_database) empties the
+    cache before a stale result could be served. SQL that reads the clock or
+    random() is never cached, since its result changes without any write.
+    """
+
+    def __init__(self, db_path, max_bytes=64 * 1024 * 1024):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+        self._data_version = self._read_data_version()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.skipped = 0
+
+    def _read_data_version(self):
+        return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def _check_data_version(self):
+        # Must be called with the lock held
+        data_version = self._read_data_version()
+        if data_version != self._data_version:
+            self._data_version = data_version
+            if self._entries:
+                self.invalidations += 1
+            self._entries.clear()
+            self.bytes = 0
+        return data_version
+
+    def get(self, sql, params=()):
+        """
+        Return (columns, rows) for the SQL, or None on a miss
+        """
+        key = (canonicalize_sql(sql), tuple(params))
+        if NONDETERMINISTIC_PATTERN.search(key[0]):
+            with self._lock:
+                self.skipped += 1
+            return None
+        with self._lock:
+            self._check_data_version()
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        columns, rows, _ = entry
+        return list(columns), ResultRows(rows, truncated=rows.truncated, total_count=rows.total_count)
+
+    def put(self, sql, params, columns, rows, data_version):
+        """
+        Store a result read at the given data_version; results read before the
+        latest write are dropped instead of stored
+        """
+        size = ENTRY_OVERHEAD_BYTES + sum(estimate_row_bytes(row) + ROW_OVERHEAD_BYTES for row in rows)
+        if size > self.max_bytes:
+            return
+        key = (canonicalize_sql(sql), tuple(params))
+        if NONDETERMINISTIC_PATTERN.search(key[0]):
+            return
+        stored = ResultRows(rows, truncated=getattr(rows, 'truncated', False),
+                            total_count=getattr(rows, 'total_count', None))
+        with self._lock:
+            if self._check_data_version() != data_version:
+                return
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous[2]
+            self._entries[key] = (list(columns), stored, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def data_version(self):
+        """
+        Return the current data version, to be passed to put() with a result read afterwards
+        """
+        with self._lock:
+            return self._check_data_version()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'skipped': self.skipped
+            }
@@ -0,0 +1,223 @@
+import csv
+import os
+import re
+import tempfile
+import time
+from result_fetch import ResultRows
+
+# Export formats and the file extension each one is written with
+EXPORT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Questions that ask for a file, optionally naming its format
+EXPORT_PATTERN = re.compile(r'\b(?:export|download|dump|spreadsheet|csv|parquet|arrow)\b')
+FORMAT_PATTERN = re.compile(r'\b(csv|parquet|arrow)\b')
+
+# Questions that ask for every matching row rather than an answer
+LISTING_PATTERN = re.compile(
+    r'\b(?:list|show|give|get|display|print)\b.*\b(?:all|every|everyone|everybody|entire|full|complete|whole)\b'
+    r'|^(?:all|every) (?:the )?(?:employees|people|staff)\b'
+)
+
+
+class ExportError(Exception):
+    """
+    Raised when a result cannot be written in the requested format
+    """
+    pass
+
+
+def export_request(question):
+    """
+    Return (export_format, explicit) for a question: the format it names or None, and whether
+    it asked for a file (True) or is merely listing-style (False); (None, None) for neither
+    """
+    text = question.lower()
+    named = FORMAT_PATTERN.search(text)
+    if EXPORT_PATTERN.search(text):
+        return (named.group(1) if named else None), True
+    if LISTING_PATTERN.search(text):
+        return None, False
+    return None, None
+
+
+class ExportResult:
+    """
+    A query result written to a file, with the rows kept in memory for the answer
+    """
+
+    def __init__(self, path, export_format, columns, row_count, size_bytes, seconds, preview):
+        self.path = path
+        self.format = export_format
+        self.columns = columns
+        self.row_count = row_count
+        self.size_bytes = size_bytes
+        self.seconds = seconds
+        self.preview = preview
+
+    @property
+    def rows_per_second(self):
+        return self.row_count / self.seconds if self.seconds else 0.0
+
+    def to_dict(self):
+        return {
+            'path': self.path,
+            'format': self.format,
+            'row_count': self.row_count,
+            'size_bytes': self.size_bytes,
+            'seconds': self.seconds,
+            'rows_per_second': self.rows_per_second
+        }
+
+    def summary(self):
+        return (f"Exported {self.row_count} rows ({', '.join(self.columns)}) to {self.path} "
+                f"({self.format}, {self.size_bytes / 1_000_000:.1f} MB)")
+
+
+def _batches(cursor, batch_size, kept, keep_rows):
+    """
+    Yield the cursor's rows in batches, keeping the first keep_rows of them in kept
+    """
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            return
+        if len(kept) < keep_rows:
+            kept.extend(batch[:keep_rows - len(kept)])
+        yield batch
+
+
+def _write_csv(path, columns, batches):
+    count = 0
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows(batch)
+            count += len(batch)
+    return count
+
+
+def _arrow_types(pa, columns, batch):
+    # SQLite columns have no declared result type, so types come from the first batch
+    types = []
+    for index, _ in enumerate(columns):
+        values = [row[index] for row in batch if row[index] is not None]
+        if values and all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            types.append(pa.int64())
+        elif values and all(isinstance(value, (int, float)) for value in values):
+            types.append(pa.float64())
+        elif values and all(isinstance(value, bytes) for value in values):
+            types.append(pa.binary())
+        else:
+            types.append(pa.string())
+    return types
+
+
+def _record_batch(pa, schema, batch):
+    arrays = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in batch]
+        if pa.types.is_string(field.type):
+            values = [None if value is None else str(value) for value in values]
+        try:
+            arrays.append(pa.array(values, type=field.type))
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as e:
+            raise ExportError(
+                f"Column {field.name} changes type after the first batch ({e}); export it as csv instead"
+            ) from e
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _write_arrow(path, columns, batches, export_format):
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ExportError(f"{export_format} export needs pyarrow (pip install pyarrow)") from e
+
+    count = 0
+    writer = None
+    try:
+        for batch in batches:
+            if writer is None:
+                schema = pa.schema(list(zip(columns, _arrow_types(pa, columns, batch))))
+                writer = (pa.parquet.ParquetWriter(path, schema) if export_format == 'parquet'
+                          else pa.ipc.new_file(path, schema))
+            record_batch = _record_batch(pa, schema, batch)
+            if export_format == 'parquet':
+                writer.write_table(pa.Table.from_batches([record_batch]))
+            else:
+                writer.write_batch(record_batch)
+            count += len(batch)
+        if writer is None:
+            # An empty result still gets a file with the column names
+            schema = pa.schema([(column, pa.string()) for column in columns])
+            writer = (pa.parquet.ParquetWriter(path, schema) if export_format == 'parquet'
+                      else pa.ipc.new_file(path, schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    return count
+
+
+def export_rows(cursor, columns, directory, export_format='csv', batch_size=10000, keep_rows=0):
+    """
+    Stream the cursor's rows into a new file in directory and return an ExportResult.
+
+    Rows are read with fetchmany and written batch by batch, so memory stays bounded
+    by batch_size and keep_rows however large the result is; the first keep_rows rows
+    are returned in ExportResult.preview. Rows are written to a .part file that is
+    renamed over the reserved name once it is complete.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ExportError(f"Unknown export format {export_format!r}, expected one of {', '.join(EXPORT_FORMATS)}")
+    os.makedirs(directory, exist_ok=True)
+    extension = EXPORT_FORMATS[export_format]
+    fd, path = tempfile.mkstemp(prefix=time.strftime('export-%Y%m%d-%H%M%S-'), suffix=extension, dir=directory)
+    os.close(fd)
+    partial_path = path + '.part'
+    kept = []
+    start = time.perf_counter()
+    try:
+        batches = _batches(cursor, batch_size, kept, keep_rows)
+        if export_format == 'csv':
+            count = _write_csv(partial_path, columns, batches)
+        else:
+            count = _write_arrow(partial_path, columns, batches, export_format)
+        os.replace(partial_path, path)
+    except BaseException:
+        for leftover in (partial_path, path):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    seconds = time.perf_counter() - start
+    preview = ResultRows(kept, truncated=count > len(kept), total_count=count)
+    return ExportResult(path, export_format, list(columns), count, os.path.getsize(path), seconds, preview)
+
+
+def prune_exports(directory, max_age_seconds=None, max_files=None):
+    """
+    Delete export files in directory older than max_age_seconds, then the oldest ones
+    beyond max_files (None disables either limit), and return how many were deleted.
+    Partial files of exports still being written are left alone until they are old.
+    """
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.name.startswith('export-') and entry.is_file()]
+    except FileNotFoundError:
+        return 0
+    now = time.time()
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    expired = [entry for entry in entries
+               if max_age_seconds is not None and now - entry.stat().st_mtime > max_age_seconds]
+    kept = [entry for entry in entries if entry not in expired and not entry.name.endswith('.part')]
+    if max_files is not None:
+        expired += kept[max_files:]
+    removed = 0
+    for entry in expired:
+        try:
+            os.remove(entry.path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
@@ -0,0 +1,62 @@
+class ResultRows(list):
+    """
+    List of fetched rows that also records whether the result was cut short.
+
+    total_count is the number of rows the query actually produced, which is
+    larger than len(rows) when the result was truncated, or None when the
+    remaining rows were not counted. export is the ExportResult when the full
+    result was written to a file and these rows are only its first ones.
+    """
+
+    def __init__(self, rows=(), truncated=False, total_count=None, export=None):
+        super().__init__(rows)
+        self.truncated = truncated
+        self.total_count = len(self) if total_count is None else total_count
+        self.export = export
+
+
+def estimate_row_bytes(row):
+    """
+    Estimate how many bytes a row adds to a results listing
+    """
+    return sum(len(str(value)) for value in row) + 2 * len(row)
+
+
+def fetch_rows(cursor, max_rows=1000, max_bytes=1_000_000, batch_size=200, count_total=True):
+    """
+    Pull rows from the cursor in batches until the row or byte budget is used up.
+    When count_total is set the rest of the result is counted without being kept,
+    so memory stays bounded by the budget however large the result is.
+    """
+    rows = ResultRows()
+    used_bytes = 0
+    truncated = False
+
+    while not truncated:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        for index, row in enumerate(batch):
+            row_bytes = estimate_row_bytes(row)
+            if len(rows) >= max_rows or used_bytes + row_bytes > max_bytes:
+                truncated = True
+                skipped = len(batch) - index
+                break
+            rows.append(row)
+            used_bytes += row_bytes
+
+    total_count = len(rows)
+    if truncated:
+        total_count += skipped
+        if count_total:
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                total_count += len(batch)
+        else:
+            total_count = None
+
+    rows.truncated = truncated
+    rows.total_count = total_count
+    return rows
@@ -0,0 +1,324 @@
+import base64
+import hashlib
+import hmac
+import json
+import re
+import zlib
+
+ORDER_BY_PATTERN = re.compile(r'\border\s+by\b', re.IGNORECASE)
+LIMIT_PATTERN = re.compile(r'\blimit\b', re.IGNORECASE)
+ORDER_ITEM_PATTERN = re.compile(
+    r'^(?P<expr>.+?)(?:\s+collate\s+\w+)?(?:\s+(?P<direction>asc|desc))?(?:\s+(?P<nulls>nulls\s+(?:first|last)))?$',
+    re.IGNORECASE | re.DOTALL
+)
+QUOTES = {'"': '"', '`': '`', '[': ']'}
+
+
+class PageCursorError(Exception):
+    """
+    Raised when a page cursor is malformed or was not issued by this process
+    """
+    pass
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def _mask(sql):
+    """
+    Return sql with string and identifier contents, comments and everything inside
+    parentheses blanked out, so keyword searches only see the top-level statement
+    """
+    out = list(sql)
+    depth = 0
+    i = 0
+    while i < len(sql):
+        char = sql[i]
+        if char in "'\"`[":
+            close = QUOTES.get(char, "'")
+            j = i + 1
+            while j < len(sql):
+                if sql[j] == close and not (close != ']' and sql[j + 1:j + 2] == close):
+                    break
+                j += 2 if sql[j] == close else 1
+            for k in range(i + 1, min(j, len(sql))):
+                out[k] = ' '
+            if depth:
+                out[i] = ' '
+                if j < len(sql):
+                    out[j] = ' '
+            i = j + 1
+            continue
+        if sql.startswith('--', i) or sql.startswith('/*', i):
+            end = sql.find('\n', i) if char == '-' else sql.find('*/', i + 2) + 1
+            end = len(sql) if end <= 0 else end
+            for k in range(i, min(end + 1, len(sql))):
+                out[k] = ' '
+            i = end + 1
+            continue
+        if char == '(':
+            depth += 1
+            if depth > 1:
+                out[i] = ' '
+        elif char == ')':
+            depth -= 1
+            if depth > 0:
+                out[i] = ' '
+        elif depth:
+            out[i] = ' '
+        i += 1
+    return ''.join(out)
+
+
+def _identifier(expression):
+    """
+    Return the column an ORDER BY expression names: the last part of a possibly
+    qualified and quoted identifier, or None for anything else
+    """
+    match = re.fullmatch(r'(?:(?:"[^"]+"|`[^`]+`|\[[^\]]+\]|\w+)\s*\.\s*)?("(?:[^"]|"")+"|`[^`]+`|\[[^\]]+\]|\w+)',
+                         expression)
+    if match is None:
+        return None
+    name = match.group(1)
+    if name[0] in QUOTES:
+        name = name[1:-1].replace('""', '"') if name[0] == '"' else name[1:-1]
+    return name
+
+
+def order_keys(sql, columns):
+    """
+    Return the outer ORDER BY of sql as [(column, descending)] over the result columns,
+    or None when there is none or an item is not a plain result column (an expression,
+    an ambiguous name or explicit NULLS FIRST/LAST)
+    """
+    source = sql.strip().rstrip(';')
+    masked = _mask(source)
+    matches = list(ORDER_BY_PATTERN.finditer(masked))
+    if not matches:
+        return None
+    start = matches[-1].end()
+    limit = LIMIT_PATTERN.search(masked, start)
+    end = limit.start() if limit else len(source)
+
+    lowered = [column.lower() for column in columns]
+    keys = []
+    position = start
+    for piece in masked[start:end].split(','):
+        # Trimmed by the mask, so a trailing comment is not part of the item
+        lead, trail = len(piece) - len(piece.lstrip()), len(piece) - len(piece.rstrip())
+        item = source[position + lead:position + len(piece) - trail]
+        position += len(piece) + 1
+        match = ORDER_ITEM_PATTERN.match(item)
+        if match is None or match.group('nulls'):
+            return None
+        expression = match.group('expr').strip()
+        if expression.isdigit():
+            index = int(expression) - 1
+            if not 0 <= index < len(columns):
+                return None
+            name = columns[index]
+        else:
+            name = _identifier(expression)
+            if name is None and expression in columns:
+                # An unaliased expression is its own result column name
+                name = expression
+        if name is None or lowered.count(name.lower()) != 1:
+            return None
+        keys.append((columns[lowered.index(name.lower())], (match.group('direction') or '').lower() == 'desc'))
+    return keys or None
+
+
+def keyset_condition(keys, after, inclusive=True, nullable=True):
+    """
+    Return (sql, params) selecting the rows that sort after the key values in after,
+    or also equal to them when inclusive. SQLite sorts NULL first, so NULL keys come
+    first in ascending and last in descending order. A bound on the first key comes
+    first so an index on it can seek straight to the page; in descending order it is
+    only a plain range when nullable is False, i.e. the first key has no NULLs.
+    """
+    (first, first_descending), first_value = keys[0], after[0]
+    if first_value is None:
+        bound = (None, ()) if not first_descending else (f'{_quote(first)} IS NULL', ())
+    elif first_descending and not nullable:
+        bound = (f'{_quote(first)} <= ?', (first_value,))
+    elif first_descending:
+        bound = (f'({_quote(first)} <= ? OR {_quote(first)} IS NULL)', (first_value,))
+    else:
+        bound = (f'{_quote(first)} >= ?', (first_value,))
+    if len(keys) == 1 and inclusive:
+        return bound if bound[0] is not None else ('1', ())
+
+    disjuncts, params = [], []
+    for index, ((column, descending), value) in enumerate(zip(keys, after)):
+        terms, term_params = [], []
+        for (equal_column, _), equal_value in zip(keys[:index], after[:index]):
+            if equal_value is None:
+                terms.append(f'{_quote(equal_column)} IS NULL')
+            else:
+                terms.append(f'{_quote(equal_column)} = ?')
+                term_params.append(equal_value)
+        if value is None:
+            if descending:
+                continue
+            terms.append(f'{_quote(column)} IS NOT NULL')
+        elif descending and (nullable or index):
+            terms.append(f'({_quote(column)} < ? OR {_quote(column)} IS NULL)')
+            term_params.append(value)
+        elif descending:
+            terms.append(f'{_quote(column)} < ?')
+            term_params.append(value)
+        else:
+            terms.append(f'{_quote(column)} > ?')
+            term_params.append(value)
+        disjuncts.append(' AND '.join(terms))
+        params.extend(term_params)
+    if inclusive:
+        terms = []
+        for column, value in zip((column for column, _ in keys), after):
+            terms.append(f'{_quote(column)} IS NULL' if value is None else f'{_quote(column)} = ?')
+            if value is not None:
+                params.append(value)
+        disjuncts.append(' AND '.join(terms))
+    condition = '(' + ' OR '.join(f'({disjunct})' for disjunct in disjuncts) + ')' if disjuncts else '0'
+    if bound[0] is None:
+        return condition, tuple(params)
+    return f'{bound[0]} AND {condition}', tuple(bound[1]) + tuple(params)
+
+
+class PageCursor:
+    """
+    Position in the result of a query: the page after the rows already returned.
+
+    With keys (the query's ORDER BY as result columns) pages are fetched by keyset:
+    the next page starts at the key values of the last row returned (after), skipping
+    the ties rows that share them and were returned already, so a page costs the same
+    however deep it is. Without keys it falls back to OFFSET. Cursors are handed out
+    as signed, opaque tokens that carry the query, so any process holding the secret
+    can continue a result.
+    """
+
+    def __init__(self, sql, params=(), page_size=50, keys=None, after=None, ties=0, offset=0, nullable=True):
+        self.sql = sql
+        self.params = tuple(params)
+        self.page_size = page_size
+        self.keys = [tuple(key) for key in keys] if keys else None
+        self.after = tuple(after) if after is not None else None
+        self.ties = ties
+        self.offset = offset
+        # Whether the first key may be NULL; see keyset_condition
+        self.nullable = nullable
+
+    def _with(self, **changes):
+        values = {'sql': self.sql, 'params': self.params, 'page_size': self.page_size, 'keys': self.keys,
+                  'after': self.after, 'ties': self.ties, 'offset': self.offset, 'nullable': self.nullable}
+        values.update(changes)
+        return PageCursor(**values)
+
+    def resize(self, page_size):
+        return self._with(page_size=page_size)
+
+    def check_nulls(self, conn):
+        """
+        Find out whether a descending first key has NULLs, so its pages can seek; one
+        lookup on an indexed column
+        """
+        if self.keys and self.keys[0][1]:
+            self.nullable = conn.execute(
+                f'SELECT 1 FROM (\n{self.sql.strip().rstrip(";")}\n) WHERE {_quote(self.keys[0][0])} IS NULL LIMIT 1',
+                self.params
+            ).fetchone() is not None
+        return self
+
+    @property
+    def mode(self):
+        return 'keyset' if self.keys else 'offset'
+
+    def page_query(self, extra=1):
+        """
+        Return (sql, params) for the page, with extra rows to tell whether another follows
+        """
+        source = self.sql.strip().rstrip(';')
+        size = self.page_size + extra
+        if not self.keys:
+            return f'SELECT * FROM (\n{source}\n) LIMIT ? OFFSET ?', self.params + (size, self.offset)
+        order = ', '.join(f'{_quote(column)} {"DESC" if descending else "ASC"}' for column, descending in self.keys)
+        if self.after is None:
+            return f'SELECT * FROM (\n{source}\n) ORDER BY {order} LIMIT ?', self.params + (size,)
+        condition, params = keyset_condition(self.keys, self.after, nullable=self.nullable)
+        return (f'SELECT * FROM (\n{source}\n) WHERE {condition} ORDER BY {order} LIMIT ? OFFSET ?',
+                self.params + params + (size, self.ties))
+
+    def advance(self, columns, rows):
+        """
+        Return the cursor for the page after rows, the rows this cursor's page returned
+        """
+        rows = list(rows)
+        if not rows:
+            return self
+        offset = self.offset + len(rows)
+        if not self.keys:
+            return self._with(offset=offset)
+        indexes = [columns.index(column) for column, _ in self.keys]
+        after = tuple(rows[-1][index] for index in indexes)
+        if any(isinstance(value, bytes) for value in after):
+            # Tokens are JSON, so BLOB keys page by OFFSET from here on
+            return self._with(keys=None, after=None, ties=0, offset=offset)
+        ties = 0
+        for row in reversed(rows):
+            if tuple(row[index] for index in indexes) != after:
+                break
+            ties += 1
+        if ties == len(rows) and after == self.after:
+            ties += self.ties
+        return self._with(after=after, ties=ties, offset=offset)
+
+    def encode(self, secret):
+        payload = json.dumps(
+            [self.sql, list(self.params), self.page_size, self.keys, self.after, self.ties, self.offset,
+             self.nullable],
+            separators=(',', ':')
+        ).encode('utf-8')
+        data = zlib.compress(payload)
+        signature = hmac.new(secret.encode('utf-8'), data, hashlib.sha256).digest()[:16]
+        return base64.urlsafe_b64encode(signature + data).decode('ascii').rstrip('=')
+
+    @classmethod
+    def decode(cls, token, secret):
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        except (ValueError, TypeError) as e:
+            raise PageCursorError("Malformed page cursor") from e
+        signature, data = raw[:16], raw[16:]
+        expected = hmac.new(secret.encode('utf-8'), data, hashlib.sha256).digest()[:16]
+        if not hmac.compare_digest(signature, expected):
+            raise PageCursorError("Unknown or expired page cursor")
+        return cls(*json.loads(zlib.decompress(data)))
+
+
+def cursor_after(sql, params, columns, rows, page_size=50):
+    """
+    Return the cursor for the rows that follow rows, the start of the query's result
+    """
+    return PageCursor(sql, params, page_size, order_keys(sql, columns)).advance(columns, rows)
+
+
+class ResultPage:
+    """
+    One page of a query result, with the token for the next page or None after the last
+    """
+
+    def __init__(self, columns, rows, next_cursor, mode):
+        self.columns = columns
+        self.rows = rows
+        self.next_cursor = next_cursor
+        self.mode = mode
+
+    def to_dict(self):
+        return {
+            'columns': self.columns,
+            'rows': [list(row) for row in self.rows],
+            'row_count': len(self.rows),
+            'next_cursor': self.next_cursor,
+            'mode': self.mode
+        }
@@ -0,0 +1,111 @@
+from collections import Counter
+from decimal import Decimal
+
+# Rough characters-per-token ratio for English text and SQL values
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def estimate_repr_tokens(columns, rows):
+    """
+    Estimate the tokens the old "Columns: ... Results: [(...), ...]" format would use
+    """
+    chars = len(f"Columns: {', '.join(columns)}\nResults: []")
+    chars += sum(len(repr(row)) + 2 for row in rows)
+    return (chars + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def _format_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, float):
+        return f'{value:.10g}'
+    return str(value).replace('\t', ' ').replace('\n', ' ')
+
+
+def _format_value_row(row):
+    return '\t'.join(_format_value(value) for value in row)
+
+
+def _is_number(value):
+    return isinstance(value, (int, float, Decimal)) and not isinstance(value, bool)
+
+
+def summarize_results(columns, rows, top_k=3):
+    """
+    Pre-aggregate a result locally: min/max/avg for numeric columns and
+    the most common values for the others
+    """
+    lines = []
+    for index, column in enumerate(columns):
+        values = [row[index] for row in rows if row[index] is not None]
+        if not values:
+            continue
+        if all(_is_number(value) for value in values):
+            average = sum(values) / len(values)
+            lines.append(
+                f"{column}: min={_format_value(min(values))} max={_format_value(max(values))} "
+                f"avg={_format_value(float(average))}"
+            )
+        else:
+            counts = Counter(_format_value(value) for value in values)
+            common = ', '.join(f"{value} ({count})" for value, count in counts.most_common(top_k))
+            lines.append(f"{column}: {len(counts)} distinct, top: {common}")
+    return lines
+
+
+class SerializedResults:
+    """
+    Compact text form of a query result together with its token accounting
+    """
+
+    def __init__(self, text, tokens, baseline_tokens, rows_included, summarized):
+        self.text = text
+        self.tokens = tokens
+        self.baseline_tokens = baseline_tokens
+        self.rows_included = rows_included
+        self.summarized = summarized
+
+    @property
+    def tokens_saved(self):
+        return max(0, self.baseline_tokens - self.tokens)
+
+
+def serialize_results(columns, rows, token_budget=1500, top_k=3):
+    """
+    Serialize query results as TSV within a token budget.
+    Results over budget keep as many leading rows as fit and add a local summary.
+    """
+    total_count = getattr(rows, 'total_count', None)
+    if total_count is None:
+        total_count = len(rows)
+    truncated = getattr(rows, 'truncated', False)
+    baseline_tokens = estimate_repr_tokens(columns, rows)
+
+    header = '\t'.join(columns)
+    lines = [_format_value_row(row) for row in rows]
+    text = '\n'.join([header] + lines)
+    if not truncated and estimate_tokens(text) <= token_budget:
+        return SerializedResults(text, estimate_tokens(text), baseline_tokens, len(rows), False)
+
+    # Over budget: summarize every fetched row, then spend what is left on sample rows
+    summary = [f"Row count: {total_count}" + ('' if len(rows) == total_count else f" (summary over the first {len(rows)})")]
+    summary += summarize_results(columns, rows, top_k=top_k)
+    summary_text = 'Summary:\n' + '\n'.join(summary)
+    remaining = token_budget - estimate_tokens(summary_text) - estimate_tokens(header) - 16
+
+    included = []
+    for line in lines:
+        cost = estimate_tokens(line) + 1
+        if cost > remaining:
+            break
+        included.append(line)
+        remaining -= cost
+
+    parts = [header] + included
+    parts.append(f"... {total_count - len(included)} more rows")
+    text = '\n'.join(parts) + '\n\n' + summary_text
+    return SerializedResults(text, estimate_tokens(text), baseline_tokens, len(included), True)
@@ -0,0 +1,297 @@
+import argparse
+import json
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from query_cache import question_key
+from result_pages import PageCursorError
+import main
+
+# Worker pool, queue and timeout settings for the HTTP service
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', '8'))
+SERVER_QUEUE_SIZE = int(os.getenv('SERVER_QUEUE_SIZE', '32'))
+SERVER_REQUEST_TIMEOUT = float(os.getenv('SERVER_REQUEST_TIMEOUT', '60'))
+
+
+class ServiceOverloadedError(Exception):
+    """
+    Raised when every worker is busy and the queue is full
+    """
+
+
+class QueryService:
+    """
+    Runs pipeline requests on a bounded worker pool.
+
+    At most workers + queue_size questions are accepted at once; beyond that
+    submit() raises ServiceOverloadedError. Identical questions that arrive
+    while one is already running share that single pipeline execution.
+    """
+
+    def __init__(self, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pipeline')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.accepted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.streaming = 0
+
+    def submit(self, question):
+        """
+        Return a future for the pipeline result of the question
+        """
+        key = question_key(question)
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                raise ServiceOverloadedError("The service is at capacity, retry later")
+            self.accepted += 1
+            future = self._executor.submit(main.run_pipeline, question)
+            self._in_flight[key] = future
+        future.add_done_callback(lambda done: self._finish(key, done))
+        return future
+
+    def _finish(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+        self._slots.release()
+
+    def submit_stream(self, question):
+        """
+        Run a streamed question on the pool like any other, without coalescing it. Returns a
+        queue that receives its events and then None, and an Event that stops it early.
+        """
+        events, cancelled = queue.Queue(), threading.Event()
+        with self._lock:
+            if not self._slots.acquire(blocking=False):
+                self.rejected += 1
+                raise ServiceOverloadedError("The service is at capacity, retry later")
+            self.accepted += 1
+            self.streaming += 1
+            future = self._executor.submit(self._run_stream, question, events, cancelled)
+        future.add_done_callback(lambda done: self._finish_stream())
+        return events, cancelled
+
+    def _run_stream(self, question, events, cancelled):
+        steps = main.stream_pipeline(question)
+        try:
+            for event in steps:
+                if cancelled.is_set():
+                    break
+                events.put(event)
+        except Exception as e:
+            events.put({'event': 'error', 'error': f'An error occurred: {str(e)}'})
+        finally:
+            # Closing the steps stops the LLM stream when the client went away
+            steps.close()
+            events.put(None)
+
+    def _finish_stream(self):
+        with self._lock:
+            self.streaming -= 1
+        self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'in_flight': len(self._in_flight),
+                'streaming': self.streaming,
+                'accepted': self.accepted,
+                'coalesced': self.coalesced,
+                'rejected': self.rejected
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def warm_up():
+    """
+    Open the shared connection pool and caches before the first request arrives
+    """
+    main.get_connection_pool()
+    if main.SQL_CACHE_ENABLED:
+        main.get_query_cache().schema_hash()
+    if main.LOCAL_RELEVANCE_ENABLED:
+        main.get_relevance_classifier().vocabulary()
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /query with {"question": ...}, POST /page with {"cursor": ...}; GET /health, GET /stats and GET /metrics.
+    With "stream": true, /query answers with one JSON event per line as the pipeline runs.
+    """
+
+    service = None
+    request_timeout = SERVER_REQUEST_TIMEOUT
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path == '/stats':
+            stats = main.get_pipeline_stats()
+            stats['service'] = self.service.stats()
+            self._send_json(200, stats)
+        elif self.path == '/metrics':
+            self._send_json(200, main.metrics_registry.snapshot())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path == '/page':
+            self._post_page()
+            return
+        if self.path != '/query':
+            self._send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            question = payload['question'].strip()
+            stream = payload.get('stream', False)
+            if not question or not isinstance(stream, bool):
+                raise ValueError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._send_json(400, {'error': 'expected a JSON body with a non-empty "question" and optional "stream"'})
+            return
+        if stream:
+            self._stream_query(question)
+            return
+
+        try:
+            future = self.service.submit(question)
+        except ServiceOverloadedError as e:
+            self._send_json(429, {'error': str(e)}, headers={'Retry-After': '1'})
+            return
+
+        try:
+            result = future.result(timeout=self.request_timeout)
+        except FutureTimeoutError:
+            self._send_json(504, {'error': f'the request timed out after {self.request_timeout} seconds'})
+            return
+        except Exception as e:
+            self._send_json(500, {'error': f'An error occurred: {str(e)}'})
+            return
+
+        response = main.pipeline_result_to_dict(result)
+        # Coalesced requests share one result, so report the question this caller asked
+        response['question'] = question
+        self._send_json(200, response)
+
+    def _stream_query(self, question):
+        """
+        Send the pipeline's events (see main.stream_pipeline) as newline-delimited JSON while
+        it runs on the worker pool: the SQL, the row count, the response tokens and then the
+        full result
+        """
+        try:
+            events, cancelled = self.service.submit_stream(question)
+        except ServiceOverloadedError as e:
+            self._send_json(429, {'error': str(e)}, headers={'Retry-After': '1'})
+            return
+
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            for event in iter(events.get, None):
+                if event['event'] == 'done':
+                    event = {'event': 'done', 'result': main.pipeline_result_to_dict(event['result'])}
+                self.wfile.write(json.dumps(event, default=str).encode('utf-8') + b'\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client went away; the worker stops the pipeline at its next event
+            pass
+        finally:
+            cancelled.set()
+
+    def _post_page(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            cursor = payload['cursor']
+            page_size = payload.get('page_size')
+            if not isinstance(cursor, str) or not (page_size is None or isinstance(page_size, int)):
+                raise TypeError
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._send_json(400, {'error': 'expected a JSON body with a "cursor" string and optional "page_size"'})
+            return
+
+        # Pages are a single bounded query, so they run on the request thread
+        try:
+            page = main.fetch_result_page(cursor, page_size)
+        except PageCursorError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+        except Exception as e:
+            self._send_json(500, {'error': f'An error occurred: {str(e)}'})
+            return
+        self._send_json(200, page.to_dict())
+
+    def log_message(self, format, *args):
+        # Keep request logging quiet; /stats exposes the counters instead
+        pass
+
+
+def create_server(host='127.0.0.1', port=8000, workers=SERVER_WORKERS, queue_size=SERVER_QUEUE_SIZE,
+                  request_timeout=SERVER_REQUEST_TIMEOUT):
+    """
+    Create the HTTP server with its own query service; call serve_forever() to run it
+    """
+    handler = type('BoundQueryRequestHandler', (QueryRequestHandler,), {
+        'service': QueryService(workers=workers, queue_size=queue_size),
+        'request_timeout': request_timeout
+    })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the employee database query pipeline over HTTP")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=SERVER_WORKERS, help="questions processed at once")
+    parser.add_argument('--queue-size', type=int, default=SERVER_QUEUE_SIZE,
+                        help="questions allowed to wait before requests get 429")
+    parser.add_argument('--timeout', type=float, default=SERVER_REQUEST_TIMEOUT, help="seconds allowed per request")
+    args = parser.parse_args(argv)
+
+    warm_up()
+    server = create_server(args.host, args.port, args.workers, args.queue_size, args.timeout)
+    print(f"Serving on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.RequestHandlerClass.service.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    run()
@@ -1,5 +1,10 @@
+import argparse
 import sqlite3
 import datetime
+import math
+import random
+import time
+from itertools import islice
 
 def create_database():
     conn = sqlite3.connect('employees.db')
@@ -71,8 +76,8 @@ def create_database():
     ]
 
     # Clear existing data and insert new data
-    cursor.execute('DROP TABLE IF EXISTS employee_stats')
-    cursor.execute('DROP TABLE IF EXISTS employees')
+    for table in ROLLUP_TABLE_NAMES + ['employee_stats', 'employees']:
+        cursor.execute(f'DROP TABLE IF EXISTS {table}')
     
     # Recreate tables
     cursor.execute('''
@@ -120,9 +125,567 @@ def create_database():
     VALUES (?, ?, ?, ?, ?)
     ''', stats_data)
 
+    build_rollups(cursor)
     conn.commit()
+
+    # WAL lets the read-only pooled connections in main.py read while the database is written
+    cursor.execute('PRAGMA journal_mode=WAL')
     conn.close()
 
+# Departments with their share of the workforce and salary band for regular employees
+DEPARTMENTS = [
+    ('Engineering', 0.30, 70000, 140000),
+    ('Sales', 0.18, 45000, 110000),
+    ('Operations', 0.12, 40000, 90000),
+    ('Customer Support', 0.10, 35000, 70000),
+    ('Finance', 0.07, 55000, 120000),
+    ('Marketing', 0.07, 50000, 110000),
+    ('Product', 0.06, 75000, 150000),
+    ('IT', 0.05, 55000, 115000),
+    ('HR', 0.03, 45000, 95000),
+    ('Legal', 0.02, 70000, 160000)
+]
+
+JOB_TITLES = {
+    'Engineering': ['Software Engineer', 'Senior Engineer', 'Junior Engineer', 'QA Engineer', 'DevOps Engineer'],
+    'Sales': ['Account Executive', 'Sales Representative', 'Sales Engineer'],
+    'Operations': ['Operations Analyst', 'Logistics Coordinator', 'Operations Specialist'],
+    'Customer Support': ['Support Specialist', 'Support Engineer'],
+    'Finance': ['Financial Analyst', 'Junior Analyst', 'Accountant'],
+    'Marketing': ['Marketing Specialist', 'Content Writer', 'Marketing Analyst'],
+    'Product': ['Product Manager', 'Product Designer', 'UX Researcher'],
+    'IT': ['Systems Administrator', 'IT Support Technician', 'Network Engineer'],
+    'HR': ['HR Generalist', 'Recruiter', 'HR Coordinator'],
+    'Legal': ['Counsel', 'Paralegal', 'Compliance Analyst']
+}
+
+FIRST_NAMES = [
+    'James', 'Mary', 'John', 'Patricia', 'Robert', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth',
+    'William', 'Barbara', 'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Charles', 'Karen',
+    'Daniel', 'Lisa', 'Matthew', 'Nancy', 'Anthony', 'Sandra', 'Mark', 'Ashley', 'Wei', 'Priya',
+    'Carlos', 'Sofia', 'Ahmed', 'Fatima', 'Hiroshi', 'Yuki', 'Olga', 'Ivan', 'Amara', 'Kwame'
+]
+
+LAST_NAMES = [
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez',
+    'Hernandez', 'Lopez', 'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin',
+    'Lee', 'Chen', 'Wang', 'Patel', 'Kim', 'Nguyen', 'Singh', 'Khan', 'Tanaka', 'Ivanov'
+]
+
+# Employees per first-line manager and first-line managers per department head
+TEAM_SIZE = 8
+MANAGERS_PER_HEAD = 50
+
+FIRST_HIRE_DATE = datetime.date(2005, 1, 1)
+LAST_HIRE_DATE = datetime.date(2024, 12, 31)
+
+EMPLOYEE_INSERT = '''
+INSERT INTO employees (
+    employee_id, first_name, last_name, email, phone_number, hire_date,
+    job_title, department, salary, manager_id, management_level
+)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+STATS_INSERT = '''
+INSERT INTO employee_stats (
+    employee_id, annual_leave_balance, sick_leave_balance,
+    last_promotion_date, performance_rating
+)
+VALUES (?, ?, ?, ?, ?)
+'''
+
+# Created after the bulk load, on the columns the generated SQL filters and joins on
+GENERATED_INDEXES = [
+    'CREATE INDEX idx_employees_department ON employees (department)',
+    'CREATE INDEX idx_employees_manager_id ON employees (manager_id)',
+    'CREATE INDEX idx_employees_hire_date ON employees (hire_date)'
+]
+
+
+# Derived tables: the reporting-line closure (every ancestor/descendant pair, depth 0
+# for the employee itself) and headcount, salary and rating rollups per department and
+# per manager (over everyone below them). Averages are stored next to the sums and
+# counts they come from, so the triggers can keep all three current.
+ROLLUP_TABLES = [
+    '''
+    CREATE TABLE employee_hierarchy (
+        ancestor_id INTEGER NOT NULL,
+        descendant_id INTEGER NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (ancestor_id, descendant_id),
+        FOREIGN KEY (ancestor_id) REFERENCES employees (employee_id),
+        FOREIGN KEY (descendant_id) REFERENCES employees (employee_id)
+    ) WITHOUT ROWID
+    ''',
+    'CREATE INDEX idx_employee_hierarchy_descendant ON employee_hierarchy (descendant_id, depth)',
+    '''
+    CREATE TABLE department_summary (
+        department TEXT PRIMARY KEY,
+        headcount INTEGER NOT NULL DEFAULT 0,
+        salary_sum REAL NOT NULL DEFAULT 0,
+        salary_avg REAL,
+        rated_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum REAL NOT NULL DEFAULT 0,
+        rating_avg REAL
+    )
+    ''',
+    '''
+    CREATE TABLE manager_summary (
+        manager_id INTEGER PRIMARY KEY,
+        direct_reports INTEGER NOT NULL DEFAULT 0,
+        headcount INTEGER NOT NULL DEFAULT 0,
+        salary_sum REAL NOT NULL DEFAULT 0,
+        salary_avg REAL,
+        rated_count INTEGER NOT NULL DEFAULT 0,
+        rating_sum REAL NOT NULL DEFAULT 0,
+        rating_avg REAL,
+        FOREIGN KEY (manager_id) REFERENCES employees (employee_id)
+    )
+    '''
+]
+
+ROLLUP_TABLE_NAMES = ['employee_hierarchy', 'department_summary', 'manager_summary']
+
+
+def _rollup_update(table, where, headcount, salary, rated, rating):
+    """
+    UPDATE statement adding the given deltas to rollup rows and recomputing their averages
+    """
+    return f'''
+        UPDATE {table} SET
+            headcount = headcount + ({headcount}),
+            salary_sum = salary_sum + ({salary}),
+            salary_avg = (salary_sum + ({salary})) / NULLIF(headcount + ({headcount}), 0),
+            rated_count = rated_count + ({rated}),
+            rating_sum = rating_sum + ({rating}),
+            rating_avg = (rating_sum + ({rating})) / NULLIF(rated_count + ({rated}), 0)
+        WHERE {where};'''
+
+
+def _rating_of(employee):
+    return f'(SELECT performance_rating FROM employee_stats WHERE employee_id = {employee})'
+
+
+def _ancestors_of(employee):
+    return (f'manager_id IN (SELECT ancestor_id FROM employee_hierarchy '
+            f'WHERE descendant_id = {employee} AND depth > 0)')
+
+
+def _department_of(employee):
+    return f'department = (SELECT department FROM employees WHERE employee_id = {employee})'
+
+
+def _own(salary, rating):
+    # (headcount, salary, rated, rating) contributed by a single employee
+    return ('1', salary, f'{rating} IS NOT NULL', f'COALESCE({rating}, 0)')
+
+
+def _subtree(root, salary, rating):
+    # (headcount, salary, rated, rating) of root and everyone below it; root's own salary and
+    # rating are passed in because the trigger may see them before or after the change
+    below = f'FROM employee_hierarchy h JOIN {{}} WHERE h.ancestor_id = {root} AND h.depth > 0'
+    people = below.format('employees e ON e.employee_id = h.descendant_id')
+    ratings = below.format('employee_stats s ON s.employee_id = h.descendant_id')
+    return (
+        f'1 + (SELECT COUNT(*) {people})',
+        f'{salary} + (SELECT COALESCE(SUM(e.salary), 0) {people})',
+        f'({rating} IS NOT NULL) + (SELECT COUNT(s.performance_rating) {ratings})',
+        f'COALESCE({rating}, 0) + (SELECT COALESCE(SUM(s.performance_rating), 0) {ratings})'
+    )
+
+
+def _negate(deltas):
+    return tuple(f'-({delta})' for delta in deltas)
+
+
+def _rating_change(new, old):
+    return ('0', '0', f'({new} IS NOT NULL) - ({old} IS NOT NULL)', f'COALESCE({new}, 0) - COALESCE({old}, 0)')
+
+
+ROLLUP_TRIGGERS = [
+    f'''
+    CREATE TRIGGER employees_rollup_insert AFTER INSERT ON employees
+    BEGIN
+        INSERT INTO employee_hierarchy (ancestor_id, descendant_id, depth)
+        SELECT ancestor_id, NEW.employee_id, depth + 1 FROM employee_hierarchy WHERE descendant_id = NEW.manager_id
+        UNION ALL SELECT NEW.employee_id, NEW.employee_id, 0;
+        INSERT OR IGNORE INTO department_summary (department) VALUES (NEW.department);
+        {_rollup_update('department_summary', 'department = NEW.department',
+                        *_own('NEW.salary', _rating_of('NEW.employee_id')))}
+        INSERT OR IGNORE INTO manager_summary (manager_id)
+        SELECT ancestor_id FROM employee_hierarchy WHERE descendant_id = NEW.employee_id AND depth > 0;
+        {_rollup_update('manager_summary', _ancestors_of('NEW.employee_id'),
+                        *_own('NEW.salary', _rating_of('NEW.employee_id')))}
+        UPDATE manager_summary SET direct_reports = direct_reports + 1 WHERE manager_id = NEW.manager_id;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER employees_rollup_delete AFTER DELETE ON employees
+    BEGIN
+        {_rollup_update('department_summary', 'department = OLD.department',
+                        *_negate(_own('OLD.salary', _rating_of('OLD.employee_id'))))}
+        {_rollup_update('manager_summary', _ancestors_of('OLD.employee_id'),
+                        *_negate(_subtree('OLD.employee_id', 'OLD.salary', _rating_of('OLD.employee_id'))))}
+        UPDATE manager_summary SET direct_reports = direct_reports - 1 WHERE manager_id = OLD.manager_id;
+        DELETE FROM employee_hierarchy
+        WHERE descendant_id IN (SELECT descendant_id FROM employee_hierarchy WHERE ancestor_id = OLD.employee_id)
+          AND ancestor_id IN (SELECT ancestor_id FROM employee_hierarchy WHERE descendant_id = OLD.employee_id);
+        DELETE FROM manager_summary WHERE manager_id = OLD.employee_id OR headcount = 0;
+        DELETE FROM department_summary WHERE headcount = 0;
+    END
+    ''',
+    # Same manager: the department rows swap the employee over, ancestors only see the salary change
+    f'''
+    CREATE TRIGGER employees_rollup_update AFTER UPDATE OF salary, department ON employees
+    WHEN NEW.manager_id IS OLD.manager_id
+    BEGIN
+        {_rollup_update('department_summary', 'department = OLD.department',
+                        *_negate(_own('OLD.salary', _rating_of('OLD.employee_id'))))}
+        INSERT OR IGNORE INTO department_summary (department) VALUES (NEW.department);
+        {_rollup_update('department_summary', 'department = NEW.department',
+                        *_own('NEW.salary', _rating_of('NEW.employee_id')))}
+        {_rollup_update('manager_summary', _ancestors_of('NEW.employee_id'),
+                        '0', 'NEW.salary - OLD.salary', '0', '0')}
+        DELETE FROM department_summary WHERE headcount = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER employees_hierarchy_cycle BEFORE UPDATE OF manager_id ON employees
+    WHEN NEW.manager_id IS NOT OLD.manager_id
+    BEGIN
+        SELECT RAISE(ABORT, 'manager_id would make an employee report to themselves')
+        WHERE EXISTS (
+            SELECT 1 FROM employee_hierarchy WHERE ancestor_id = NEW.employee_id AND descendant_id = NEW.manager_id
+        );
+    END
+    ''',
+    # A new manager moves the whole subtree: take it off the old chain, rewire its
+    # closure rows, then add it to the new chain
+    f'''
+    CREATE TRIGGER employees_rollup_move AFTER UPDATE OF manager_id ON employees
+    WHEN NEW.manager_id IS NOT OLD.manager_id
+    BEGIN
+        {_rollup_update('department_summary', 'department = OLD.department',
+                        *_negate(_own('OLD.salary', _rating_of('OLD.employee_id'))))}
+        INSERT OR IGNORE INTO department_summary (department) VALUES (NEW.department);
+        {_rollup_update('department_summary', 'department = NEW.department',
+                        *_own('NEW.salary', _rating_of('NEW.employee_id')))}
+        {_rollup_update('manager_summary', _ancestors_of('NEW.employee_id'),
+                        *_negate(_subtree('NEW.employee_id', 'OLD.salary', _rating_of('NEW.employee_id'))))}
+        UPDATE manager_summary SET direct_reports = direct_reports - 1 WHERE manager_id = OLD.manager_id;
+        DELETE FROM employee_hierarchy
+        WHERE descendant_id IN (SELECT descendant_id FROM employee_hierarchy WHERE ancestor_id = NEW.employee_id)
+          AND ancestor_id IN (
+              SELECT ancestor_id FROM employee_hierarchy WHERE descendant_id = NEW.employee_id AND depth > 0
+          );
+        INSERT INTO employee_hierarchy (ancestor_id, descendant_id, depth)
+        SELECT a.ancestor_id, d.descendant_id, a.depth + d.depth + 1
+        FROM employee_hierarchy a JOIN employee_hierarchy d
+        WHERE a.descendant_id = NEW.manager_id AND d.ancestor_id = NEW.employee_id;
+        INSERT OR IGNORE INTO manager_summary (manager_id)
+        SELECT ancestor_id FROM employee_hierarchy WHERE descendant_id = NEW.employee_id AND depth > 0;
+        {_rollup_update('manager_summary', _ancestors_of('NEW.employee_id'),
+                        *_subtree('NEW.employee_id', 'NEW.salary', _rating_of('NEW.employee_id')))}
+        UPDATE manager_summary SET direct_reports = direct_reports + 1 WHERE manager_id = NEW.manager_id;
+        DELETE FROM manager_summary WHERE headcount = 0;
+        DELETE FROM department_summary WHERE headcount = 0;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER employee_stats_rollup_insert AFTER INSERT ON employee_stats
+    BEGIN
+        {_rollup_update('department_summary', _department_of('NEW.employee_id'),
+                        *_rating_change('NEW.performance_rating', 'NULL'))}
+        {_rollup_update('manager_summary', _ancestors_of('NEW.employee_id'),
+                        *_rating_change('NEW.performance_rating', 'NULL'))}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER employee_stats_rollup_delete AFTER DELETE ON employee_stats
+    BEGIN
+        {_rollup_update('department_summary', _department_of('OLD.employee_id'),
+                        *_rating_change('NULL', 'OLD.performance_rating'))}
+        {_rollup_update('manager_summary', _ancestors_of('OLD.employee_id'),
+                        *_rating_change('NULL', 'OLD.performance_rating'))}
+    END
+    ''',
+    f'''
+    CREATE TRIGGER employee_stats_rollup_update AFTER UPDATE OF performance_rating ON employee_stats
+    BEGIN
+        {_rollup_update('department_summary', _department_of('NEW.employee_id'),
+                        *_rating_change('NEW.performance_rating', 'OLD.performance_rating'))}
+        {_rollup_update('manager_summary', _ancestors_of('NEW.employee_id'),
+                        *_rating_change('NEW.performance_rating', 'OLD.performance_rating'))}
+    END
+    '''
+]
+
+# Set-based (re)build of the derived tables from employees and employee_stats
+ROLLUP_REBUILD = [
+    '''
+    INSERT INTO employee_hierarchy (ancestor_id, descendant_id, depth)
+    WITH RECURSIVE chain (ancestor_id, descendant_id, depth) AS (
+        SELECT employee_id, employee_id, 0 FROM employees
+        UNION ALL
+        SELECT e.manager_id, c.descendant_id, c.depth + 1
+        FROM chain c JOIN employees e ON e.employee_id = c.ancestor_id
+        JOIN employees m ON m.employee_id = e.manager_id
+    )
+    SELECT ancestor_id, descendant_id, depth FROM chain
+    ''',
+    '''
+    INSERT INTO department_summary
+        (department, headcount, salary_sum, salary_avg, rated_count, rating_sum, rating_avg)
+    SELECT e.department, COUNT(*), SUM(e.salary), AVG(e.salary),
+           COUNT(s.performance_rating), COALESCE(SUM(s.performance_rating), 0), AVG(s.performance_rating)
+    FROM employees e LEFT JOIN employee_stats s ON s.employee_id = e.employee_id
+    GROUP BY e.department
+    ''',
+    '''
+    INSERT INTO manager_summary
+        (manager_id, direct_reports, headcount, salary_sum, salary_avg, rated_count, rating_sum, rating_avg)
+    SELECT h.ancestor_id, SUM(h.depth = 1), COUNT(*), SUM(e.salary), AVG(e.salary),
+           COUNT(s.performance_rating), COALESCE(SUM(s.performance_rating), 0), AVG(s.performance_rating)
+    FROM employee_hierarchy h
+    JOIN employees e ON e.employee_id = h.descendant_id
+    LEFT JOIN employee_stats s ON s.employee_id = h.descendant_id
+    WHERE h.depth > 0
+    GROUP BY h.ancestor_id
+    '''
+]
+
+
+def build_rollups(conn):
+    """
+    (Re)create the hierarchy closure and rollup tables from the current data and
+    install the triggers that keep them up to date
+    """
+    for table in ROLLUP_TABLE_NAMES:
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+    for statement in ROLLUP_TABLES + ROLLUP_REBUILD + ROLLUP_TRIGGERS:
+        conn.execute(statement)
+
+
+def check_rollups(conn):
+    """
+    Rebuild the derived tables from scratch into temp tables and return the names of
+    those whose maintained contents differ
+    """
+    differing = []
+    for table in ROLLUP_TABLE_NAMES:
+        conn.execute(f'CREATE TEMP TABLE expected_{table} AS SELECT * FROM main.{table} WHERE 0')
+    try:
+        for statement in ROLLUP_REBUILD:
+            for table in ROLLUP_TABLE_NAMES:
+                statement = statement.replace(f'INSERT INTO {table}', f'INSERT INTO expected_{table}')
+            conn.execute(statement.replace('FROM employee_hierarchy', 'FROM expected_employee_hierarchy'))
+        for table in ROLLUP_TABLE_NAMES:
+            maintained = sorted(conn.execute(f'SELECT * FROM main.{table}'))
+            expected = sorted(conn.execute(f'SELECT * FROM expected_{table}'))
+            # Sums maintained by deltas drift from a fresh SUM in the last float digits
+            if len(maintained) != len(expected) or not all(
+                len(row) == len(other) and all(
+                    a == b or (isinstance(a, float) and isinstance(b, float) and math.isclose(a, b))
+                    for a, b in zip(row, other)
+                )
+                for row, other in zip(maintained, expected)
+            ):
+                differing.append(table)
+    finally:
+        for table in ROLLUP_TABLE_NAMES:
+            conn.execute(f'DROP TABLE IF EXISTS temp.expected_{table}')
+    return differing
+
+
+def department_sizes(num_employees):
+    """
+    Split the employees below the CEO across departments by their share, largest remainder first
+    """
+    remaining = num_employees - 1
+    exact = [share * remaining for _, share, _, _ in DEPARTMENTS]
+    sizes = [int(value) for value in exact]
+    by_remainder = sorted(range(len(DEPARTMENTS)), key=lambda index: exact[index] - sizes[index], reverse=True)
+    for index in by_remainder[:remaining - sum(sizes)]:
+        sizes[index] += 1
+    return sizes
+
+
+def generate_rows(num_employees, seed=42):
+    """
+    Yield (employee, stats) row pairs for a company of num_employees.
+
+    The CEO (level 3) heads one or more department heads (level 2) per department,
+    each leading up to MANAGERS_PER_HEAD managers (level 1), each leading a team of
+    about TEAM_SIZE employees (level 0). The same seed always yields the same rows.
+    """
+    rng = random.Random(seed)
+    hire_span = (LAST_HIRE_DATE - FIRST_HIRE_DATE).days
+    next_id = 1
+
+    def person(employee_id, title, department, salary, manager_id, level):
+        first_name = rng.choice(FIRST_NAMES)
+        last_name = rng.choice(LAST_NAMES)
+        # Senior staff tend to have been hired earlier
+        hire_offset = int(hire_span * rng.random() ** (1 + level))
+        hire_date = FIRST_HIRE_DATE + datetime.timedelta(days=hire_offset)
+        employee = (
+            employee_id, first_name, last_name,
+            f'{first_name}.{last_name}.{employee_id}@company.com'.lower(),
+            f'555-{employee_id:07d}', hire_date.isoformat(), title, department,
+            round(salary, 2), manager_id, level
+        )
+        promoted = rng.random() < 0.6 and hire_date < LAST_HIRE_DATE
+        last_promotion_date = None
+        if promoted:
+            days_since_hire = (LAST_HIRE_DATE - hire_date).days
+            last_promotion_date = (hire_date + datetime.timedelta(days=rng.randint(1, days_since_hire))).isoformat()
+        stats = (
+            employee_id, rng.randint(0, 30), rng.randint(0, 12), last_promotion_date,
+            round(min(5.0, max(1.0, rng.gauss(3.8, 0.5))), 2)
+        )
+        return employee, stats
+
+    yield person(next_id, 'CEO', 'Executive', 250000.00, None, 3)
+    ceo_id = next_id
+    next_id += 1
+
+    for (department, _, low, high), size in zip(DEPARTMENTS, department_sizes(num_employees)):
+        if size == 0:
+            continue
+        managers = max(1, size // (TEAM_SIZE + 1)) if size > 1 else 0
+        heads = max(1, -(-managers // MANAGERS_PER_HEAD))
+        managers = max(0, min(managers, size - heads))
+        staff = size - heads - managers
+
+        head_ids = list(range(next_id, next_id + heads))
+        for index, head_id in enumerate(head_ids):
+            title = f'Head of {department}' if index == 0 else f'Director of {department}'
+            yield person(head_id, title, department, rng.uniform(high * 1.3, high * 1.8), ceo_id, 2)
+        next_id += heads
+
+        manager_ids = list(range(next_id, next_id + managers))
+        for index, manager_id in enumerate(manager_ids):
+            yield person(manager_id, f'{department} Manager', department,
+                         rng.uniform(high * 0.9, high * 1.3), head_ids[index // MANAGERS_PER_HEAD % heads], 1)
+        next_id += managers
+
+        leads = manager_ids or head_ids
+        titles = JOB_TITLES[department]
+        for index in range(staff):
+            yield person(next_id, rng.choice(titles), department, rng.uniform(low, high),
+                         leads[index % len(leads)], 0)
+            next_id += 1
+
+
+def generate_database(num_employees, db_path='employees.db', seed=42, chunk_size=10000):
+    """
+    Create the employee database filled with num_employees generated employees.
+
+    Rows are written with chunked executemany calls inside a single transaction,
+    with journaling and syncing turned off for the load; indexes, the hierarchy
+    and rollup tables and planner statistics are built once the data is in.
+    Returns the load timings.
+    """
+    if num_employees < 1:
+        raise ValueError("num_employees must be at least 1")
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode=OFF')
+        conn.execute('PRAGMA synchronous=OFF')
+        conn.execute('PRAGMA cache_size=-262144')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        for table in ROLLUP_TABLE_NAMES + ['employee_stats', 'employees']:
+            conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.execute('''
+        CREATE TABLE employees (
+            employee_id INTEGER PRIMARY KEY,
+            first_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            email TEXT UNIQUE NOT NULL,
+            phone_number TEXT,
+            hire_date DATE NOT NULL,
+            job_title TEXT NOT NULL,
+            department TEXT NOT NULL,
+            salary DECIMAL(10, 2) NOT NULL,
+            manager_id INTEGER,
+            management_level INTEGER DEFAULT 0,
+            FOREIGN KEY (manager_id) REFERENCES employees (employee_id)
+        )
+        ''')
+        conn.execute('''
+        CREATE TABLE employee_stats (
+            employee_id INTEGER PRIMARY KEY,
+            annual_leave_balance INTEGER DEFAULT 20,
+            sick_leave_balance INTEGER DEFAULT 10,
+            last_promotion_date DATE,
+            performance_rating DECIMAL(3,2),
+            FOREIGN KEY (employee_id) REFERENCES employees (employee_id)
+        )
+        ''')
+
+        start = time.perf_counter()
+        rows = generate_rows(num_employees, seed=seed)
+        conn.execute('BEGIN')
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            conn.executemany(EMPLOYEE_INSERT, [employee for employee, _ in chunk])
+            conn.executemany(STATS_INSERT, [stats for _, stats in chunk])
+        conn.execute('COMMIT')
+        load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for statement in GENERATED_INDEXES:
+            conn.execute(statement)
+        index_seconds = time.perf_counter() - start
+
+        # Built set-based after the load, so the triggers only pay for later changes
+        start = time.perf_counter()
+        conn.execute('BEGIN')
+        build_rollups(conn)
+        conn.execute('COMMIT')
+        conn.execute('ANALYZE')
+        rollup_seconds = time.perf_counter() - start
+
+        # WAL lets the read-only pooled connections in main.py read while the database is written
+        conn.execute('PRAGMA journal_mode=WAL')
+    finally:
+        conn.close()
+
+    rows_loaded = num_employees * 2
+    return {
+        'employees': num_employees,
+        'rows': rows_loaded,
+        'load_seconds': load_seconds,
+        'rows_per_second': rows_loaded / load_seconds if load_seconds else 0.0,
+        'index_seconds': index_seconds,
+        'rollup_seconds': rollup_seconds
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create the employee database")
+    parser.add_argument('--employees', type=int,
+                        help="generate this many employees instead of the 10-employee sample")
+    parser.add_argument('--db', default='employees.db', help="database file to generate")
+    parser.add_argument('--seed', type=int, default=42, help="random seed for generated data")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="rows per executemany call")
+    args = parser.parse_args(argv)
+
+    if args.employees is None:
+        create_database()
+        print("Database created successfully with sample data, hierarchy and rollup tables!")
+        return
+
+    summary = generate_database(args.employees, db_path=args.db, seed=args.seed, chunk_size=args.chunk_size)
+    print(
+        f"Generated {summary['employees']} employees ({summary['rows']} rows) in "
+        f"{summary['load_seconds']:.2f}s, {summary['rows_per_second']:,.0f} rows/s; "
+        f"indexes built in {summary['index_seconds']:.2f}s, hierarchy and rollups in {summary['rollup_seconds']:.2f}s"
+    )
+
+
 if __name__ == '__main__':
-    create_database()
-    print("Database created successfully with two tables and sample data!") 
\ No newline at end of file
+    main() 
\ No newline at end of file
@@ -0,0 +1,252 @@
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+STRING_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'")
+BLOCK_COMMENT_PATTERN = re.compile(r'/\*.*?\*/', re.DOTALL)
+LINE_COMMENT_PATTERN = re.compile(r'--[^\n]*')
+FIRST_KEYWORD_PATTERN = re.compile(r'^\s*\(*\s*([A-Za-z]+)')
+OUTER_LIMIT_PATTERN = re.compile(r'\blimit\s+\d+(\s*(,|offset)\s*\d+)?\s*$', re.IGNORECASE)
+PLAN_SCAN_PATTERN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+READ_KEYWORDS = {'select', 'with', 'values'}
+
+# Words that can follow a table name but are not aliases
+NON_ALIAS_WORDS = {
+    'as', 'cross', 'except', 'full', 'group', 'having', 'indexed', 'inner', 'intersect', 'join',
+    'left', 'limit', 'natural', 'not', 'on', 'order', 'outer', 'right', 'union', 'using', 'where',
+    'window', 'from', 'select', 'and', 'or', 'by', 'when', 'then', 'else', 'end'
+}
+
+# The alias is only taken when it is not a keyword, so "a, b FROM t" still sees t
+TABLE_REFERENCE_PATTERN = re.compile(
+    r'(?:\bfrom|\bjoin|,)\s+([A-Za-z_]\w*)(?:\s+(?:as\s+)?(?!(?:%s)\b)([A-Za-z_]\w*))?'
+    % '|'.join(sorted(NON_ALIAS_WORDS)),
+    re.IGNORECASE
+)
+
+# Authorizer actions a read-only query may perform
+ALLOWED_ACTIONS = {
+    sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE
+}
+
+
+class SQLGuardError(Exception):
+    """
+    Raised when generated SQL is rejected or exceeds its execution budget
+    """
+
+
+def strip_sql(sql):
+    """
+    Remove comments, string literals and trailing semicolons, leaving only the SQL structure
+    """
+    text = BLOCK_COMMENT_PATTERN.sub(' ', sql)
+    text = LINE_COMMENT_PATTERN.sub(' ', text)
+    text = STRING_LITERAL_PATTERN.sub("''", text)
+    return text.strip().rstrip(';').strip()
+
+
+def check_read_only(sql):
+    """
+    Reject anything that is not a single SELECT/WITH/VALUES statement
+    """
+    structure = strip_sql(sql)
+    if not structure:
+        raise SQLGuardError("The generated SQL is empty")
+    if ';' in structure:
+        raise SQLGuardError("Only a single SQL statement can be executed")
+    match = FIRST_KEYWORD_PATTERN.match(structure)
+    if match is None or match.group(1).lower() not in READ_KEYWORDS:
+        raise SQLGuardError("Only read-only SELECT queries can be executed")
+
+
+def _read_only_authorizer(action, arg1, arg2, database, trigger):
+    return sqlite3.SQLITE_OK if action in ALLOWED_ACTIONS else sqlite3.SQLITE_DENY
+
+
+def table_aliases(sql):
+    """
+    Map every table name and alias referenced in FROM/JOIN clauses to its table name
+    """
+    aliases = {}
+    for table, alias in TABLE_REFERENCE_PATTERN.findall(strip_sql(sql)):
+        aliases[table.lower()] = table.lower()
+        if alias:
+            aliases[alias.lower()] = table.lower()
+    return aliases
+
+
+class SQLGuard:
+    """
+    Pre-flight checks and execution budgets for generated SQL.
+
+    prepare() rejects writes and multi-statement SQL, runs EXPLAIN QUERY PLAN,
+    rejects nested full scans whose row combinations exceed max_join_rows and
+    wraps unbounded full scans of large tables in a LIMIT. budget() enforces a
+    wall-clock and VM-step limit through the connection's progress handler.
+    """
+
+    def __init__(self, max_scan_rows=100_000, max_join_rows=10_000_000, default_limit=1000,
+                 timeout_seconds=10.0, max_vm_steps=50_000_000, progress_interval=10_000,
+                 table_size_ttl=60.0):
+        self.max_scan_rows = max_scan_rows
+        self.max_join_rows = max_join_rows
+        self.default_limit = default_limit
+        self.timeout_seconds = timeout_seconds
+        self.max_vm_steps = max_vm_steps
+        self.progress_interval = progress_interval
+        self.table_size_ttl = table_size_ttl
+        self._lock = threading.Lock()
+        self._table_sizes = {}
+        self.checked = 0
+        self.rejected = 0
+        self.limited = 0
+        self.interrupted = 0
+
+    def table_size(self, conn, table):
+        """
+        Approximate a table's row count from its largest rowid, which is an O(log n) lookup.
+        Sizes are remembered for table_size_ttl seconds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            cached = self._table_sizes.get(table)
+            if cached is not None and now - cached[1] < self.table_size_ttl:
+                return cached[0]
+        try:
+            size = conn.execute(f'SELECT MAX(rowid) FROM "{table}"').fetchone()[0] or 0
+        except sqlite3.Error:
+            # Not a rowid table, e.g. a CTE or view name
+            size = None
+        with self._lock:
+            self._table_sizes[table] = (size, now)
+        return size
+
+    def reset_table_sizes(self):
+        with self._lock:
+            self._table_sizes.clear()
+
+    def explain(self, conn, sql, params=()):
+        """
+        Return the EXPLAIN QUERY PLAN rows as (id, parent, detail)
+        """
+        return [(row[0], row[1], row[3]) for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params)]
+
+    def prepare(self, conn, sql, params=(), limit=True):
+        """
+        Check a query before execution and return (sql_to_run, limited); without limit
+        large scans are left unbounded, for callers that stream every row
+        """
+        with self._lock:
+            self.checked += 1
+        try:
+            check_read_only(sql)
+            conn.set_authorizer(_read_only_authorizer)
+            try:
+                plan = self.explain(conn, sql, params)
+            except sqlite3.DatabaseError as e:
+                raise SQLGuardError(f"The generated SQL was rejected: {e}")
+            finally:
+                conn.set_authorizer(None)
+            limited_sql = self._check_plan(conn, sql, plan)
+            if not limit:
+                limited_sql = None
+        except SQLGuardError:
+            with self._lock:
+                self.rejected += 1
+            raise
+
+        if limited_sql is None:
+            return sql, False
+        with self._lock:
+            self.limited += 1
+        return limited_sql, True
+
+    def _check_plan(self, conn, sql, plan):
+        aliases = table_aliases(sql)
+        scans_by_parent = {}
+        for node_id, parent, detail in plan:
+            match = PLAN_SCAN_PATTERN.match(detail)
+            if match is None or detail.startswith('SCAN CONSTANT ROW'):
+                continue
+            table = aliases.get(match.group(1).lower())
+            size = self.table_size(conn, table) if table else None
+            if size:
+                scans_by_parent.setdefault(parent, []).append((match.group(1), size))
+
+        largest_scan = 0
+        for scans in scans_by_parent.values():
+            # Full scans under the same parent are nested loops of one join
+            combinations = 1
+            for _, size in scans:
+                combinations *= size
+                largest_scan = max(largest_scan, size)
+            if len(scans) > 1 and combinations > self.max_join_rows:
+                described = ' and '.join(f"{name} (~{size} rows)" for name, size in scans)
+                raise SQLGuardError(
+                    f"The generated SQL joins {described} without an index, "
+                    f"about {combinations} row combinations"
+                )
+
+        if largest_scan > self.max_scan_rows and not OUTER_LIMIT_PATTERN.search(strip_sql(sql)):
+            # Newlines keep a trailing line comment from swallowing the LIMIT
+            return f"SELECT * FROM (\n{sql.strip().rstrip(';')}\n) LIMIT {int(self.default_limit)}"
+        return None
+
+    def count_rows(self, conn, sql, params=()):
+        """
+        Count the rows a query returns without fetching them, within the guard's budget,
+        for results cut short by the LIMIT prepare() added; None if the count runs out of budget
+        """
+        try:
+            with self.budget(conn):
+                return conn.execute(f"SELECT COUNT(*) FROM (\n{sql.strip().rstrip(';')}\n)", params).fetchone()[0]
+        except SQLGuardError:
+            return None
+
+    @contextmanager
+    def budget(self, conn, timeout_seconds=None, max_vm_steps=None):
+        """
+        Abort the statement running on the connection once it exceeds the time or VM-step
+        budget; the arguments override the guard's limits for this statement
+        """
+        timeout_seconds = self.timeout_seconds if timeout_seconds is None else timeout_seconds
+        max_vm_steps = self.max_vm_steps if max_vm_steps is None else max_vm_steps
+        deadline = time.perf_counter() + timeout_seconds
+        state = {'steps': 0, 'reason': None}
+
+        def progress():
+            state['steps'] += self.progress_interval
+            if state['steps'] > max_vm_steps:
+                state['reason'] = f"more than {max_vm_steps} VM steps"
+                return 1
+            if time.perf_counter() > deadline:
+                state['reason'] = f"more than {timeout_seconds} seconds"
+                return 1
+            return 0
+
+        conn.set_progress_handler(progress, self.progress_interval)
+        conn.set_authorizer(_read_only_authorizer)
+        try:
+            yield
+        except sqlite3.OperationalError as e:
+            if state['reason'] is None:
+                raise
+            with self._lock:
+                self.interrupted += 1
+            raise SQLGuardError(f"The query was stopped after {state['reason']}") from e
+        finally:
+            conn.set_progress_handler(None, self.progress_interval)
+            conn.set_authorizer(None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'checked': self.checked,
+                'rejected': self.rejected,
+                'limited': self.limited,
+                'interrupted': self.interrupted
+            }
@@ -1,8 +1,58 @@
 import unittest
 import sqlite3
 import os
+import tempfile
+import atexit
+import shutil
+import csv
+import threading
+import urllib.request
+import urllib.error
+import time
+import queue
+
+# Replay the LLM responses recorded in cassettes/ so the suite runs offline;
+# LLM_CASSETTE_MODE=record (or rerecord, for changed prompts) refreshes them
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+os.environ.setdefault('LLM_CASSETTE_MODE', 'replay')
+os.environ.setdefault('LLM_CASSETTE_DIR', os.path.join(TEST_DIR, 'cassettes'))
+if os.environ['LLM_CASSETTE_MODE'] == 'replay':
+    # Replay never reaches the API, but the client still needs a key to be created
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-replay')
+if os.getenv('PYTEST_XDIST_WORKER'):
+    # Parallel workers each get their own employees.db and caches
+    worker_dir = tempfile.mkdtemp(prefix=f"test-{os.environ['PYTEST_XDIST_WORKER']}-")
+    atexit.register(shutil.rmtree, worker_dir, ignore_errors=True)
+    os.chdir(worker_dir)
+
 from main import check_query_relevance, generate_sql_query, execute_sql_query, generate_response
-from setup_database import create_database
+from setup_database import create_database, generate_database, check_rollups
+from query_cache import QueryCache
+from relevance_classifier import RelevanceClassifier
+from result_cache import ResultCache
+from result_fetch import fetch_rows, ResultRows
+from result_export import export_rows, export_request, prune_exports
+from result_pages import PageCursor, PageCursorError, order_keys
+from result_serializer import serialize_results
+from response_templates import render_response
+from sql_guard import SQLGuard, SQLGuardError
+from index_advisor import WorkloadLog, IndexAdvisor
+from benchmark import (MockOpenAIServer, BENCHMARK_QUESTIONS, OFF_TOPIC_QUESTIONS, CANNED_RESPONSE,
+                       summarize_latencies, compare_reports)
+from openai import OpenAI
+from metrics import MetricsRegistry, Histogram
+from tracing import TraceLog, request_trace, trace_stage, record_cache_lookup, current_trace
+from prompt_builder import SchemaPromptBuilder
+from question_compiler import QuestionCompiler, render_sql
+from conversation import ResultSession, RESULT_TABLE
+from query_library import QueryLibrary, SEED_EXAMPLES
+from llm_cassette import Cassette, CassetteMiss
+import json
+import main
+import server
+import async_pipeline
+import asyncio
+import batch
 
 class TestEmployeeDatabaseSystem(unittest.TestCase):
     # Class variable to store test results
@@ -11,9 +61,54 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
         'sql_generation': {'passed': 0, 'total': 0},
         'query_execution': {'passed': 0, 'total': 0},
         'response_generation': {'passed': 0, 'total': 0},
-        'data_integrity': {'passed': 0, 'total': 0}
+        'data_integrity': {'passed': 0, 'total': 0},
+        'sql_cache': {'passed': 0, 'total': 0},
+        'result_cache': {'passed': 0, 'total': 0},
+        'result_export': {'passed': 0, 'total': 0},
+        'conversation': {'passed': 0, 'total': 0},
+        'result_pages': {'passed': 0, 'total': 0},
+        'streaming': {'passed': 0, 'total': 0},
+        'sql_guard': {'passed': 0, 'total': 0},
+        'index_advisor': {'passed': 0, 'total': 0},
+        'data_generator': {'passed': 0, 'total': 0},
+        'rollups': {'passed': 0, 'total': 0},
+        'benchmark': {'passed': 0, 'total': 0},
+        'tracing': {'passed': 0, 'total': 0},
+        'sql_prompt': {'passed': 0, 'total': 0},
+        'local_sql': {'passed': 0, 'total': 0},
+        'query_library': {'passed': 0, 'total': 0},
+        'llm_cassette': {'passed': 0, 'total': 0},
+        'local_relevance': {'passed': 0, 'total': 0},
+        'batch': {'passed': 0, 'total': 0},
+        'http_service': {'passed': 0, 'total': 0}
     }
 
+    # Statistics reported by the local relevance classifier benchmark
+    relevance_classifier_stats = None
+
+    relevant_queries = [
+        "Who has the highest salary?",
+        "Show me all employees in Engineering",
+        "What is the average performance rating?",
+        "List employees with most sick leave"
+    ]
+    irrelevant_queries = [
+        "What's the weather like?",
+        "Tell me a joke",
+        "What time is it?",
+        "How to make coffee?"
+    ]
+    # On-topic questions that use little or none of the schema vocabulary; the local
+    # classifier may pass them to the LLM but must never reject them
+    unlisted_relevant_queries = [
+        "Who has worked here the longest?",
+        "Who has been here the longest?",
+        "Who takes the most time off?",
+        "Who got a raise last year?",
+        "Who sits in the London office?",
+        "Which of our people got promoted?"
+    ]
+
     @classmethod
     def setUpClass(cls):
         """Set up test database before running tests"""
@@ -37,6 +132,10 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
         total_tests = 0
         
         for component, results in cls.test_results.items():
+            if results['total'] == 0:
+                print(f"\n{component.replace('_', ' ').title()}:")
+                print("Not run (no recorded LLM responses to replay)")
+                continue
             accuracy = (results['passed'] / results['total']) * 100 if results['total'] > 0 else 0
             print(f"\n{component.replace('_', ' ').title()}:")
             print(f"Accuracy: {accuracy:.2f}%")
@@ -70,6 +169,22 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
             overall_interpretation = "The system requires major improvements and should not be used in production"
         print(f"Overall Interpretation: {overall_interpretation}")
 
+        cassette_dir = os.environ['LLM_CASSETTE_DIR']
+        if os.environ['LLM_CASSETTE_MODE'] == 'replay' and not (
+                os.path.isdir(cassette_dir) and any(name.endswith('.json') for name in os.listdir(cassette_dir))):
+            print("\nNo LLM responses recorded: the GPT-3.5 relevance, SQL generation and response "
+                  "stages were not tested. The scores above only cover the local classifier, "
+                  "compiled SQL and templated answers.")
+
+        stats = cls.relevance_classifier_stats
+        if stats is not None:
+            print("\nLocal Relevance Classifier:")
+            print(f"Confident decisions: {stats['local_decisions']}")
+            print(f"Fallback rate: {stats['fallback_rate'] * 100:.2f}%")
+            print(f"Average decision time: {stats['average_local_microseconds']:.1f} microseconds")
+            if stats['estimated_seconds_saved'] is not None:
+                print(f"Estimated latency saved: {stats['estimated_seconds_saved']:.2f}s")
+
     def test_database_structure(self):
         """Test if database tables are created correctly"""
         self.__class__.test_results['data_integrity']['total'] += 1
@@ -128,29 +243,73 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
 
     def test_query_relevance(self):
         """Test if query relevance check works correctly"""
-        # Test relevant queries
-        relevant_queries = [
-            "Who has the highest salary?",
-            "Show me all employees in Engineering",
-            "What is the average performance rating?",
-            "List employees with most sick leave"
-        ]
-        for query in relevant_queries:
+        labelled_queries = ([(query, True) for query in self.relevant_queries] +
+                            [(query, False) for query in self.irrelevant_queries])
+        for query, expected in labelled_queries:
+            try:
+                relevant = check_query_relevance(query)
+            except CassetteMiss:
+                # Only responses recorded from the API count towards relevance accuracy
+                continue
             self.__class__.test_results['query_relevance']['total'] += 1
-            if check_query_relevance(query):
+            if relevant == expected:
                 self.__class__.test_results['query_relevance']['passed'] += 1
 
-        # Test irrelevant queries
-        irrelevant_queries = [
-            "What's the weather like?",
-            "Tell me a joke",
-            "What time is it?",
-            "How to make coffee?"
-        ]
-        for query in irrelevant_queries:
-            self.__class__.test_results['query_relevance']['total'] += 1
-            if not check_query_relevance(query):
-                self.__class__.test_results['query_relevance']['passed'] += 1
+    def test_local_relevance_classifier(self):
+        """Benchmark the local relevance classifier against the relevance test cases"""
+        classifier = RelevanceClassifier('employees.db')
+        labelled_queries = ([(query, True) for query in self.relevant_queries] +
+                            [(query, False) for query in self.irrelevant_queries])
+        for query, expected in labelled_queries:
+            # Ambiguous questions fall back to the LLM and are not scored here
+            decision = classifier.classify(query)
+            if decision is None:
+                continue
+            self.__class__.test_results['local_relevance']['total'] += 1
+            if decision == expected:
+                self.__class__.test_results['local_relevance']['passed'] += 1
+        for query in self.unlisted_relevant_queries:
+            self.__class__.test_results['local_relevance']['total'] += 1
+            if classifier.classify(query) is not False:
+                self.__class__.test_results['local_relevance']['passed'] += 1
+        # Off-topic questions that share words with the schema are never accepted locally
+        for query in OFF_TOPIC_QUESTIONS:
+            self.__class__.test_results['local_relevance']['total'] += 1
+            if classifier.classify(query) is not True:
+                self.__class__.test_results['local_relevance']['passed'] += 1
+        self.__class__.relevance_classifier_stats = classifier.stats()
+
+        # Speculative SQL generation only starts when the local classifier is unsure
+        self.__class__.test_results['local_relevance']['total'] += 1
+        mock = MockOpenAIServer().start()
+        client, cassette_mode, speculative = main.client, main.LLM_CASSETTE_MODE, main.SPECULATIVE_EXECUTION
+        cache_enabled = main.SQL_CACHE_ENABLED
+        try:
+            main.client = OpenAI(api_key='sk-speculative', base_url=mock.base_url)
+            main.LLM_CASSETTE_MODE, main.SPECULATIVE_EXECUTION, main.SQL_CACHE_ENABLED = 'off', True, False
+            off_topic = [main.check_query_relevance(query) for query in OFF_TOPIC_QUESTIONS]
+            runs = main._speculative_stats['runs']
+            rejected = main.get_sql_for_question("Tell me a joke", main.new_pipeline_result("Tell me a joke"))
+            local_calls = mock.stats()
+            unsure = main.new_pipeline_result("Who has worked here the longest?")
+            sql_query = main.get_sql_for_question("Who has worked here the longest?", unsure)
+            speculative_runs = main._speculative_stats['runs'] - runs
+        finally:
+            main.client, main.LLM_CASSETTE_MODE, main.SPECULATIVE_EXECUTION = client, cassette_mode, speculative
+            main.SQL_CACHE_ENABLED = cache_enabled
+            mock.stop()
+        try:
+            self.assertEqual(off_topic, [False] * len(OFF_TOPIC_QUESTIONS))
+            self.assertIsNone(rejected)
+            self.assertEqual(local_calls['relevance']['calls'], len(OFF_TOPIC_QUESTIONS))
+            self.assertNotIn('sql', local_calls)
+            self.assertTrue(unsure['relevant'])
+            self.assertIsNotNone(sql_query)
+            self.assertEqual(speculative_runs, 1)
+            self.assertEqual(mock.stats()['sql']['calls'], 1)
+            self.__class__.test_results['local_relevance']['passed'] += 1
+        except AssertionError:
+            pass
 
     def test_sql_generation(self):
         """Test if SQL query generation works correctly"""
@@ -170,9 +329,15 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
         ]
 
         for test_case in test_cases:
-            self.__class__.test_results['sql_generation']['total'] += 1
             try:
                 sql_query = generate_sql_query(test_case["query"])
+            except CassetteMiss:
+                # Only responses recorded from the API count towards SQL generation accuracy
+                continue
+            except Exception:
+                sql_query = ''
+            self.__class__.test_results['sql_generation']['total'] += 1
+            try:
                 all_keywords_present = all(keyword.upper() in sql_query.upper() 
                                         for keyword in test_case["expected_keywords"])
                 if all_keywords_present:
@@ -207,6 +372,997 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
         except Exception:
             pass
 
+    def test_result_streaming(self):
+        """Test if large results are capped at the row budget and the true total is reported"""
+        self.__class__.test_results['query_execution']['total'] += 1
+        try:
+            self.cursor.execute("""
+                WITH RECURSIVE numbers(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM numbers WHERE n < 5000)
+                SELECT n, 'row ' || n FROM numbers
+            """)
+            results = fetch_rows(self.cursor, max_rows=100, batch_size=64)
+            self.assertEqual(len(results), 100)
+            self.assertTrue(results.truncated)
+            self.assertEqual(results.total_count, 5000)
+
+            # A small result fits the budget untouched
+            self.cursor.execute("SELECT employee_id FROM employees")
+            results = fetch_rows(self.cursor, max_rows=100)
+            self.assertFalse(results.truncated)
+            self.assertEqual(results.total_count, len(results))
+            self.__class__.test_results['query_execution']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_result_cache(self):
+        """Test if cached results are reused for equivalent SQL and invalidated by writes"""
+        self.__class__.test_results['result_cache']['total'] += 1
+        try:
+            cache = ResultCache('employees.db')
+            query = "SELECT first_name FROM employees WHERE department = 'Engineering'"
+            self.assertIsNone(cache.get(query))
+            data_version = cache.data_version()
+            self.cursor.execute(query)
+            cache.put(query, (), ['first_name'], ResultRows(self.cursor.fetchall()), data_version)
+
+            # Whitespace, case and trailing semicolons do not change the key, string literals do
+            self.assertIsNotNone(cache.get("select first_name\n  FROM employees where department = 'Engineering';"))
+            self.assertIsNone(cache.get("SELECT first_name FROM employees WHERE department = 'engineering'"))
+            # SQLite reads a double-quoted string as a literal when no column has its name
+            double_quoted = 'SELECT first_name FROM employees WHERE department = "Engineering"'
+            self.cursor.execute(double_quoted)
+            cache.put(double_quoted, (), ['first_name'], ResultRows(self.cursor.fetchall()), data_version)
+            self.assertIsNotNone(cache.get(double_quoted.lower().replace('"engineering"', '"Engineering"')))
+            self.assertIsNone(cache.get('SELECT first_name FROM employees WHERE department = "engineering"'))
+
+            # Results that depend on the clock or random() are never served from the cache
+            for volatile in ["SELECT COUNT(*) FROM employees WHERE hire_date > date('now', '-1 year')",
+                             "SELECT first_name FROM employees WHERE hire_date < CURRENT_DATE",
+                             "SELECT first_name FROM employees ORDER BY random() LIMIT 1"]:
+                self.cursor.execute(volatile)
+                cache.put(volatile, (), ['value'], ResultRows(self.cursor.fetchall()), data_version)
+                self.assertIsNone(cache.get(volatile))
+            self.assertEqual(cache.stats()['skipped'], 3)
+            fixed_date = "SELECT COUNT(*) FROM employees WHERE hire_date > date('2020-01-01')"
+            self.cursor.execute(fixed_date)
+            cache.put(fixed_date, (), ['count'], ResultRows(self.cursor.fetchall()), data_version)
+            self.assertIsNotNone(cache.get(fixed_date))
+
+            # Any committed write empties the cache
+            self.cursor.execute("UPDATE employees SET salary = salary + 1 WHERE employee_id = 1")
+            self.conn.commit()
+            self.assertIsNone(cache.get(query))
+            self.assertGreater(cache.stats()['hit_ratio'], 0)
+            self.__class__.test_results['result_cache']['passed'] += 1
+        except AssertionError:
+            pass
+        finally:
+            self.cursor.execute("UPDATE employees SET salary = salary - 1 WHERE employee_id = 1")
+            self.conn.commit()
+
+    def test_result_export(self):
+        """Test if large and listing-style results are streamed to a file and only summarized"""
+        self.__class__.test_results['result_export']['total'] += 1
+        employees = self.cursor.execute("SELECT COUNT(*) FROM employees").fetchone()[0]
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'export.db')
+            generate_database(3000, db_path=db_path, seed=5)
+            conn = sqlite3.connect(db_path)
+            try:
+                cursor = conn.execute('SELECT employee_id, first_name, salary FROM employees ORDER BY employee_id')
+                columns = [description[0] for description in cursor.description]
+                export = export_rows(cursor, columns, tmp, batch_size=500, keep_rows=3)
+                first_rows = conn.execute(
+                    'SELECT employee_id, first_name, salary FROM employees ORDER BY employee_id LIMIT 3'
+                ).fetchall()
+            finally:
+                conn.close()
+            with open(export.path, newline='', encoding='utf-8') as f:
+                written = list(csv.reader(f))
+
+            export_dir = main.EXPORT_DIR
+            main.EXPORT_DIR = tmp
+            try:
+                exported = main.execute_sql_query("SELECT first_name, last_name FROM employees", (), 'csv', 0)
+                inline = main.execute_sql_query("SELECT first_name FROM employees", (), 'csv', 1000)
+                response, messages = main.prepare_response("Export every employee", exported)
+                files = [name for name in os.listdir(tmp) if name.startswith('export-')]
+
+                # A truncated answer is only exported when the question is listing-style, and
+                # then the export counts the rows instead of a separate COUNT(*)
+                sql_guard, max_rows, cache_enabled = main._sql_guard, main.RESULT_MAX_ROWS, main.RESULT_CACHE_ENABLED
+                counts = []
+                try:
+                    main._sql_guard = SQLGuard(max_scan_rows=5, default_limit=4)
+                    count_rows = main._sql_guard.count_rows
+                    main._sql_guard.count_rows = lambda *args: counts.append(args) or count_rows(*args)
+                    main.RESULT_MAX_ROWS, main.RESULT_CACHE_ENABLED = 3, False
+                    truncated = main.execute_sql_query("SELECT last_name FROM employees")
+                    inline_files = len([name for name in os.listdir(tmp) if name.startswith('export-')])
+                    listing = main.execute_sql_query("SELECT last_name FROM employees", (), 'csv', 1000)
+                finally:
+                    main._sql_guard, main.RESULT_MAX_ROWS = sql_guard, max_rows
+                    main.RESULT_CACHE_ENABLED = cache_enabled
+                if listing[1].export is not None:
+                    os.remove(listing[1].export.path)
+            finally:
+                main.EXPORT_DIR = export_dir
+            # Old files go after the retention period, the oldest beyond the file limit
+            expired = os.path.join(tmp, 'export-expired.csv')
+            open(expired, 'w').close()
+            os.utime(expired, (0, 0))
+            pruned_old = prune_exports(tmp, max_age_seconds=3600)
+            pruned_extra = prune_exports(tmp, max_files=1)
+            remaining = [name for name in os.listdir(tmp) if name.startswith('export-')]
+            try:
+                self.assertEqual(export.row_count, 3000)
+                self.assertEqual(written[0], columns)
+                self.assertEqual(len(written), 3001)
+                self.assertEqual(list(export.preview), first_rows)
+                self.assertEqual(export.preview.total_count, 3000)
+
+                rows = exported[1]
+                self.assertEqual(rows.export.row_count, employees)
+                self.assertTrue(rows.truncated)
+                self.assertLessEqual(len(rows), 5)
+                self.assertEqual((len(inline[1]), inline[1].export), (employees, None))
+                self.assertEqual(sorted(files), sorted([os.path.basename(export.path), os.path.basename(rows.export.path)]))
+                self.assertEqual((len(truncated[1]), truncated[1].export, truncated[1].total_count),
+                                 (3, None, employees))
+                self.assertEqual(inline_files, len(files))
+                self.assertEqual(listing[1].export.row_count, employees)
+                self.assertEqual(len(counts), 1)
+                self.assertIsNone(messages)
+                self.assertIn(rows.export.path, response)
+                self.assertEqual((pruned_old, pruned_extra), (1, 1))
+                self.assertEqual(remaining, [os.path.basename(rows.export.path)])
+
+                self.assertEqual(export_request("Export all employees to parquet"), ('parquet', True))
+                self.assertEqual(export_request("List all employees in Sales"), (None, False))
+                self.assertEqual(export_request("Who has the highest salary?"), (None, None))
+                self.__class__.test_results['result_export']['passed'] += 1
+            except AssertionError:
+                pass
+
+    def test_conversation_followups(self):
+        """Test if follow-up questions are answered from the previous result kept in a TEMP table"""
+        self.__class__.test_results['conversation']['total'] += 1
+        engineers = self.cursor.execute(
+            "SELECT first_name, last_name FROM employees "
+            "WHERE department = 'Engineering' AND job_title = 'Software Engineer' ORDER BY last_name DESC"
+        ).fetchall()
+        finance = self.cursor.execute(
+            "SELECT first_name, salary FROM employees WHERE department = 'Finance' AND salary > 80000 "
+            "ORDER BY salary DESC"
+        ).fetchall()
+
+        session = main.new_conversation()
+        export_dir = main.EXPORT_DIR
+        with tempfile.TemporaryDirectory() as tmp:
+            main.EXPORT_DIR = tmp
+            try:
+                first = main.run_conversation_turn(session, "Show me all employees in engineering")
+                refined = main.run_conversation_turn(session, "now only the software engineers")
+                counted = main.run_conversation_turn(session, "how many of them?")
+                ordered = main.run_conversation_turn(session, "sort them by last name descending")
+                paged = main.run_conversation_turn(session, "next page")
+                unrelated = session.compile("Who has the highest salary?")
+            finally:
+                main.EXPORT_DIR = export_dir
+
+        table = ResultSession(main.DATABASE_PATH, page_size=1)
+        try:
+            salaries = "SELECT first_name, salary, department, salary FROM employees"
+            cursor = self.conn.execute(salaries)
+            columns = [description[0] for description in cursor.description]
+            stored = table.store_cursor("Show everyone's salary", salaries, (), columns, cursor)
+            # "in Finance" only refines the result when the question refers back to it
+            standalone = [table.compile(question) for question in
+                          ("Employees in Finance", "Show employees from Finance")]
+            referring = [table.compile(question) for question in
+                         ("now those in Finance", "what about the ones in Finance", "those in Finance")]
+            filtered = table.compile("just the ones in finance")
+            table.adopt(filtered[1])
+            compared = table.compile("those with salary above 80k")
+            table.adopt(compared[1])
+            sorted_query, _ = table.compile("highest salary first")
+            finance_rows = table.conn.execute(sorted_query.sql, sorted_query.params).fetchall()
+            small = ResultSession(main.DATABASE_PATH, max_rows=2)
+            too_large = not small.store_cursor("All", "-", (), ['first_name'],
+                                               self.conn.execute("SELECT first_name FROM employees"))
+            small.close()
+        finally:
+            table.close()
+            session.close()
+        try:
+            self.assertEqual(first['sql_source'], 'local')
+            self.assertEqual(refined['sql_source'], 'followup')
+            self.assertIn(RESULT_TABLE, refined['sql'])
+            self.assertEqual([row[:2] for row in refined['rows']], sorted(engineers, key=lambda row: row[1]))
+            self.assertEqual(list(counted['rows']), [(len(engineers),)])
+            self.assertEqual([row[:2] for row in ordered['rows']], engineers)
+            self.assertEqual(list(paged['rows']), [])
+            self.assertIsNotNone(paged['response'])
+            self.assertIsNone(unrelated)
+            self.assertEqual(standalone, [None, None])
+            self.assertNotIn(None, referring)
+
+            self.assertTrue(stored)
+            self.assertEqual(columns, ['first_name', 'salary', 'department', 'salary'])
+            self.assertEqual([(row[0], row[1]) for row in finance_rows], finance)
+            self.assertTrue(too_large)
+            self.__class__.test_results['conversation']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_result_pages(self):
+        """Test if keyset pages walk a result exactly once, with ties and NULLs, and cursors cannot be forged"""
+        self.__class__.test_results['result_pages']['total'] += 1
+        conn = sqlite3.connect(':memory:')
+        conn.execute("CREATE TABLE t (id INTEGER PRIMARY KEY, grade, team)")
+        conn.executemany("INSERT INTO t (grade, team) VALUES (?, ?)",
+                         [((None, 1, 2, 2)[i % 4], (None, 'a', 'b')[i % 3]) for i in range(103)])
+        walked = {}
+        for order in ('grade, team', 'grade DESC, team', 't.team DESC', '2 DESC, id', None):
+            sql = "SELECT id, grade, team FROM t" + (f" ORDER BY {order}" if order else "")
+            cursor = PageCursor(sql, (), 10, order_keys(sql, ['id', 'grade', 'team'])).check_nulls(conn)
+            rows = []
+            while True:
+                page_sql, params = cursor.page_query()
+                page = conn.execute(page_sql, params).fetchall()
+                rows += page[:10]
+                if len(page) <= 10:
+                    break
+                cursor = PageCursor.decode(cursor.advance(['id', 'grade', 'team'], page[:10]).encode('key'), 'key')
+            walked[order] = (cursor.mode, rows, conn.execute(sql).fetchall())
+        conn.close()
+
+        # Ties on department: only keyset plus the ties count walks them exactly once
+        sql = "SELECT first_name, department FROM employees ORDER BY department DESC"
+        employees = self.cursor.execute(sql).fetchall()
+        first = ResultRows(employees[:3], truncated=True)
+        token = main.page_cursor_after(sql, (), ['first_name', 'department'], first, page_size=4).encode(
+            main.PAGE_CURSOR_SECRET
+        )
+        paged = list(first)
+        while token is not None:
+            page = main.fetch_result_page(token)
+            paged += page.rows
+            token = page.next_cursor
+
+        session = ResultSession(main.DATABASE_PATH, page_size=2)
+        try:
+            session.store_pages("Everyone by department", sql, (),
+                                main.page_cursor_after(sql, (), ['first_name', 'department'], first, page_size=2))
+            compiled, cursor = session.compile("next page")
+            next_rows = session.conn.execute(compiled.sql, compiled.params).fetchall()
+            session.adopt(cursor, ['first_name', 'department'], next_rows)
+            following = session.compile("next page")[0]
+            following_rows = session.conn.execute(following.sql, following.params).fetchall()
+            unsupported = session.compile("now only the ones in Finance")
+        finally:
+            session.close()
+        try:
+            for order, (mode, rows, expected) in walked.items():
+                self.assertEqual(mode, 'offset' if order is None else 'keyset')
+                self.assertEqual(sorted(rows), sorted(expected))
+                if order is not None:
+                    self.assertEqual([row[1:] for row in rows], [row[1:] for row in expected])
+            self.assertEqual(len(paged), len(employees))
+            self.assertEqual([row[1] for row in paged], [row[1] for row in employees])
+            self.assertEqual(sorted(paged), sorted(employees))
+            with self.assertRaises(PageCursorError):
+                main.fetch_result_page(PageCursor("SELECT * FROM employee_stats").encode('not-the-secret'))
+            self.assertIsNone(order_keys("SELECT name, ROW_NUMBER() OVER (ORDER BY id) AS n FROM t", ['name', 'n']))
+            self.assertEqual(order_keys("SELECT a.x FROM a ORDER BY a.x DESC LIMIT 5", ['x']), [('x', True)])
+
+            self.assertEqual(next_rows + following_rows, employees[3:7])
+            self.assertIsNone(unsupported)
+            self.__class__.test_results['result_pages']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_streaming_responses(self):
+        """Test if the SQL, row count and response tokens are streamed as they are ready, in the REPL and over HTTP"""
+        self.__class__.test_results['streaming']['total'] += 1
+        mock = MockOpenAIServer().start()
+        client, cassette = main.client, main._cassette
+        lookup_known_sql, store_generated_sql = main.lookup_known_sql, main.store_generated_sql
+        rows = [tuple(range(i, i + 5)) for i in range(30)]
+        columns = ['a', 'b', 'c', 'd', 'e']
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                main.client = OpenAI(api_key='sk-stream', base_url=mock.base_url)
+                main._cassette = Cassette(tmp, mode='record')
+                streamed = list(main.stream_response("List everyone", (columns, rows)))
+                replayed = list(main.stream_response("List everyone", (columns, rows)))
+            events = list(main.stream_pipeline("How many employees are there?"))
+            output = list(main.stream_user_input("How many employees are there?"))
+            unrelated = list(main.stream_user_input("What's the weather like?"))
+
+            httpd = server.create_server(port=0)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            request = urllib.request.Request(
+                f'http://127.0.0.1:{httpd.server_address[1]}/query',
+                data=json.dumps({'question': "How many employees are there?", 'stream': True}).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            with urllib.request.urlopen(request, timeout=30) as response:
+                content_type = response.headers['Content-Type']
+                lines = [json.loads(line) for line in response.read().splitlines()]
+            httpd.shutdown()
+            httpd.server_close()
+
+            # Streams run on the worker pool: with its only worker busy, a stream waits its turn
+            release = threading.Event()
+            run_pipeline = main.run_pipeline
+            main.run_pipeline = lambda question: release.wait(10)
+            service = server.QueryService(workers=1, queue_size=2)
+            try:
+                service.submit("Who is blocking the worker?")
+                stream_events, cancelled = service.submit_stream("How many employees are there?")
+                waiting = service.stats()['streaming']
+                with self.assertRaises(queue.Empty):
+                    stream_events.get(timeout=0.2)
+                release.set()
+                pooled = [event['event'] for event in iter(lambda: stream_events.get(timeout=10), None)]
+            finally:
+                release.set()
+                main.run_pipeline = run_pipeline
+                service.shutdown()
+
+            # The async pipeline's SQLite lookups run on its thread pool, not on the event loop
+            blocking_threads = []
+            def on_thread(function):
+                def wrapper(*args):
+                    blocking_threads.append(threading.get_ident())
+                    return function(*args)
+                return wrapper
+            main.lookup_known_sql = on_thread(lookup_known_sql)
+            main.store_generated_sql = on_thread(store_generated_sql)
+
+            async def stream_async():
+                loop_thread = threading.get_ident()
+                events, traces = [], []
+                async for event in async_pipeline.AsyncPipeline().stream_pipeline("How many employees are there?"):
+                    # The stream's trace is not current in the caller between events
+                    events.append(event)
+                    traces.append(current_trace())
+                return loop_thread, events, traces
+            loop_thread, async_events, async_traces = asyncio.run(stream_async())
+        finally:
+            main.client, main._cassette = client, cassette
+            main.lookup_known_sql, main.store_generated_sql = lookup_known_sql, store_generated_sql
+            mock.stop()
+        try:
+            self.assertGreater(len(streamed), 1)
+            self.assertEqual(''.join(streamed), CANNED_RESPONSE)
+            self.assertEqual(replayed, [CANNED_RESPONSE])
+            self.assertEqual(mock.stats()['response']['calls'], 1)
+
+            self.assertEqual([event['event'] for event in events], ['sql', 'rows', 'token', 'done'])
+            self.assertEqual(events[1]['row_count'], 1)
+            result = events[-1]['result']
+            self.assertEqual(events[2]['text'], result['response'])
+            self.assertLessEqual(result['timings']['first_token'], result['timings']['total'])
+            self.assertTrue(output[0].startswith("SQL Query"))
+            self.assertTrue(output[1].startswith("Rows: 1"))
+            self.assertEqual(output[2], result['response'])
+            self.assertEqual(unrelated, [main.UNRELATED_RESPONSE])
+
+            self.assertEqual(content_type, 'application/x-ndjson')
+            self.assertEqual([line['event'] for line in lines], ['sql', 'rows', 'token', 'done'])
+            self.assertEqual(lines[-1]['result']['answer'], result['response'])
+
+            self.assertEqual([event['event'] for event in async_events], ['sql', 'rows', 'token', 'done'])
+            self.assertEqual(async_traces, [None] * 4)
+            self.assertEqual(waiting, 1)
+            self.assertEqual(pooled, ['sql', 'rows', 'token', 'done'])
+            self.assertEqual(len(blocking_threads), 2)
+            self.assertNotIn(loop_thread, blocking_threads)
+            self.__class__.test_results['streaming']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_http_service(self):
+        """Test the HTTP service's backpressure and the coalescing of identical questions"""
+        self.__class__.test_results['http_service']['total'] += 1
+        release = threading.Event()
+        calls = []
+
+        def run_pipeline(question):
+            calls.append(question)
+            release.wait(10)
+            result = main.new_pipeline_result(question)
+            result.update({'relevant': True, 'response': f'Answer to {question}'})
+            return result
+
+        def post(question, stream=False):
+            request = urllib.request.Request(
+                f'http://127.0.0.1:{httpd.server_address[1]}/query',
+                data=json.dumps({'question': question, 'stream': stream}).encode('utf-8'),
+                headers={'Content-Type': 'application/json'}
+            )
+            try:
+                with urllib.request.urlopen(request, timeout=30) as response:
+                    return response.status, response.headers, json.loads(response.read())
+            except urllib.error.HTTPError as e:
+                return e.code, e.headers, json.loads(e.read())
+
+        original = main.run_pipeline
+        main.run_pipeline = run_pipeline
+        httpd = server.create_server(port=0, workers=1, queue_size=1)
+        service = httpd.RequestHandlerClass.service
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        responses = {}
+        try:
+            # One question runs and one waits in the queue; an identical copy of the running one
+            # joins it without taking a slot
+            clients = []
+            for name, question in [('first', "Who is blocking the worker?"), ('copy', "who is blocking the worker"),
+                                   ('queued', "Who is waiting in the queue?")]:
+                client = threading.Thread(target=lambda name=name, question=question:
+                                          responses.__setitem__(name, post(question)))
+                client.start()
+                clients.append(client)
+                while sum(service.stats()[key] for key in ('accepted', 'coalesced')) < len(clients):
+                    time.sleep(0.01)
+            overloaded = post("One question too many?")
+            overloaded_stream = post("One stream too many?", stream=True)
+            release.set()
+            for client in clients:
+                client.join(30)
+            stats = service.stats()
+        finally:
+            release.set()
+            main.run_pipeline = original
+            httpd.shutdown()
+            httpd.server_close()
+            service.shutdown()
+
+        try:
+            for status, headers, body in (overloaded, overloaded_stream):
+                self.assertEqual(status, 429)
+                self.assertEqual(headers['Retry-After'], '1')
+                self.assertIn('capacity', body['error'])
+            self.assertEqual(calls, ["Who is blocking the worker?", "Who is waiting in the queue?"])
+            self.assertEqual([responses[name][0] for name in ('first', 'copy', 'queued')], [200, 200, 200])
+            # Coalesced callers share the answer but each sees the question it asked
+            self.assertEqual(responses['copy'][2]['answer'], "Answer to Who is blocking the worker?")
+            self.assertEqual(responses['copy'][2]['question'], "who is blocking the worker")
+            self.assertEqual((stats['accepted'], stats['coalesced'], stats['rejected']), (2, 1, 2))
+            self.__class__.test_results['http_service']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_sql_guard(self):
+        """Test if writes, Cartesian products and runaway queries are stopped before they pin a worker"""
+        self.__class__.test_results['sql_guard']['total'] += 1
+        conn = sqlite3.connect('file:employees.db?mode=ro', uri=True)
+        try:
+            guard = SQLGuard(max_scan_rows=5, max_join_rows=50, default_limit=3, max_vm_steps=100000)
+            for query in ["DELETE FROM employees", "SELECT 1; DROP TABLE employees",
+                          "WITH x AS (SELECT 1) DELETE FROM employees", "SELECT * FROM employees a, employees b"]:
+                with self.assertRaises(SQLGuardError):
+                    guard.prepare(conn, query)
+
+            # Unbounded scans of large tables get a LIMIT, indexed lookups are left alone
+            sql, limited = guard.prepare(conn, "SELECT first_name FROM employees -- every employee")
+            self.assertTrue(limited)
+            self.assertEqual(len(conn.execute(sql).fetchall()), 3)
+            self.assertFalse(guard.prepare(conn, "SELECT first_name FROM employees WHERE employee_id = 1")[1])
+            employee_count = conn.execute("SELECT COUNT(*) FROM employees").fetchone()[0]
+            self.assertEqual(guard.count_rows(conn, "SELECT first_name FROM employees -- every employee"),
+                             employee_count)
+
+            # A result cut short by the guard's LIMIT still reports the query's true row count
+            sql_guard, max_rows, cache_enabled = main._sql_guard, main.RESULT_MAX_ROWS, main.RESULT_CACHE_ENABLED
+            try:
+                main._sql_guard = SQLGuard(max_scan_rows=5, default_limit=4)
+                main.RESULT_MAX_ROWS, main.RESULT_CACHE_ENABLED = 3, False
+                _, results = main._execute_sql_query("SELECT first_name FROM employees")
+            finally:
+                main._sql_guard, main.RESULT_MAX_ROWS, main.RESULT_CACHE_ENABLED = sql_guard, max_rows, cache_enabled
+            self.assertTrue(results.truncated)
+            self.assertEqual(len(results), 3)
+            self.assertEqual(results.total_count, employee_count)
+
+            with self.assertRaises(SQLGuardError):
+                with guard.budget(conn):
+                    conn.execute("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+                                 "SELECT COUNT(*) FROM n").fetchall()
+            self.__class__.test_results['sql_guard']['passed'] += 1
+        except AssertionError:
+            pass
+        finally:
+            conn.close()
+
+    def test_index_advisor(self):
+        """Test if the index advisor recommends and applies indexes for the logged predicates"""
+        self.__class__.test_results['index_advisor']['total'] += 1
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'employees.db')
+            conn = sqlite3.connect(db_path)
+            try:
+                conn.execute('CREATE TABLE employees (employee_id INTEGER PRIMARY KEY, first_name TEXT, '
+                             'department TEXT, manager_id INTEGER)')
+                conn.executemany('INSERT INTO employees VALUES (?, ?, ?, ?)', [
+                    (i, f'Employee {i}', ['Engineering', 'Finance', 'Sales', 'HR'][i % 4], i // 10 or None)
+                    for i in range(1, 2001)
+                ])
+                conn.commit()
+
+                log_path = os.path.join(tmp, 'workload.db')
+                log = WorkloadLog(log_path, flush_seconds=60)
+                for _ in range(3):
+                    log.record("SELECT first_name FROM employees WHERE department = 'Finance'", 0.01, conn)
+                log.record("SELECT e.first_name FROM employees e JOIN employees m "
+                           "ON e.manager_id = m.employee_id WHERE m.first_name = 'Employee 7'", 0.01, conn)
+                # Executions are buffered in memory and written out in one batch
+                reader = sqlite3.connect(log_path)
+                try:
+                    self.assertEqual(reader.execute("SELECT COUNT(*) FROM workload").fetchone()[0], 0)
+                    self.assertEqual(log.stats(), {'statements': 2, 'executions': 4})
+                    self.assertEqual(reader.execute("SELECT SUM(executions) FROM workload").fetchone()[0], 4)
+                finally:
+                    reader.close()
+                log.record("SELECT e.first_name FROM employees e JOIN employees m "
+                           "ON e.manager_id = m.employee_id WHERE m.first_name = 'Employee 7'", 0.01, conn)
+                log.close()
+                log = WorkloadLog(log_path)
+                self.assertEqual(log.stats(), {'statements': 2, 'executions': 5})
+
+                advisor = IndexAdvisor(db_path)
+                counts = advisor.predicate_counts(log.statements())
+                self.assertEqual(counts[('employees', 'department', 'eq')], 3)
+                self.assertEqual(counts[('employees', 'manager_id', 'join')], 2)
+
+                # Candidates are costed from the plans alone, with and without sqlite_stat1
+                for analyze in (False, True):
+                    if analyze:
+                        conn.execute('ANALYZE')
+                        conn.commit()
+                    recommendations = advisor.recommend(log.statements())
+                    indexed = {tuple(recommendation['columns']) for recommendation in recommendations}
+                    self.assertIn(('department', 'first_name'), indexed)
+                    self.assertTrue(any(columns[0] == 'manager_id' for columns in indexed))
+                    for recommendation in recommendations:
+                        self.assertLess(recommendation['cost_after'], recommendation['cost_before'])
+                        for statement in recommendation['statements']:
+                            self.assertTrue(any('INDEX' in line for line in statement['plan_after']))
+
+                advisor.apply(recommendations)
+                indexes = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+                self.assertIn('idx_employees_department_first_name', indexes)
+                self.__class__.test_results['index_advisor']['passed'] += 1
+            except AssertionError:
+                pass
+            finally:
+                conn.close()
+
+    def test_data_generator(self):
+        """Test if generated databases are deterministic and have a consistent manager hierarchy"""
+        self.__class__.test_results['data_generator']['total'] += 1
+        with tempfile.TemporaryDirectory() as tmp:
+            snapshots = []
+            for name in ('first.db', 'second.db'):
+                db_path = os.path.join(tmp, name)
+                summary = generate_database(2000, db_path=db_path, seed=7, chunk_size=300)
+                conn = sqlite3.connect(db_path)
+                try:
+                    snapshots.append((
+                        conn.execute('SELECT * FROM employees ORDER BY employee_id').fetchall(),
+                        conn.execute('SELECT * FROM employee_stats ORDER BY employee_id').fetchall()
+                    ))
+                    orphaned = conn.execute('''
+                    SELECT COUNT(*) FROM employees e LEFT JOIN employees m ON e.manager_id = m.employee_id
+                    WHERE e.manager_id IS NOT NULL
+                    AND (m.employee_id IS NULL OR m.management_level <= e.management_level)
+                    ''').fetchone()[0]
+                    indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+                finally:
+                    conn.close()
+            try:
+                self.assertEqual(summary['rows'], 4000)
+                self.assertGreater(summary['rows_per_second'], 0)
+                self.assertEqual(len(snapshots[0][0]), 2000)
+                self.assertEqual(len(snapshots[0][1]), 2000)
+                self.assertEqual(snapshots[0], snapshots[1])
+                self.assertEqual(orphaned, 0)
+                self.assertTrue({'idx_employees_department', 'idx_employees_manager_id'} <= indexes)
+                self.__class__.test_results['data_generator']['passed'] += 1
+            except AssertionError:
+                pass
+
+    def test_hierarchy_rollups(self):
+        """Test if the hierarchy closure and rollup tables stay correct as employees change"""
+        self.__class__.test_results['rollups']['total'] += 1
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'rollups.db')
+            generate_database(500, db_path=db_path, seed=3)
+            conn = sqlite3.connect(db_path, isolation_level=None)
+            try:
+                built = check_rollups(conn)
+                top = conn.execute('SELECT employee_id FROM employees WHERE manager_id IS NULL').fetchone()[0]
+                head, lead = conn.execute(
+                    'SELECT manager_id, employee_id FROM employees WHERE management_level = 1 LIMIT 1'
+                ).fetchone()
+                other_head = conn.execute(
+                    'SELECT employee_id FROM employees WHERE management_level = 2 AND employee_id != ? LIMIT 1',
+                    (head,)
+                ).fetchone()[0]
+                member = conn.execute('SELECT employee_id FROM employees WHERE manager_id = ? LIMIT 1',
+                                      (lead,)).fetchone()[0]
+                conn.execute('UPDATE employees SET salary = salary * 1.1 WHERE department = ?', ('Sales',))
+                conn.execute('UPDATE employees SET manager_id = ? WHERE employee_id = ?', (other_head, lead))
+                conn.execute('UPDATE employees SET manager_id = ?, department = ? WHERE employee_id = ?',
+                             (top, 'Research', member))
+                conn.execute("""
+                INSERT INTO employees (employee_id, first_name, last_name, email, hire_date, job_title,
+                                       department, salary, manager_id)
+                VALUES (9001, 'New', 'Hire', 'new.hire@company.com', '2024-01-02', 'Engineer',
+                        'Engineering', 80000, ?)
+                """, (lead,))
+                conn.execute('INSERT INTO employee_stats (employee_id, performance_rating) VALUES (9001, 4.5)')
+                conn.execute('UPDATE employee_stats SET performance_rating = 1.0 WHERE employee_id = ?', (member,))
+                conn.execute('DELETE FROM employee_stats WHERE employee_id = 250')
+                conn.execute('DELETE FROM employees WHERE employee_id = 250')
+                with self.assertRaises(sqlite3.IntegrityError):
+                    conn.execute('UPDATE employees SET manager_id = 9001 WHERE employee_id = ?', (other_head,))
+                maintained = check_rollups(conn)
+
+                under_top = conn.execute(
+                    'SELECT COUNT(*), SUM(depth = 1) FROM employee_hierarchy WHERE ancestor_id = ? AND depth > 0',
+                    (top,)
+                ).fetchone()
+                summary = conn.execute(
+                    'SELECT headcount, direct_reports FROM manager_summary WHERE manager_id = ?', (top,)
+                ).fetchone()
+                employees, direct = conn.execute(
+                    'SELECT COUNT(*) - 1, SUM(manager_id = ?) FROM employees', (top,)
+                ).fetchone()
+                research = conn.execute(
+                    "SELECT headcount, rating_avg FROM department_summary WHERE department = 'Research'"
+                ).fetchone()
+            finally:
+                conn.close()
+            try:
+                self.assertEqual(built, [])
+                self.assertEqual(maintained, [])
+                self.assertEqual(under_top, (employees, direct))
+                self.assertEqual(summary, (employees, direct))
+                self.assertEqual(research, (1, 1.0))
+                self.__class__.test_results['rollups']['passed'] += 1
+            except AssertionError:
+                pass
+
+    def test_benchmark_harness(self):
+        """Test if the OpenAI stand-in answers like the real API and regressions between reports are found"""
+        self.__class__.test_results['benchmark']['total'] += 1
+        mock = MockOpenAIServer(latency=0.01).start()
+        try:
+            question, sql = next(iter(BENCHMARK_QUESTIONS.items()))
+            local_client = OpenAI(api_key='sk-benchmark', base_url=mock.base_url)
+            response = local_client.chat.completions.create(
+                model="gpt-3.5-turbo",
+                messages=[{"role": "system", "content": "You are an SQL expert."},
+                          {"role": "user", "content": question}]
+            )
+            self.assertEqual(response.choices[0].message.content, sql)
+            self.assertEqual(mock.stats()['sql']['calls'], 1)
+            self.assertGreater(response.usage.prompt_tokens, 0)
+
+            latencies = summarize_latencies([i / 1000 for i in range(1, 101)])
+            self.assertAlmostEqual(latencies['p50'], 50.0)
+            self.assertAlmostEqual(latencies['p99'], 99.0)
+
+            scenario = {'name': 'process_user_input', 'concurrency': 1, 'throughput': 10.0,
+                        'stages': {'total': {'p50': 100.0, 'p95': 200.0, 'p99': 300.0}}}
+            baseline = {'runs': [{'employees': 1000, 'scenarios': [scenario]}]}
+            slower = {'runs': [{'employees': 1000, 'scenarios': [dict(
+                scenario, throughput=5.0, stages={'total': {'p50': 100.0, 'p95': 400.0, 'p99': 300.0}}
+            )]}]}
+            self.assertEqual(compare_reports(baseline, baseline), [])
+            self.assertEqual(len(compare_reports(baseline, slower)), 2)
+            self.__class__.test_results['benchmark']['passed'] += 1
+        except AssertionError:
+            pass
+        finally:
+            mock.stop()
+
+    def test_llm_cassettes(self):
+        """Test if LLM responses are recorded once, replayed offline and re-recorded when the prompt changes"""
+        self.__class__.test_results['llm_cassette']['total'] += 1
+        mock = MockOpenAIServer().start()
+        local_client = OpenAI(api_key='sk-cassette', base_url=mock.base_url)
+        question, sql = next(iter(BENCHMARK_QUESTIONS.items()))
+        request = {'model': 'gpt-3.5-turbo', 'temperature': 0,
+                   'messages': [{"role": "system", "content": "You are an SQL expert."},
+                                {"role": "user", "content": question}]}
+        changed = dict(request, messages=[{"role": "system", "content": "You are an SQL expert. Use SQLite."},
+                                          request['messages'][1]])
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                recorder = Cassette(tmp, mode='record')
+                self.assertIsNone(recorder.replay('sql_generation', request))
+                recorder.record('sql_generation', request, local_client.chat.completions.create(**request))
+                mock.stop()
+
+                player = Cassette(tmp, mode='replay')
+                self.assertEqual(player.replay('sql_generation', request).choices[0].message.content, sql)
+                with self.assertRaises(CassetteMiss):
+                    player.replay('sql_generation', changed)
+                self.assertEqual(player.stats()['stale'], 1)
+                recorder = Cassette(tmp, mode='record')
+                self.assertEqual(recorder.replay('sql_generation', changed).choices[0].message.content, sql)
+                with self.assertRaises(CassetteMiss):
+                    player.replay('relevance', request)
+
+                self.assertIsNone(Cassette(tmp, mode='rerecord').replay('sql_generation', changed))
+                self.assertIsNotNone(Cassette(tmp, mode='rerecord').replay('sql_generation', request))
+                self.assertEqual(len(os.listdir(tmp)), 1)
+            self.__class__.test_results['llm_cassette']['passed'] += 1
+        except AssertionError:
+            pass
+        finally:
+            mock.stop()
+
+    def test_pipeline_tracing(self):
+        """Test if request traces record stages and errors and feed the metrics registry and JSON log"""
+        self.__class__.test_results['tracing']['total'] += 1
+        with tempfile.TemporaryDirectory() as tmp:
+            log = TraceLog(os.path.join(tmp, 'traces.jsonl'))
+            registry = MetricsRegistry()
+            try:
+                with request_trace("How many employees are there?", registry=registry, log=log) as trace:
+                    with trace_stage('execute'):
+                        record_cache_lookup('result', False)
+                with self.assertRaises(ValueError):
+                    with request_trace("Who is the CEO?", registry=registry, log=log):
+                        with trace_stage('sql_generation'):
+                            raise ValueError("bad SQL")
+                with request_trace("Who is the CEO?", enabled=False) as disabled:
+                    self.assertIsNone(disabled)
+                    self.assertIsNone(current_trace())
+                log.close()
+
+                with open(os.path.join(tmp, 'traces.jsonl'), encoding='utf-8') as f:
+                    records = [json.loads(line) for line in f]
+                self.assertEqual(len(records), 2)
+                self.assertEqual(records[0]['trace_id'], trace.trace_id)
+                self.assertIn('execute', records[0]['stages'])
+                self.assertEqual(records[1]['error'], 'ValueError: bad SQL')
+                self.assertEqual(records[1]['error_stage'], 'sql_generation')
+
+                snapshot = registry.snapshot()
+                self.assertEqual(snapshot['counters']['pipeline_requests{path=sync,status=ok}'], 1)
+                self.assertEqual(snapshot['counters']['pipeline_requests{path=sync,status=error}'], 1)
+                self.assertEqual(snapshot['counters']['cache_lookups{cache=result,result=miss}'], 1)
+                self.assertEqual(snapshot['histograms']['pipeline_stage_seconds{stage=execute}']['count'], 1)
+
+                # A streamed request's trace is only current inside its steps: two streams
+                # interleaved on one thread keep their own traces, and one can be closed elsewhere
+                first = main.stream_pipeline("How many employees are there?")
+                second = main.stream_pipeline("How many employees are there?")
+                between = [next(first)['event'], current_trace(), next(second)['event'], current_trace()]
+                done = [list(first)[-1]['result'], list(second)[-1]['result']]
+                abandoned = main.stream_pipeline("How many employees are there?")
+                next(abandoned)
+                closer = threading.Thread(target=abandoned.close)
+                closer.start()
+                closer.join()
+                self.assertEqual(between, ['sql', None, 'sql', None])
+                self.assertIsNone(current_trace())
+                self.assertNotEqual(done[0]['trace_id'], done[1]['trace_id'])
+
+                histogram = Histogram(buckets=(10, 20, 30))
+                for value in range(1, 31):
+                    histogram.observe(value)
+                self.assertAlmostEqual(histogram.percentile(0.5), 15.0)
+                self.__class__.test_results['tracing']['passed'] += 1
+            except AssertionError:
+                pass
+
+    def test_pruned_prompts(self):
+        """Test if SQL prompts list only the tables a question needs and stay below the static prompt"""
+        self.__class__.test_results['sql_prompt']['total'] += 1
+        from main import SQL_SYSTEM_PROMPT
+        builder = SchemaPromptBuilder('employees.db', baseline_prompt=SQL_SYSTEM_PROMPT)
+        try:
+            salary = builder.build("What is the average salary in Engineering?")
+            self.assertEqual(salary.tables, ['employees'])
+            self.assertNotIn('employee_stats', salary.text)
+            self.assertIn('Engineering', salary.text)
+            self.assertIn('aggregation', salary.rules)
+
+            rating = builder.build("Which employees have the best performance rating?")
+            self.assertEqual(rating.tables, ['employees', 'employee_stats'])
+            self.assertIn('- performance_rating (', rating.text)
+            self.assertIn('joins', rating.rules)
+
+            fallback = builder.build("Show me everything")
+            self.assertEqual(fallback.tables, ['employees', 'employee_stats'])
+            self.assertIn('- sick_leave_balance (', fallback.text)
+
+            for build in (salary, rating, fallback):
+                self.assertTrue(build.text.startswith("You are an SQL expert."))
+                self.assertLess(build.tokens, build.baseline_tokens)
+            stats = builder.stats()
+            self.assertEqual((stats['prompts'], stats['pruned']), (3, 2))
+            self.assertGreater(stats['tokens_saved'], 0)
+            self.__class__.test_results['sql_prompt']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_local_sql_compiler(self):
+        """Test if common question shapes compile to parameterized SQL and the rest fall through"""
+        self.__class__.test_results['local_sql']['total'] += 1
+        compiler = QuestionCompiler('employees.db')
+        departments = self.cursor.execute("SELECT COUNT(DISTINCT department) FROM employees").fetchone()[0]
+        expected = {
+            "Who has the highest salary?": [('James', 'Wilson', 250000)],
+            "Show me all employees in engineering": 5,
+            "What is the average salary by department?": departments,
+            "Top 3 employees by performance rating": 3,
+            "How many employees are in Finance?": [(4,)]
+        }
+        try:
+            for question, rows in expected.items():
+                compiled = compiler.compile(question)
+                self.assertIsNotNone(compiled, question)
+                results = self.cursor.execute(compiled.sql, compiled.params).fetchall()
+                self.assertEqual(len(results) if isinstance(rows, int) else results, rows, question)
+            self.assertIn('?', compiler.compile("Employees in the Finance department").sql)
+            self.assertEqual(render_sql("SELECT 1 WHERE x = ? LIMIT ?", ("O'Brien", 5)),
+                             "SELECT 1 WHERE x = 'O''Brien' LIMIT 5")
+
+            for question in self.irrelevant_queries + ["Show me all employees in Marketing",
+                                                       "Who has the highest salary in Engineering?"]:
+                self.assertIsNone(compiler.compile(question), question)
+            stats = compiler.stats()
+            self.assertEqual((stats['hits'], stats['misses']), (6, 6))
+            self.assertEqual(stats['hit_rate'], 0.5)
+
+            # Employees without a rating are left out of the bottom N rather than sorted first
+            compiled = compiler.compile("Bottom 3 employees by performance rating")
+            copy = sqlite3.connect(':memory:')
+            try:
+                self.conn.backup(copy)
+                copy.execute("UPDATE employee_stats SET performance_rating = NULL WHERE employee_id = 1")
+                results = copy.execute(compiled.sql, compiled.params).fetchall()
+            finally:
+                copy.close()
+            self.assertEqual(len(results), 3)
+            self.assertNotIn(None, [row[2] for row in results])
+            self.__class__.test_results['local_sql']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_query_library(self):
+        """Test if verified queries are found exactly, ranked by similarity and kept across restarts"""
+        self.__class__.test_results['query_library']['total'] += 1
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'library.db')
+            library = QueryLibrary(path)
+            try:
+                self.assertEqual(library.lookup("who are the 5 most recently hired employees"), SEED_EXAMPLES[0][1])
+                self.assertIsNone(library.lookup("Who has the lowest salary?"))
+
+                nearest = library.nearest("Which employees have the most annual leave days?")
+                self.assertEqual(nearest[0][1], "Which employees have the most annual leave left?")
+                self.assertEqual(library.nearest("Tell me a joke"), [])
+                # A verified question is never its own example
+                for question, _ in SEED_EXAMPLES:
+                    self.assertNotIn(question, [entry[1] for entry in library.nearest(question.lower(), k=10)])
+
+                library.add_many([(f"Show the employees in team {number}",
+                                   f"SELECT * FROM employees WHERE manager_id = {number}") for number in range(5000)])
+                library.add("Who earns the least?", "SELECT first_name, last_name, salary FROM employees "
+                                                    "ORDER BY salary ASC LIMIT 1")
+                library.close()
+
+                library = QueryLibrary(path)
+                self.assertEqual(library.stats()['entries'], len(SEED_EXAMPLES) + 5001)
+                self.assertIn('ORDER BY salary ASC', library.lookup("Who earns the least?"))
+                self.assertEqual(library.lookup("Show the employees in team 42"),
+                                 "SELECT * FROM employees WHERE manager_id = 42")
+                self.assertEqual(library.nearest("Who earns the least money?")[0][1], "Who earns the least?")
+                self.__class__.test_results['query_library']['passed'] += 1
+            except AssertionError:
+                pass
+            finally:
+                library.close()
+
+    def test_batch_mode(self):
+        """Test batch input parsing, duplicate fan-out and the output file"""
+        self.__class__.test_results['batch']['total'] += 1
+        with tempfile.TemporaryDirectory() as tmp:
+            def write(name, text):
+                path = os.path.join(tmp, name)
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                return path
+
+            jsonl = batch.read_questions(write('questions.jsonl', (
+                '"Who has the highest salary?"\n'
+                '\n'
+                '{"id": "q2", "question": "  Show me all employees in Engineering "}\n'
+                '{"question": "How many employees are there?"}\n'
+            )))
+            with_header = batch.read_questions(write('header.csv', (
+                'id,question\n'
+                'a,Who has the highest salary?\n'
+                'b,\n'
+                'c,"Salary, by department"\n'
+            )))
+            no_id = batch.read_questions(write('no_id.csv', 'team,question\nSales,Who is the boss?\n'))
+            headerless = batch.read_questions(write('plain.csv', (
+                'Who has the highest salary?\n'
+                '\n'
+                'Show me all employees in Engineering\n'
+            )))
+
+            questions = [('a', 'Who has the highest salary?'), ('b', 'Tell me a joke'),
+                         ('c', 'who has the highest salary'), ('d', 'Tell me a joke!'),
+                         ('e', 'List everyone in Sales')]
+            groups = batch.dedupe_questions(questions)
+
+            # Stub the pipeline: one run per unique question, one of them failing
+            calls = []
+
+            def run_pipeline(question):
+                calls.append(question)
+                if 'joke' in question:
+                    raise RuntimeError('pipeline failed')
+                result = main.new_pipeline_result(question)
+                result.update({'relevant': True, 'sql': 'SELECT 1', 'columns': ['value'],
+                               'rows': [(1,)], 'response': 'One'})
+                return result
+
+            original = batch.run_pipeline
+            batch.run_pipeline = run_pipeline
+            try:
+                output = os.path.join(tmp, 'results.jsonl')
+                summary = batch.run_batch(questions, output, workers=2)
+            finally:
+                batch.run_pipeline = original
+            with open(output, encoding='utf-8') as f:
+                records = {record['id']: record for record in map(json.loads, f)}
+
+        try:
+            self.assertEqual(jsonl, [(1, 'Who has the highest salary?'),
+                                     ('q2', 'Show me all employees in Engineering'),
+                                     (4, 'How many employees are there?')])
+            self.assertEqual(with_header, [('a', 'Who has the highest salary?'),
+                                           ('c', 'Salary, by department')])
+            self.assertEqual(no_id, [(2, 'Who is the boss?')])
+            self.assertEqual(headerless, [(1, 'Who has the highest salary?'),
+                                          (3, 'Show me all employees in Engineering')])
+            with self.assertRaises(ValueError):
+                batch.read_questions(os.path.join(tmp, 'questions.txt'))
+
+            # Groups keep first-seen order, and the first wording of each is the one run
+            self.assertEqual([[record_id for record_id, _ in group] for group in groups.values()],
+                             [['a', 'c'], ['b', 'd'], ['e']])
+            self.assertEqual(sorted(calls), sorted(['Who has the highest salary?', 'Tell me a joke',
+                                                    'List everyone in Sales']))
+            self.assertEqual((summary['questions'], summary['unique'], summary['errors']), (5, 3, 1))
+
+            # Every input line gets a record, duplicates pointing at the question that was run
+            self.assertEqual(sorted(records), ['a', 'b', 'c', 'd', 'e'])
+            self.assertEqual((records['a']['answer'], records['a']['rows'], records['a']['error']),
+                             ('One', [[1]], None))
+            self.assertEqual((records['c']['question'], records['c']['answer'], records['c']['duplicate_of']),
+                             ('who has the highest salary', 'One', 'a'))
+            self.assertIsNone(records['a']['duplicate_of'])
+            for record_id in ('b', 'd'):
+                self.assertEqual(records[record_id]['error'], 'pipeline failed')
+                self.assertNotIn('answer', records[record_id])
+            self.assertEqual(records['d']['duplicate_of'], 'b')
+            self.__class__.test_results['batch']['passed'] += 1
+        except AssertionError:
+            pass
+
     def test_response_generation(self):
         """Test if response generation works correctly"""
         self.__class__.test_results['response_generation']['total'] += 1
@@ -228,6 +1384,50 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
         except Exception:
             pass
 
+    def test_result_serialization(self):
+        """Test if results are serialized compactly and summarized when over the token budget"""
+        self.__class__.test_results['response_generation']['total'] += 1
+        try:
+            columns = ['first_name', 'department', 'salary']
+            small = serialize_results(columns, [('John', 'Engineering', 95000.0)])
+            self.assertEqual(small.text, "first_name\tdepartment\tsalary\nJohn\tEngineering\t95000")
+            self.assertFalse(small.summarized)
+
+            rows = [(f'Employee {i}', 'Finance' if i % 2 else 'Engineering', 50000.0 + i) for i in range(1000)]
+            large = serialize_results(columns, ResultRows(rows), token_budget=200)
+            self.assertTrue(large.summarized)
+            self.assertLessEqual(large.tokens, 200)
+            self.assertIn("Row count: 1000", large.text)
+            self.assertIn("salary: min=50000 max=50999", large.text)
+            self.assertGreater(large.tokens_saved, 0)
+            self.__class__.test_results['response_generation']['passed'] += 1
+        except AssertionError:
+            pass
+
+    def test_templated_responses(self):
+        """Test if simple results are answered from templates and complex ones are left to the LLM"""
+        self.__class__.test_results['response_generation']['total'] += 1
+        try:
+            self.assertEqual(render_response(['AVG(salary)'], [(117500.0,)]), "The average salary is 117,500.00.")
+            self.assertEqual(render_response(['employee_count'], [(10,)]), "The employee count is 10.")
+            self.assertEqual(render_response(['total_salary'], [(1250000,)]), "The total salary is 1,250,000.")
+            self.assertEqual(render_response(['year'], [(2020,)]), "The year is 2020.")
+            self.assertIn("Amount paid: 1,500, Employee id: 1042",
+                          render_response(['amount_paid', 'employee_id'], [(1500, 1042)]))
+            self.assertIn("Id: 1042", render_response(['id', 'first_name'], [(1042, 'John')]))
+            self.assertIn("Hire year: 2020, Headcount: 1,200",
+                          render_response(['hire_year', 'headcount'], [(2020, 1200)]))
+            self.assertIn("First name: John", render_response(['first_name', 'salary'], [('John', 95000.0)]))
+            self.assertIn("match your question", render_response(['first_name'], []))
+
+            # Wide or long results still go to the LLM
+            wide_row = tuple(range(8))
+            self.assertIsNone(render_response([f'column_{i}' for i in range(8)], [wide_row, wide_row]))
+            self.assertIsNone(render_response(['first_name'], [('John',)] * 50))
+            self.__class__.test_results['response_generation']['passed'] += 1
+        except AssertionError:
+            pass
+
     def test_foreign_key_constraints(self):
         """Test if foreign key constraints are working"""
         self.__class__.test_results['data_integrity']['total'] += 1
@@ -255,6 +1455,47 @@ class TestEmployeeDatabaseSystem(unittest.TestCase):
         except Exception:
             pass
 
+    def test_sql_cache(self):
+        """Test if cached SQL is reused for normalized questions and dropped on schema changes"""
+        self.__class__.test_results['sql_cache']['total'] += 1
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = QueryCache(os.path.join(cache_dir, 'query_cache.db'), 'employees.db')
+            cache.put("Who are the top 5 earners?", "SELECT first_name FROM employees ORDER BY salary DESC LIMIT 5")
+
+            # Case, punctuation and number literals are normalized away
+            self.assertEqual(cache.get("who are the TOP 3 earners"),
+                             "SELECT first_name FROM employees ORDER BY salary DESC LIMIT 3")
+            self.assertIsNone(cache.get("Who are the lowest earners?"))
+
+            # Changing the schema invalidates every entry
+            self.cursor.execute("CREATE TABLE cache_test (id INTEGER)")
+            self.conn.commit()
+            self.assertIsNone(cache.get("Who are the top 5 earners?"))
+
+            # Generated SQL is only cached once it has executed
+            broken, working = "Which employees speak Klingon fluently?", "Which employees joined on a Tuesday?"
+            mock = MockOpenAIServer(questions={broken: "SELECT klingon FROM employees",
+                                               working: "SELECT first_name FROM employees LIMIT 1"}).start()
+            client, mode = main.client, main.LLM_CASSETTE_MODE
+            main.get_query_cache().clear()
+            try:
+                main.client, main.LLM_CASSETTE_MODE = OpenAI(api_key='sk-cache', base_url=mock.base_url), 'off'
+                with self.assertRaises((sqlite3.Error, SQLGuardError)):
+                    main.run_pipeline(broken)
+                self.assertEqual(main.run_pipeline(working)['sql_source'], 'llm')
+            finally:
+                main.client, main.LLM_CASSETTE_MODE = client, mode
+                mock.stop()
+            self.assertIsNone(main.get_query_cache().get(broken))
+            self.assertEqual(main.get_query_cache().get(working), "SELECT first_name FROM employees LIMIT 1")
+            self.__class__.test_results['sql_cache']['passed'] += 1
+        except AssertionError:
+            pass
+        finally:
+            self.cursor.execute("DROP TABLE IF EXISTS cache_test")
+            self.conn.commit()
+
     @classmethod
     def tearDownClass(cls):
         """Print final accuracy report after all tests"""
@@ -0,0 +1,232 @@
+import contextvars
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# The trace of the request being processed; copied into threads and tasks the request fans out to
+_current_trace = contextvars.ContextVar('pipeline_trace', default=None)
+
+
+class PipelineTrace:
+    """
+    Structured record of one pipeline request: time per stage, every LLM call
+    with its token usage and retries, cache hits, rows returned and any error
+    """
+
+    def __init__(self, question, path='sync'):
+        self.trace_id = uuid.uuid4().hex
+        self.question = question
+        self.path = path
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self.total_seconds = None
+        self.stages = {}
+        self.llm_calls = []
+        self.cache = {'sql': None, 'result': None}
+        self.relevance_source = None
+        self.relevant = None
+        self.sql_source = None
+        self.response_source = None
+        self.rows = None
+        self.error = None
+        self.error_stage = None
+
+    def add_stage(self, name, seconds):
+        with self._lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_llm_call(self, stage, usage, retries, seconds):
+        with self._lock:
+            self.llm_calls.append({
+                'stage': stage,
+                'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+                'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0,
+                'retries': retries,
+                'seconds': seconds
+            })
+
+    def finish(self, result=None, error=None):
+        self.total_seconds = time.perf_counter() - self._start
+        if result is not None:
+            self.relevant = result['relevant']
+            self.sql_source = result['sql_source']
+            self.response_source = result['response_source']
+            if result['sql'] is not None:
+                self.rows = len(result['rows'])
+        if error is not None:
+            self.error = f'{type(error).__name__}: {error}'
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'trace_id': self.trace_id,
+                'started_at': self.started_at,
+                'path': self.path,
+                'question': self.question,
+                'total_seconds': self.total_seconds,
+                'stages': dict(self.stages),
+                'llm_calls': list(self.llm_calls),
+                'prompt_tokens': sum(call['prompt_tokens'] for call in self.llm_calls),
+                'completion_tokens': sum(call['completion_tokens'] for call in self.llm_calls),
+                'retries': sum(call['retries'] for call in self.llm_calls),
+                'cache': dict(self.cache),
+                'relevance_source': self.relevance_source,
+                'relevant': self.relevant,
+                'sql_source': self.sql_source,
+                'response_source': self.response_source,
+                'rows': self.rows,
+                'error': self.error,
+                'error_stage': self.error_stage
+            }
+
+
+class TraceLog:
+    """
+    Appends finished traces to a file as JSON lines
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, trace):
+        line = json.dumps(trace, default=str) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def request_trace(question, path='sync', registry=None, log=None, enabled=True):
+    """
+    Trace the pipeline request run inside the block and yield the trace, or None when
+    tracing is disabled. When the block ends the trace goes to the registry and the log.
+    """
+    if not enabled:
+        yield None
+        return
+    trace = PipelineTrace(question, path)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    except BaseException as e:
+        if trace.total_seconds is None:
+            trace.finish(error=e)
+        raise
+    finally:
+        _current_trace.reset(token)
+        if trace.total_seconds is None:
+            trace.finish()
+        record = trace.to_dict()
+        if registry is not None:
+            registry.observe_trace(record)
+        if log is not None:
+            log.write(record)
+
+
+@contextmanager
+def trace_stage(name):
+    """
+    Add the time spent in the block to the current trace's stage; a no-op without a trace
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        if trace.error_stage is None:
+            trace.error_stage = name
+        raise
+    finally:
+        trace.add_stage(name, time.perf_counter() - start)
+
+
+def set_trace_attribute(name, value):
+    trace = _current_trace.get()
+    if trace is not None:
+        setattr(trace, name, value)
+
+
+def record_cache_lookup(cache, hit):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.cache[cache] = hit
+
+
+def record_llm_call(stage, usage, retries, seconds):
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_llm_call(stage, usage, retries, seconds)
+
+
+def run_in_trace_context(function, *args):
+    """
+    Return a callable running function(*args) in a copy of the current context,
+    for handing work to a thread pool without losing the request's trace
+    """
+    context = contextvars.copy_context()
+    return lambda: context.run(function, *args)
+
+
+def iterate_in_context(steps):
+    """
+    Iterate the generator in a copy of the current context, so a trace it sets (pipeline_trace
+    around its steps) is current only while a step runs and never leaks to the caller between
+    events. Closing the iterator closes the generator in that context too.
+    """
+    context = contextvars.copy_context()
+    try:
+        event = context.run(next, steps)
+        while True:
+            try:
+                yield event
+            except GeneratorExit:
+                context.run(steps.close)
+                raise
+            except BaseException as e:
+                event = context.run(steps.throw, e)
+            else:
+                event = context.run(next, steps)
+    except StopIteration:
+        return
+
+
+async def iterate_in_context_async(steps):
+    """
+    Async version of iterate_in_context. A coroutine cannot be run in another context without
+    a task of its own, so the trace the steps set is saved after each step and current again
+    only for the next one.
+    """
+    trace = _current_trace.get()
+    try:
+        while True:
+            token = _current_trace.set(trace)
+            try:
+                event = await steps.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                trace = _current_trace.get()
+                _current_trace.reset(token)
+            yield event
+    finally:
+        token = _current_trace.set(trace)
+        try:
+            await steps.aclose()
+        finally:
+            _current_trace.reset(token)